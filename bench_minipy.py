@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+
+"""Benchmark suite for minipy.
+
+Usage: bench_minipy.py [options] [FILE|DIR ...]
+       bench_minipy.py --compare OLD.json NEW.json
+       bench_minipy.py --imports FILE|DIR ...
+       bench_minipy.py --loops
+
+Runs minipy over a fixed set of corpora and reports, for each corpus,
+the throughput of each phase (parse, reserved_names_in_ast, rename_ast,
+find_renaming, serialize_ast and the self-test), the size of the output
+relative to the input (also when indented with --tabs, and when renamed
+and compressed, with names chosen for each --target), and the peak
+memory use. The corpora are:
+
+stdlib  -- the top-level modules of the Python standard library
+literal -- synthetic modules consisting of giant literals
+nested  -- synthetic modules consisting of deeply nested expressions
+blocks  -- synthetic modules consisting of deeply nested blocks
+files   -- the Python files named on the command line, if any
+
+Each corpus is run in its own process so that the peak memory use can
+be measured. The results can be saved as JSON with --output, and two
+saved results compared with --compare, which reports any phase that
+got slower by more than --threshold, or any output that got larger by
+more than --size-threshold, and exits with status 1 if there are any.
+
+With --imports, it instead times importing all the modules named on
+the command line in a fresh process, from the source tree, from the
+minified tree, from the tree minified with --defer (see
+minipy.defer_imports), and from a bundle (see minipy.bundle).
+
+With --loops, it instead times some loop-heavy functions, minified
+without and with --localize (see minipy.localize_loops).
+
+"""
+
+from ast import parse, walk
+import json
+import minipy
+import os
+import sys
+from time import time
+
+PHASES = ('parse reserved_names_in_ast rename_ast find_renaming serialize_ast '
+          'selftest'.split())
+
+def stdlib_corpus():
+    """Return a list of the sources of the top-level standard library
+    modules that minipy can parse and rename.
+
+    """
+    lib = os.path.dirname(os.__file__)
+    sources = []
+    for f in sorted(os.listdir(lib)):
+        if f.endswith('.py'):
+            source = open(os.path.join(lib, f)).read()
+            try:
+                minipy.reserved_names_in_ast(parse(source))
+            except Exception:
+                continue
+            sources.append(source)
+    return sources
+
+def literal_corpus():
+    """Return a list of synthetic modules consisting of giant literals:
+    tables of numbers, dictionaries of strings, and long strings.
+
+    """
+    table = '\n'.join('TABLE_{0} = [{1}]'.format(
+            i, ', '.join(str((i * 7919 + j * 104729) % 65536)
+                         for j in range(2000)))
+                      for i in range(100))
+    strings = 'STRINGS = {{\n{0}\n}}\n'.format('\n'.join(
+            "    'key_{0}': 'value \\t{0}\\n \"quoted\" \\'{1}\\'',".format(i, i * i)
+            for i in range(20000)))
+    text = 'TEXT = {0!r}\n'.format(''.join(
+            chr(32 + (i * 31) % 95) for i in range(200000)))
+    return [table, strings, text]
+
+def nested_corpus():
+    """Return a list of synthetic modules consisting of deeply nested
+    expressions of various kinds.
+
+    """
+    depth = 80
+    operators = '+ - * / % ** << >> & | ^ //'.split()
+    displays = '[{0}, {1}]', '{{{1}: {0}}}', '({0}, {1})'
+    sources = []
+    binops = []
+    for i in range(200):
+        e = 'a'
+        for d in range(depth):
+            e = '({0} {1} x{2})'.format(e, operators[(i + d) % len(operators)], d)
+        binops.append('v{0} = {1}'.format(i, e))
+    sources.append('\n'.join(binops) + '\n')
+    others = []
+    for i in range(200):
+        call, lst, lam = 'a', 'a', 'a'
+        for d in range(depth // 2):
+            call = 'f{0}({1}, k={0})'.format(d, call)
+            lst = displays[d % len(displays)].format(lst, d)
+            lam = 'lambda y{0}: {1} if y{0} else -y{0}'.format(d, lam)
+        others.append('c{0} = {1}\nl{0} = {2}\nf{0} = {3}'
+                      .format(i, call, lst, lam))
+    sources.append('\n'.join(others) + '\n')
+    return sources
+
+def blocks_corpus():
+    """Return a list of synthetic modules consisting of deeply nested
+    blocks, like generated state machines.
+
+    """
+    depth = 24
+
+    def block(d):
+        indent = '    ' * (d + 1)
+        if d == depth:
+            return [indent + 'return state']
+        return ([indent + 'state = state * 31 + data[{0}]'.format(d),
+                 indent + 'if state % {0}:'.format(d + 2)]
+                + block(d + 1)
+                + [indent + 'elif state > {0}:'.format(d),
+                   indent + '    state -= {0}'.format(d + 1),
+                   indent + 'else:',
+                   indent + '    return {0}'.format(d)])
+    lines = []
+    for i in range(100):
+        lines.append('def machine_{0}(state, data):'.format(i))
+        lines.extend(block(0))
+    return ['\n'.join(lines) + '\n']
+
+def loop_samples():
+    """Return a dictionary mapping name to the source of a loop-heavy
+    module, whose function run does the work.
+
+    """
+    return dict(
+        numeric='''
+import math
+
+def run():
+    total = 0.0
+    for i in xrange(200000):
+        total += math.sqrt(abs(i - 100000)) + math.floor(i / 3.0)
+    return total
+''',
+        methods='''
+def collect(n):
+    items = []
+    seen = set()
+    for i in xrange(n):
+        key = i % 1000
+        if key not in seen:
+            seen.add(key)
+        items.append(key)
+    return len(items)
+
+def run():
+    return collect(200000)
+''',
+        text='''
+def checksum(text):
+    result = []
+    i = 0
+    while i < len(text):
+        result.append(chr((ord(text[i]) * 7 + i) % 256))
+        i += 1
+    return hash(''.join(result))
+
+def run():
+    return checksum('The quick brown fox jumps over the lazy dog. ' * 2000)
+''')
+
+def loops(repeat=5):
+    """Time the function run in each of the loop_samples, minified
+    without and with localize=True, and return a dictionary mapping
+    sample name to a dictionary giving the best times and the number of
+    lookups moved out of loops.
+
+    """
+    results = dict()
+    for name, source in sorted(loop_samples().items()):
+        stats = dict()
+        minified = minipy.minify_source(source, None, name + '.py')
+        localized = minipy.minify_source(source, None, name + '.py',
+                                         localize=True, stats=stats)
+        times = []
+        for code in (minified, localized):
+            namespace = dict()
+            exec(compile(code, name + '.py', 'exec'), namespace)
+            best = None
+            for _ in range(repeat):
+                start = time()
+                namespace['run']()
+                elapsed = time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            times.append(best)
+        results[name] = dict(before=times[0], after=times[1],
+                             localized=stats['localized'])
+    return results
+
+def files_corpus(paths):
+    """Return a list of the sources of the Python files under paths."""
+    return [open(f).read() for f, _ in minipy.find_sources(paths, '')]
+
+def compressed_size(sources, target):
+    """Return the total size of the sources when minified with renaming
+    for target (see minipy.rename_ast) and compressed with zlib.
+
+    """
+    import zlib
+    size = 0
+    for source in sources:
+        tree = parse(source)
+        renaming = minipy.find_renaming(tree, target=target,
+                                        reserve=minipy.FindReserved())
+        size += len(zlib.compress(minipy.serialize_ast(
+                    tree, docstrings=True, renaming=renaming), 9))
+    return size
+
+def run_corpus(sources, repeat=3):
+    """Run each phase over the sources repeat times and return a dictionary
+    of results, taking the best time for each phase.
+
+    """
+    best = dict((p, None) for p in PHASES)
+    for _ in range(repeat):
+        times = dict((p, 0.0) for p in PHASES)
+        nodes = 0
+        sizes = dict(source=0, minified=0, tabs=0, renamed=0)
+        for source in sources:
+            t = time()
+            tree = parse(source)
+            times['parse'] += time() - t
+            t = time()
+            visitor = minipy.SerializeVisitor()
+            visitor.start()
+            visitor.visit(tree)
+            minified = ''.join(visitor.result)
+            times['serialize_ast'] += time() - t
+            t = time()
+            visitor.check(tree, minified)
+            times['selftest'] += time() - t
+            sizes['tabs'] += len(minipy.serialize_ast(tree, tabs=True,
+                                                      selftest=False))
+            t = time()
+            minipy.find_renaming(tree, reserve=minipy.FindReserved())
+            times['find_renaming'] += time() - t
+            t = time()
+            reserved = minipy.reserved_names_in_ast(tree)
+            times['reserved_names_in_ast'] += time() - t
+            t = time()
+            minipy.rename_ast(tree, reserved)
+            times['rename_ast'] += time() - t
+            renamed = minipy.serialize_ast(tree, docstrings=True)
+            nodes += sum(1 for _ in walk(tree))
+            sizes['source'] += len(source)
+            sizes['minified'] += len(minified)
+            sizes['renamed'] += len(renamed)
+        for p in PHASES:
+            if best[p] is None or times[p] < best[p]:
+                best[p] = times[p]
+    phases = dict()
+    for p in PHASES:
+        seconds = max(best[p], 1e-9)
+        phases[p] = dict(seconds=best[p],
+                         nodes_per_second=nodes / seconds,
+                         bytes_per_second=sizes['source'] / seconds)
+    for target in 'raw', 'gzip':
+        sizes['compressed_' + target] = compressed_size(sources, target)
+    for s in 'minified tabs renamed compressed_raw compressed_gzip'.split():
+        sizes[s + '_ratio'] = float(sizes[s]) / sizes['source']
+    return dict(files=len(sources), nodes=nodes, phases=phases, sizes=sizes)
+
+def peak_rss():
+    """Return the peak resident set size of this process in kilobytes."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024            # Bytes on OS X, kilobytes elsewhere.
+    return rss
+
+def child(name, paths, repeat):
+    """Run the named corpus in this process and write the results to
+    standard output as JSON.
+
+    """
+    corpora = dict(stdlib=stdlib_corpus, literal=literal_corpus,
+                   nested=nested_corpus, blocks=blocks_corpus,
+                   files=lambda: files_corpus(paths))
+    before = peak_rss()
+    result = run_corpus(corpora[name](), repeat)
+    result['peak_rss_kb'] = peak_rss()
+    result['startup_rss_kb'] = before
+    json.dump(result, sys.stdout)
+
+def time_imports(roots, names, repeat=5):
+    """Import the named modules in a fresh process with roots at the
+    start of sys.path, repeat times, and return the best time taken.
+    Each root is a directory, or a bundle, which is imported first.
+
+    """
+    from subprocess import Popen, PIPE
+    code = """if 1:
+        import os, sys, time
+        start = time.time()
+        for root in {0!r}:
+            if root.endswith('.py'):
+                sys.path.insert(0, os.path.dirname(root))
+                __import__(os.path.basename(root)[:-3])
+            else:
+                sys.path.insert(0, root)
+        for name in {1!r}:
+            __import__(name)
+        print(time.time() - start)
+        """.format(roots, names)
+    times = []
+    for _ in range(repeat + 1):  # The first run writes .pyc files.
+        output, _ = Popen([sys.executable, '-c', code],
+                          stdout=PIPE).communicate()
+        times.append(float(output))
+    return min(times[1:])
+
+def imports(paths, repeat=5):
+    """Minify the Python files under paths, and return a dictionary
+    giving the number of modules and the best time to import them all
+    from the source tree, the minified tree, the tree minified with
+    defer=True (and the number of imports moved) and a bundle.
+
+    """
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    tmpdir = mkdtemp()
+    try:
+        minified = os.path.join(tmpdir, 'tree')
+        deferred = os.path.join(tmpdir, 'deferred')
+        roots = set()
+        names = []
+        moved = 0
+        for source, _ in minipy.find_sources(paths, ''):
+            name = minipy.module_name(source)
+            parts = name.split('.')
+            root = os.path.abspath(source)
+            for _ in parts:
+                root = os.path.dirname(root)
+            roots.add(root)
+            for tree, defer in (minified, False), (deferred, True):
+                destination = os.path.join(tree, *parts) + '.py'
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                stats = dict()
+                minipy.minify(source, output=destination, defer=defer,
+                              stats=stats)
+                moved += len(stats.get('deferred', ()))
+            if name.endswith('.__init__'):
+                name = name[:-len('.__init__')]
+            names.append(name)
+        bundle = os.path.join(tmpdir, 'minipy_bundle.py')
+        minipy.bundle(paths, bundle, jobs=1)
+        return dict(modules=len(names),
+                    source=time_imports(sorted(roots), names, repeat),
+                    minified=time_imports([minified], names, repeat),
+                    deferred=time_imports([deferred], names, repeat),
+                    moved=moved,
+                    bundle=time_imports([bundle], names, repeat))
+    finally:
+        rmtree(tmpdir)
+
+def run(names, paths, repeat):
+    """Run the named corpora, each in its own process, and return a
+    dictionary mapping corpus name to results.
+
+    """
+    from subprocess import Popen, PIPE
+    results = dict()
+    for name in names:
+        args = [sys.executable, os.path.abspath(__file__), '--child', name,
+                '--repeat', str(repeat)] + paths
+        output, _ = Popen(args, stdout=PIPE).communicate()
+        results[name] = json.loads(output)
+    return results
+
+def report(results, out=sys.stdout):
+    for name in sorted(results):
+        r = results[name]
+        out.write('{0}: {1} files, {2} nodes, peak RSS {3} kB\n'
+                  .format(name, r['files'], r['nodes'], r['peak_rss_kb']))
+        for p in PHASES:
+            phase = r['phases'][p]
+            out.write('  {0:24}{1:10.3f} s{2:14.0f} nodes/s{3:14.0f} bytes/s\n'
+                      .format(p, phase['seconds'], phase['nodes_per_second'],
+                              phase['bytes_per_second']))
+        s = r['sizes']
+        out.write('  output size: {0:.3f} (minified), {1:.3f} (renamed)\n'
+                  .format(s['minified_ratio'], s['renamed_ratio']))
+        if 'tabs_ratio' in s:
+            out.write('  with --tabs: {0:.4f} (minified), saving {1} bytes\n'
+                      .format(s['tabs_ratio'], s['minified'] - s['tabs']))
+        if 'compressed_raw_ratio' in s:
+            out.write('  compressed size: {0:.4f} (--target=raw), {1:.4f} '
+                      '(--target=gzip)\n'.format(s['compressed_raw_ratio'],
+                                                  s['compressed_gzip_ratio']))
+
+def compare(old, new, threshold=0.1, size_threshold=0.0):
+    """Compare two sets of results and return a list of regressions,
+    each a string describing a phase that got slower by more than the
+    fraction threshold, or an output that got larger by more than the
+    fraction size_threshold.
+
+    """
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        o, n = old[name], new[name]
+        for p in PHASES:
+            if p not in o['phases']:
+                continue
+            before = o['phases'][p]['nodes_per_second']
+            after = n['phases'][p]['nodes_per_second']
+            if after < before * (1 - threshold):
+                regressions.append('{0}: {1} slowed from {2:.0f} to {3:.0f} '
+                                   'nodes/s ({4:+.1%})'.format(
+                        name, p, before, after, after / before - 1))
+        for s in ('minified_ratio tabs_ratio renamed_ratio '
+                  'compressed_raw_ratio compressed_gzip_ratio').split():
+            if s not in o['sizes'] or s not in n['sizes']:
+                continue
+            before, after = o['sizes'][s], n['sizes'][s]
+            if after > before * (1 + size_threshold):
+                regressions.append('{0}: {1} grew from {2:.4f} to {3:.4f} '
+                                   '({4:+.2%})'.format(
+                        name, s, before, after, after / before - 1))
+    return regressions
+
+def main():
+    import optparse
+    p = optparse.OptionParser(usage="usage: %prog [options] [FILE|DIR ...]\n"
+                              "       %prog --compare OLD.json NEW.json")
+    p.add_option('--output', '-o',
+                 help="save the results to this file as JSON")
+    p.add_option('--corpus', '-c', action='append',
+                 help="run only this corpus (may be repeated)")
+    p.add_option('--repeat', '-r', type='int', default=3,
+                 help="number of times to run each phase (default: 3)")
+    p.add_option('--compare', action='store_true', default=False,
+                 help="compare two saved results")
+    p.add_option('--threshold', type='float', default=0.1,
+                 help="fractional slowdown to report (default: 0.1)")
+    p.add_option('--size-threshold', type='float', default=0.0,
+                 help="fractional output size increase to report "
+                 "(default: 0)")
+    p.add_option('--imports', action='store_true', default=False,
+                 help="time importing the files from the source tree, "
+                 "the minified tree (also with --defer) and a bundle")
+    p.add_option('--loops', action='store_true', default=False,
+                 help="time loop-heavy functions minified without and "
+                 "with --localize")
+    p.add_option('--child', help=optparse.SUPPRESS_HELP)
+    opts, args = p.parse_args()
+    if opts.child:
+        child(opts.child, args, opts.repeat)
+        return
+    if opts.compare:
+        if len(args) != 2:
+            p.error("--compare needs two result files")
+        old, new = [json.load(open(f)) for f in args]
+        regressions = compare(old, new, opts.threshold, opts.size_threshold)
+        for r in regressions:
+            print(r)
+        sys.exit(1 if regressions else 0)
+    if opts.imports:
+        if not args:
+            p.error("--imports needs files or directories")
+        result = imports(args, opts.repeat)
+        print('{0} modules imported in {1:.4f} s (source), {2:.4f} s '
+              '(minified), {3:.4f} s (with --defer, {4} imports moved), '
+              '{5:.4f} s (bundle)'.format(
+                result['modules'], result['source'], result['minified'],
+                result['deferred'], result['moved'], result['bundle']))
+        return
+    if opts.loops:
+        for name, r in sorted(loops(opts.repeat).items()):
+            print('{0}: {1:.4f} s without, {2:.4f} s with --localize, '
+                  '{3:.2f}x faster ({4} lookups localized)'.format(
+                    name, r['before'], r['after'], r['before'] / r['after'],
+                    r['localized']))
+        return
+    names = (opts.corpus or ['stdlib', 'literal', 'nested', 'blocks']
+             + ['files'] * bool(args))
+    results = run(names, args, opts.repeat)
+    report(results)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
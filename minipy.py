@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 
 from ast import *
-from imp import find_module, load_module
+import __builtin__
+from imp import find_module, C_BUILTIN, PKG_DIRECTORY, PY_SOURCE
 from math import isinf
 import re
-from string import ascii_lowercase, ascii_uppercase
-from sys import stderr, stdout
+from string import ascii_lowercase, ascii_uppercase, digits
+from sys import exit, stderr, stdin, stdout
 
 __author__ = __maintainer__ = 'Gareth Rees'
 __email__ = 'gdr@garethrees.org'
@@ -14,7 +15,8 @@ __license__ = "GNU General Public License (GPL) Version 3"
 __status__ = 'Development'
 __version_info__ = (0, 2)
 __version__ = '{0}.{1}'.format(*__version_info__)
-__all__ = 'serialize_ast reserved_names_in_ast rename_ast detect_encoding minify'.split()
+__all__ = ('serialize_ast reserved_names_in_ast rename_ast find_renaming '
+           'detect_encoding minify minify_files MinifyCache').split()
 
 class Assoc:
     Non = 0
@@ -30,55 +32,96 @@ class Prec:
     Attribute = 17
     Max = 18
 
-class SavePrecedence:
-    """Context manager class that saves and restores the precedence and
-    associativity for a SerializeVisitor instance, and emits a pair of
-    parentheses if necessary to preserve the meaning.
-
-    """
-    def __init__(self, visitor, prec=Prec.Max, assoc=Assoc.Non, force=False):
-        self.v = visitor
-        self.new_prec = prec
-        self.paren = (force
-                      or prec < self.v.prec
-                      or prec == self.v.prec
-                      and (self.v.assoc == Assoc.Non
-                           or self.v.assoc != assoc))
-
-    def __enter__(self):
-        self.saved_prec = self.v.prec
-        self.saved_assoc = self.v.assoc
-        self.saved_operator = self.v.operator
-        if self.paren:
-            self.v.emit('(')
-            self.v.prec = Prec.Paren
-            self.v.assoc = Assoc.Non
-
-    def __exit__(self, *e):
-        if self.paren:
-            self.v.emit(')')
-        self.v.prec = self.saved_prec
-        self.v.assoc = self.saved_assoc
-        self.v.operator = self.saved_operator
-
 class SerializeVisitor(NodeVisitor):
     def __init__(self, docstrings=False, encoding='latin1', indent=1,
-                 joinlines=True, selftest=True, **kwargs):
+                 joinlines=True, selftest=True, renaming=None, tabs=False,
+                 **kwargs):
         self.docstrings = docstrings
         self.encoding = encoding
         self.indent = indent
         self.joinlines = joinlines
         self.selftest = selftest
+        self.renaming = renaming
+        self.tabs = tabs
         self.unicode_literals = False
+        self.dispatch = self.dispatch_table()
 
-    def selftest_failure(self, result, original, minified):
-        import difflib
-        return ("RESULT\n{3}\n{0}\n\n"
-                "ORIGINAL\n{3}\n{1}\n\n"
-                "MINIFIED\n{3}\n{2}\n"
-                .format(result, original, minified, '-' * 72))
+    @classmethod
+    def dispatch_table(cls):
+        """Return a dictionary mapping each type of node to the function
+        that serializes it, building it the first time it's needed for
+        the class.
 
-    def serialize(self, tree):
+        """
+        table = cls.__dict__.get('_dispatch')
+        if table is None:
+            table = dict()
+            for t in globals().values():
+                if isinstance(t, type) and issubclass(t, AST):
+                    method = getattr(cls, 'visit_' + t.__name__,
+                                     cls.generic_visit)
+                    table[t] = method.im_func
+            cls._dispatch = table
+        return table
+
+    def visit(self, node):
+        return self.dispatch[type(node)](self, node)
+
+    def push(self, prec=Prec.Max, assoc=Assoc.Non, force=False):
+        """Save the precedence, associativity and operator, and emit an
+        opening parenthesis if one is needed to preserve the meaning of
+        an expression with precedence prec and associativity assoc in
+        the current context. Return the saved state, to be passed to
+        pop at the end of the expression.
+
+        """
+        p = self.prec
+        a = self.assoc
+        paren = force or prec < p or prec == p and (a == Assoc.Non or a != assoc)
+        saved = p, a, self.operator, paren
+        if paren:
+            self.emit('(')
+            self.prec = Prec.Paren
+            self.assoc = Assoc.Non
+        return saved
+
+    def pop(self, saved):
+        """Restore the state saved by push, and emit a closing parenthesis
+        if push emitted an opening one.
+
+        """
+        self.prec, self.assoc, self.operator, paren = saved
+        if paren:
+            self.emit(')')
+
+    def selftest_failure(self, result, original, minified, statement):
+        lineno = getattr(original, 'lineno', None)
+        if lineno is None:
+            lineno = getattr(statement, 'lineno', '?')
+        lines = result.splitlines()
+        line = ''
+        if hasattr(minified, 'lineno') and minified.lineno <= len(lines):
+            line = lines[minified.lineno - 1]
+        return ("self-test failed at line {0} of the original\n\n"
+                "ORIGINAL\n{4}\n{1}\n\n"
+                "MINIFIED\n{4}\n{2}\n\n"
+                "MINIFIED LINE\n{4}\n{3}\n"
+                .format(lineno, dump(original), dump(minified), line, '-' * 72))
+
+    def check(self, tree, result, flags=0):
+        """Re-parse the serialized result (with the compiler flags for any
+        future features in effect) and check that it has the same parse
+        tree as the original. Return the parse tree of the result.
+
+        """
+        minified = compile(result.decode(self.encoding), '<minified>', 'exec',
+                           PyCF_ONLY_AST | flags)
+        difference = compare_ast(tree, minified, self.renaming)
+        if difference:
+            raise AssertionError, self.selftest_failure(result, *difference)
+        return minified
+
+    def start(self):
         self.lastchar = '\n'
         self.lastemit = '\n'
         self.lastnum = False
@@ -87,14 +130,55 @@ class SerializeVisitor(NodeVisitor):
         self.assoc = Assoc.Non
         self.operator = None
         self.result = []
+
+    def serialize(self, tree):
+        result = self.unparse(tree)
+        self.test(tree, result)
+        return result
+
+    def unparse(self, tree):
+        """Serialize tree without running the self-test."""
+        self.start()
         self.visit(tree)
-        result = ''.join(self.result)
+        return ''.join(self.result)
+
+    def test(self, tree, result, flags=0):
+        """Run the self-test on result, if enabled, and return the parse
+        tree of the result; otherwise return None. (It's not possible if
+        docstrings are being removed.)
+
+        """
         if not self.docstrings and self.selftest:
-            original = dump(tree)
-            minified = dump(parse(result.decode(self.encoding)))
-            if original != minified:
-                raise AssertionError, self.selftest_failure(result, original, minified)
-        return result
+            return self.check(tree, result, flags)
+
+    def serialize_stream(self, modules, write):
+        """Serialize a sequence of pairs (tree, flags), where each tree is
+        a module containing some of the top-level statements of a larger
+        module and flags are the compiler flags for the future features
+        in effect, as if they were a single module. Pass the result to
+        the function write, one piece for each tree, so that only one
+        tree needs to be in memory at a time.
+
+        """
+        self.start()
+        self.depth = 0
+        prev_multiline = False
+        statements = 0
+        empty = True
+        for tree, flags in modules:
+            empty = empty and not tree.body
+            for b in tree.body:
+                if self.docstrings and self.no_side_effects(b):
+                    continue
+                prev_multiline = self.visit_statement(b, prev_multiline,
+                                                      statements)
+                statements += 1
+            result = ''.join(self.result)
+            self.result = []
+            self.test(tree, result.lstrip(';\n'), flags)
+            write(result)
+        if statements == 0 and not empty:
+            write('0')
 
     ops = {
         # Generator          0
@@ -139,21 +223,23 @@ class SerializeVisitor(NodeVisitor):
     # they are nested they cannot be combined onto one line: for
     # example, "if x:pass" is OK, but "if x:if y:pass" is a syntax
     # error.
-    multiliners = [
+    multiliners = frozenset([
         ClassDef, For, FunctionDef, If, TryExcept, TryFinally, While, With
-        ]
+        ])
 
     def comma(self, b=True):
         self.emit(',', b)
 
+    idchars = frozenset(ascii_lowercase + ascii_uppercase + digits + '_')
+
     def idchar(self, c):
-        return c.isalnum() or c == '_'
+        return c in self.idchars
 
     def emit_raw(self, s):
         self.result.append(s)
 
     def space_needed(self, s):
-        if not self.idchar(self.lastchar) or not self.idchar(s[0]):
+        if self.lastchar not in self.idchars or s[0] not in self.idchars:
             return False
         if not self.lastnum:
             return True
@@ -165,9 +251,9 @@ class SerializeVisitor(NodeVisitor):
 
     def emit(self, s, emit=True):
         if emit:
-            if self.space_needed(s):
-                self.emit_raw(' ')
-            self.emit_raw(s)
+            if self.lastchar in self.idchars and self.space_needed(s):
+                self.result.append(' ')
+            self.result.append(s)
             self.lastchar = s[-1]
             self.lastemit = s
             self.lastnum = False
@@ -176,13 +262,27 @@ class SerializeVisitor(NodeVisitor):
         if self.lastchar != '\n':
             self.emit('\n')
             if self.depth > 0:
-                self.emit_raw(' ' * self.depth * self.indent)
+                columns = self.depth * self.indent
+                if self.tabs:
+                    # Python 2 takes a tab to the next multiple of 8.
+                    self.emit_raw('\t' * (columns // 8) + ' ' * (columns % 8))
+                else:
+                    self.emit_raw(' ' * columns)
+
+    def name(self, node, field):
+        # The name in the field of node, after renaming.
+        if self.renaming is None:
+            return getattr(node, field)
+        return self.renaming.field(node, field)
 
     def visit_alias(self, node):
-        self.emit(node.name)
-        if node.asname:
+        name, asname = node.name, node.asname
+        if self.renaming is not None:
+            name, asname = self.renaming.alias(node)
+        self.emit(name)
+        if asname:
             self.emit('as')
-            self.emit(node.asname)
+            self.emit(asname)
 
     def visit_arguments(self, node):
         i = 0
@@ -195,15 +295,15 @@ class SerializeVisitor(NodeVisitor):
             i += 1
         if node.vararg:
             self.comma(i)
-            self.emit('*' + node.vararg)
+            self.emit('*' + self.name(node, 'vararg'))
             i += 1
         if node.kwarg:
             self.comma(i)
-            self.emit('**' + node.kwarg)
+            self.emit('**' + self.name(node, 'kwarg'))
             i += 1
 
     def multiline(self, node):
-        return any(isinstance(node, t) for t in self.multiliners)
+        return type(node) in self.multiliners
 
     def multiline_body(self, body):
         return any(self.multiline(b) for b in body)
@@ -236,19 +336,28 @@ class SerializeVisitor(NodeVisitor):
         for b in body:
             if self.docstrings and self.no_side_effects(b):
                 continue
-            cur_multiline = self.multiline(b)
-            if not self.joinlines or prev_multiline or cur_multiline:
-                self.newline()
-            else:
-                self.emit(';', statements)
-            self.visit(b)
-            prev_multiline = cur_multiline
+            prev_multiline = self.visit_statement(b, prev_multiline, statements)
             statements += 1
         if statements == 0:
             self.emit('0')
         if M:
             self.depth -= 1
 
+    def visit_statement(self, node, prev_multiline, statements):
+        """Emit a statement, preceded by a newline or semicolon if
+        needed, given whether the previous statement in the suite was
+        multiline and the number of statements emitted so far in the
+        suite. Return whether the statement was multiline.
+
+        """
+        cur_multiline = self.multiline(node)
+        if not self.joinlines or prev_multiline or cur_multiline:
+            self.newline()
+        else:
+            self.emit(';', statements)
+        self.visit(node)
+        return cur_multiline
+
     def visit_decorators(self, decorators):
         for d in decorators:
             self.newline()
@@ -259,16 +368,18 @@ class SerializeVisitor(NodeVisitor):
     def visit_generators(self, generators):
         for g in generators:
             self.emit('for')
-            with SavePrecedence(self):
-                self.prec = Prec.Paren
-                self.visit(g.target)
+            saved = self.push()
+            self.prec = Prec.Paren
+            self.visit(g.target)
+            self.pop(saved)
             self.emit('in')
-            with SavePrecedence(self):
-                self.prec = Prec.Lambda
-                self.visit(g.iter)
-                for i in g.ifs:
-                    self.emit('if')
-                    self.visit(i)
+            saved = self.push()
+            self.prec = Prec.Lambda
+            self.visit(g.iter)
+            for i in g.ifs:
+                self.emit('if')
+                self.visit(i)
+            self.pop(saved)
 
     def visit_orelse(self, node):
         if node.orelse:
@@ -278,12 +389,13 @@ class SerializeVisitor(NodeVisitor):
 
     def visit_Assert(self, node):
         self.emit('assert')
-        with SavePrecedence(self, Prec.Tuple):
-            self.prec = Prec.Tuple
-            self.visit(node.test)
-            if node.msg:
-                self.comma()
-                self.visit(node.msg)
+        saved = self.push(Prec.Tuple)
+        self.prec = Prec.Tuple
+        self.visit(node.test)
+        if node.msg:
+            self.comma()
+            self.visit(node.msg)
+        self.pop(saved)
 
     def visit_Assign(self, node):
         for t in node.targets:
@@ -292,13 +404,14 @@ class SerializeVisitor(NodeVisitor):
         self.visit(node.value)
 
     def visit_Attribute(self, node):
-        with SavePrecedence(self, Prec.Attribute, Assoc.Left):
-            self.prec = Prec.Attribute
-            self.assoc = Assoc.Left
-            self.operator = '.'
-            self.visit(node.value)
-            self.emit('.')
-            self.emit(node.attr)
+        saved = self.push(Prec.Attribute, Assoc.Left)
+        self.prec = Prec.Attribute
+        self.assoc = Assoc.Left
+        self.operator = '.'
+        self.visit(node.value)
+        self.emit('.')
+        self.emit(node.attr)
+        self.pop(saved)
 
     def visit_AugAssign(self, node):
         self.visit(node.target)
@@ -308,141 +421,153 @@ class SerializeVisitor(NodeVisitor):
 
     def visit_BinOp(self, node):
         name, prec, assoc = self.ops[type(node.op)]
-        with SavePrecedence(self, prec, assoc):
-            self.prec = prec
-            self.assoc = Assoc.Left
-            self.operator = name
-            self.visit(node.left)
-            self.emit(name)
-            self.assoc = Assoc.Right
-            self.visit(node.right)
+        saved = self.push(prec, assoc)
+        self.prec = prec
+        self.assoc = Assoc.Left
+        self.operator = name
+        self.visit(node.left)
+        self.emit(name)
+        self.assoc = Assoc.Right
+        self.visit(node.right)
+        self.pop(saved)
 
     def visit_BoolOp(self, node):
         name, prec, assoc = self.ops[type(node.op)]
-        with SavePrecedence(self, prec, assoc):
-            self.prec = prec
-            self.assoc = Assoc.Left
-            self.operator = name
-            for i, v in enumerate(node.values):
-                self.emit(name, i)
-                self.visit(v)
-                self.assoc = Assoc.Right
+        saved = self.push(prec, assoc)
+        self.prec = prec
+        self.assoc = Assoc.Left
+        self.operator = name
+        for i, v in enumerate(node.values):
+            self.emit(name, i)
+            self.visit(v)
+            self.assoc = Assoc.Right
+        self.pop(saved)
 
     def visit_Break(self, node):
         self.emit('break')
 
     def visit_Call(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Attribute
-            self.assoc = Assoc.Left
-            self.visit(node.func)
-            if (not node.kwargs and not node.starargs
-                and not node.keywords
-                and len(node.args) == 1
-                and isinstance(node.args[0], GeneratorExp)):
-                self.prec = Prec.Generator
-            else:
-                self.prec = Prec.Tuple
-            self.emit('(')
-            i = 0
-            for a in node.args:
-                self.comma(i)
-                self.visit(a)
-                i += 1
-            for k in node.keywords:
-                self.comma(i)
-                self.emit(k.arg)
-                self.emit('=')
-                self.visit(k.value)
-                i += 1
-            if node.starargs:
-                self.comma(i)
-                self.emit('*')
-                self.visit(node.starargs)
-                i += 1
-            if node.kwargs:
-                self.comma(i)
-                self.emit('**')
-                self.visit(node.kwargs)
-            self.emit(')')
+        saved = self.push()
+        self.prec = Prec.Attribute
+        self.assoc = Assoc.Left
+        self.visit(node.func)
+        if (not node.kwargs and not node.starargs
+            and not node.keywords
+            and len(node.args) == 1
+            and isinstance(node.args[0], GeneratorExp)):
+            self.prec = Prec.Generator
+        else:
+            self.prec = Prec.Tuple
+        self.emit('(')
+        i = 0
+        for a in node.args:
+            self.comma(i)
+            self.visit(a)
+            i += 1
+        for k in node.keywords:
+            self.comma(i)
+            self.emit(self.name(k, 'arg'))
+            self.emit('=')
+            self.visit(k.value)
+            i += 1
+        if node.starargs:
+            self.comma(i)
+            self.emit('*')
+            self.visit(node.starargs)
+            i += 1
+        if node.kwargs:
+            self.comma(i)
+            self.emit('**')
+            self.visit(node.kwargs)
+        self.emit(')')
+        self.pop(saved)
 
     def visit_ClassDef(self, node):
         self.visit_decorators(node.decorator_list)
         self.emit('class')
-        self.emit(node.name)
+        self.emit(self.name(node, 'name'))
         if node.bases:
-            with SavePrecedence(self):
-                self.prec = Prec.Tuple
-                self.emit('(')
-                for i, b in enumerate(node.bases):
-                    self.comma(i)
-                    self.visit(b)
-                self.emit(')')
+            saved = self.push()
+            self.prec = Prec.Tuple
+            self.emit('(')
+            for i, b in enumerate(node.bases):
+                self.comma(i)
+                self.visit(b)
+            self.emit(')')
+            self.pop(saved)
         self.visit_body(node.body)
 
     def visit_Compare(self, node):
         name, prec, assoc = self.ops[type(node.ops[0])]
-        with SavePrecedence(self, prec, assoc):
-            self.prec = prec
-            self.assoc = Assoc.Left
-            self.visit(node.left)
-            for op, val in zip(node.ops, node.comparators):
-                self.emit(self.ops[type(op)][0])
-                self.assoc = Assoc.Right
-                self.visit(val)
+        saved = self.push(prec, assoc)
+        self.prec = prec
+        self.assoc = Assoc.Left
+        self.visit(node.left)
+        for op, val in zip(node.ops, node.comparators):
+            self.emit(self.ops[type(op)][0])
+            self.assoc = Assoc.Right
+            self.visit(val)
+        self.pop(saved)
 
     def visit_Continue(self, node):
         self.emit('continue')
 
     def visit_Delete(self, node):
         self.emit('del')
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            for i, t in enumerate(node.targets):
-                self.comma(i)
-                self.visit(t)
+        saved = self.push()
+        self.prec = Prec.Tuple
+        for i, t in enumerate(node.targets):
+            self.comma(i)
+            self.visit(t)
+        self.pop(saved)
 
     def visit_Dict(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('{')
-            for i, (k, v) in enumerate(zip(node.keys, node.values)):
-                self.comma(i)
-                self.visit(k)
-                self.emit(':')
-                self.visit(v)
-            self.emit('}')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('{')
+        for i, (k, v) in enumerate(zip(node.keys, node.values)):
+            self.comma(i)
+            self.visit(k)
+            self.emit(':')
+            self.visit(v)
+        self.emit('}')
+        self.pop(saved)
 
     def visit_DictComp(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('{')
-            self.visit(node.key)
-            self.emit(':')
-            self.visit(node.value)
-            self.visit_generators(node.generators)
-            self.emit('}')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('{')
+        self.visit(node.key)
+        self.emit(':')
+        self.visit(node.value)
+        self.visit_generators(node.generators)
+        self.emit('}')
+        self.pop(saved)
 
     def visit_Ellipsis(self, node):
         self.emit('...')
 
     def visit_Exec(self, node):
         self.emit('exec')
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.visit(node.body)
-            if node.globals:
-                self.emit('in')
-                self.visit(node.globals)
-                if node.locals:
-                    self.comma()
-                    self.visit(node.locals)
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.visit(node.body)
+        if node.globals:
+            self.emit('in')
+            self.visit(node.globals)
+            if node.locals:
+                self.comma()
+                self.visit(node.locals)
+        self.pop(saved)
 
     def visit_ExtSlice(self, node):
         for i, d in enumerate(node.dims):
             self.visit(d)
             self.comma(i == 0 or i + 1 < len(node.dims))
 
+    def visit_Expr(self, node):
+        self.visit(node.value)
+
     def visit_For(self, node):
         self.emit('for')
         self.visit(node.target)
@@ -454,23 +579,25 @@ class SerializeVisitor(NodeVisitor):
     def visit_FunctionDef(self, node):
         self.visit_decorators(node.decorator_list)
         self.emit('def')
-        self.emit(node.name)
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('(')
-            self.visit(node.args)
-            self.emit(')')
+        self.emit(self.name(node, 'name'))
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('(')
+        self.visit(node.args)
+        self.emit(')')
+        self.pop(saved)
         self.visit_body(node.body)
 
     def visit_GeneratorExp(self, node):
-        with SavePrecedence(self, Prec.Paren):
-            self.prec = Prec.Tuple
-            self.visit(node.elt)
-            self.visit_generators(node.generators)
+        saved = self.push(Prec.Paren)
+        self.prec = Prec.Tuple
+        self.visit(node.elt)
+        self.visit_generators(node.generators)
+        self.pop(saved)
 
     def visit_Global(self, node):
         self.emit('global')
-        for i, n in enumerate(node.names):
+        for i, n in enumerate(self.name(node, 'names')):
             self.comma(i)
             self.emit(n)
 
@@ -487,16 +614,17 @@ class SerializeVisitor(NodeVisitor):
         self.visit_orelse(node)
 
     def visit_IfExp(self, node):
-        with SavePrecedence(self, Prec.Lambda, Assoc.Right):
-            self.prec = Prec.Or
-            self.visit(node.body)
-            self.emit('if')
-            self.visit(node.test)
-            if node.orelse:
-                self.emit('else')
-                self.prec = Prec.Lambda
-                self.assoc = Assoc.Right
-                self.visit(node.orelse)
+        saved = self.push(Prec.Lambda, Assoc.Right)
+        self.prec = Prec.Or
+        self.visit(node.body)
+        self.emit('if')
+        self.visit(node.test)
+        if node.orelse:
+            self.emit('else')
+            self.prec = Prec.Lambda
+            self.assoc = Assoc.Right
+            self.visit(node.orelse)
+        self.pop(saved)
 
     def visit_Import(self, node):
         self.emit('import')
@@ -517,38 +645,47 @@ class SerializeVisitor(NodeVisitor):
             if node.module == '__future__' and n.name == 'unicode_literals':
                 self.unicode_literals = True
 
+    def visit_Index(self, node):
+        self.visit(node.value)
+
     def visit_Lambda(self, node):
-        with SavePrecedence(self, Prec.Lambda, Assoc.Right):
-            self.prec = Prec.Lambda
-            self.assoc = Assoc.Right
-            self.emit('lambda')
-            self.visit_arguments(node.args)
-            self.emit(':')
-            self.visit(node.body)
+        saved = self.push(Prec.Lambda, Assoc.Right)
+        self.prec = Prec.Lambda
+        self.assoc = Assoc.Right
+        self.emit('lambda')
+        self.visit_arguments(node.args)
+        self.emit(':')
+        self.visit(node.body)
+        self.pop(saved)
 
     def visit_List(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('[')
-            for i, e in enumerate(node.elts):
-                self.comma(i)
-                self.visit(e)
-            self.emit(']')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('[')
+        for i, e in enumerate(node.elts):
+            self.comma(i)
+            self.visit(e)
+        self.emit(']')
+        self.pop(saved)
 
     def visit_ListComp(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('[')
-            self.visit(node.elt)
-            self.visit_generators(node.generators)
-            self.emit(']')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('[')
+        self.visit(node.elt)
+        self.visit_generators(node.generators)
+        self.emit(']')
+        self.pop(saved)
 
     def visit_Module(self, node):
         if node.body:
             self.visit_body(node.body, colon=False)
 
     def visit_Name(self, node):
-        self.emit(node.id)
+        if self.renaming is None:
+            self.emit(node.id)
+        else:
+            self.emit(self.renaming.rename(node, 'id', node.id))
 
     def visit_Num(self, node):
         s = repr(node.n)
@@ -559,11 +696,12 @@ class SerializeVisitor(NodeVisitor):
         if s[0] == '-':
             sign = '-'
             prec = 16
-        with SavePrecedence(self, prec, Assoc.Right):
-            if isinstance(node.n, float) and isinf(node.n):
-                self.emit(sign + '1e400')
-            else:
-                self.emit(s)
+        saved = self.push(prec, Assoc.Right)
+        if isinstance(node.n, float) and isinf(node.n):
+            self.emit(sign + '1e400')
+        else:
+            self.emit(s)
+        self.pop(saved)
         self.lastnum = True
 
     def visit_Pass(self, node):
@@ -571,31 +709,33 @@ class SerializeVisitor(NodeVisitor):
 
     def visit_Print(self, node):
         self.emit('print')
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            i = 0
-            if node.dest:
-                self.emit('>>')
-                self.visit(node.dest)
-                i = 1
-            for v in node.values:
-                self.comma(i)
-                self.visit(v)
-                i += 1
-            self.emit(',', not node.nl)
+        saved = self.push()
+        self.prec = Prec.Tuple
+        i = 0
+        if node.dest:
+            self.emit('>>')
+            self.visit(node.dest)
+            i = 1
+        for v in node.values:
+            self.comma(i)
+            self.visit(v)
+            i += 1
+        self.emit(',', not node.nl)
+        self.pop(saved)
 
     def visit_Raise(self, node):
         self.emit('raise')
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            if node.type:
-                self.visit(node.type)
-            if node.inst:
-                self.comma()
-                self.visit(node.inst)
-            if node.tback:
-                self.comma()
-                self.visit(node.tback)
+        saved = self.push()
+        self.prec = Prec.Tuple
+        if node.type:
+            self.visit(node.type)
+        if node.inst:
+            self.comma()
+            self.visit(node.inst)
+        if node.tback:
+            self.comma()
+            self.visit(node.tback)
+        self.pop(saved)
 
     def visit_Repr(self, node):
         self.emit('`')
@@ -608,21 +748,23 @@ class SerializeVisitor(NodeVisitor):
             self.visit(node.value)
 
     def visit_Set(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('{')
-            for i, e in enumerate(node.elts):
-                self.comma(i)
-                self.visit(e)
-            self.emit('}')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('{')
+        for i, e in enumerate(node.elts):
+            self.comma(i)
+            self.visit(e)
+        self.emit('}')
+        self.pop(saved)
 
     def visit_SetComp(self, node):
-        with SavePrecedence(self):
-            self.prec = Prec.Tuple
-            self.emit('{')
-            self.visit(node.elt)
-            self.visit_generators(node.generators)
-            self.emit('}')
+        saved = self.push()
+        self.prec = Prec.Tuple
+        self.emit('{')
+        self.visit(node.elt)
+        self.visit_generators(node.generators)
+        self.emit('}')
+        self.pop(saved)
 
     def visit_Slice(self, node):
         if node.lower:
@@ -657,37 +799,70 @@ class SerializeVisitor(NodeVisitor):
                     s = s[:-1] + '\\' + s[-1]
                 s = s.replace(quotes, '\\' + quotes)
 
-        def escape(m):
-            c = ord(m.group(0))
-            if c < 8 and (m.group(1) == '' or not m.group(1).isdigit()):
-                if c == 0:
-                    return r'\0'
-                else:
-                    return r'\0{0:o}'.format(c)
-            return r'\x{0:02x}'.format(c)
         if isinstance(s, unicode):
-            s = re.sub('[\x00-\x1f](?=(.?))', escape, s)
+            s = self._unicode_escape_re.sub(self._escape, s)
             return s.encode(self.encoding, error)
         else:
-            return re.sub('[\x00-\x1f\x7f-\xff](?=(.?))', escape, s)
+            return self._str_escape_re.sub(self._escape, s)
+
+    _unicode_escape_re = re.compile('[\x00-\x1f](?=(.?))')
+    _str_escape_re = re.compile('[\x00-\x1f\x7f-\xff](?=(.?))')
+
+    @staticmethod
+    def _escape(m):
+        c = ord(m.group(0))
+        if c < 8 and (m.group(1) == '' or not m.group(1).isdigit()):
+            if c == 0:
+                return r'\0'
+            else:
+                return r'\0{0:o}'.format(c)
+        return r'\x{0:02x}'.format(c)
+
+    _needs_quoting_re = re.compile(r"[^\x20-\x26\x28-\x5b\x5d-\x7e]")
+
+    _control_re = re.compile('[\x00-\x1f]')
+    _str_control_re = re.compile('[\x00-\x1f\x7f-\xff]')
+
+    # Memo of shortest_string_repr, shared by all instances so that it
+    # persists across files. Long strings are rarely repeated, so only
+    # short ones are kept, and the memo is emptied when it fills up.
+    _reprs = {}
+    _reprs_max = 1 << 12
+    _reprs_max_len = 1 << 8
 
     def shortest_string_repr(self, s):
         """Return the shortest representation of the string s suitable for a
-        Python source file in self.encoding. Generates up to eight
-        ways of representing the string and picks the shortest.
+        Python source file in self.encoding. There are up to eight
+        ways of representing the string: their lengths are worked out
+        from a single encoding of the string, and then only the
+        shortest is generated.
 
         """
         if self.unicode_literals:
             prefix = 'b' * isinstance(s, str)
         else:
             prefix = 'u' * isinstance(s, unicode)
-        cand = []               # List of candidate representation.
+        if not self._needs_quoting_re.search(s):
+            # Printable ASCII without backslashes or single quotes: the
+            # shortest representation is always plain single quotes.
+            if isinstance(s, unicode):
+                s = s.encode(self.encoding)
+            return "{0}'{1}'".format(prefix, s)
+        memo = len(s) <= self._reprs_max_len
+        if memo:
+            key = type(s), s, prefix, self.encoding
+            result = self._reprs.get(key)
+            if result is not None:
+                return result
+        best = None             # Triple (length, quotes, raw?) of best so far.
 
         # The constraints on r-prefixed strings are really quite tight:
         #
         # 1. Backslash-replacement must add no more backslashes when we
         #    come to encode the output. (Otherwise we'll get something
-        #    like r'\xa0' which will be wrongly interpreted.)
+        #    like r'\xa0' which will be wrongly interpreted.) So the
+        #    string must contain no control characters (nor, if it's a
+        #    byte string, any non-ASCII characters).
         # 2. The string contains none of the six escape sequences in
         #    _escape_set.
         # 3. The string does not end with a backslash.
@@ -697,34 +872,66 @@ class SerializeVisitor(NodeVisitor):
         # quotes can be used if that set appears in the string, and
         # newlines may not appear in single- or double-quoted strings.
 
-        s1 = self.encode_string(s, escapes=False, error='ignore')
-        s2 = self.encode_string(s, escapes=False)
-        if (s.count('\\') == s1.count('\\')
-            and (prefix != 'u' or '\\u' not in s2 and '\\U' not in s2)
-            and not set(s) & self._escape_set
-            and s and s[-1] != '\\'):
+        control_re = (self._control_re if isinstance(s, unicode)
+                      else self._str_control_re)
+        raw = None
+        if (s[-1] != '\\' and not set(s) & self._escape_set
+            and not control_re.search(s)):
+            raw = self.encode_string(s, escapes=False)
+            if (s.count('\\') != self.encode_string(
+                    s, escapes=False, error='ignore').count('\\')
+                or prefix == 'u' and ('\\u' in raw or '\\U' in raw)):
+                raw = None
+        if raw is not None:
             for q in ("'''", '"""') + ("'", '"') * ('\n' not in s):
-                if q not in s and not (s and q[0] == s[-1]):
-                    cand.append("{0}r{1}{2}{1}".format(prefix, q, s2))
-
-        # Ordinary strings are easy.
+                if q not in s and q[0] != s[-1]:
+                    n = len(raw) + 2 * len(q) + 1
+                    if best is None or n < best[0]:
+                        best = n, q, True
+
+        # Ordinary strings are easy. Encoding with no quotes turns each
+        # newline into a four-character hex escape (as it is in triple
+        # quotes) and then each set of quotes adds a backslash before
+        # each occurrence of the quotes in the string (and before a
+        # final quote character, in triple quotes), and single quotes
+        # turn newlines into two-character escapes.
+        body = len(self.encode_string(s))
+        newlines = s.count('\n')
         for q in ("'''", '"""', "'", '"'):
-            s_encoded = self.encode_string(s, True, q)
-            cand.append("{0}{1}{2}{1}".format(prefix, q, s_encoded))
-        return min(cand, key=len)
+            if len(q) == 1:
+                n = body - 2 * newlines + s.count(q)
+            elif s[-1] == q[0]:
+                n = body + 1 + s[:-1].count(q)
+            else:
+                n = body + s.count(q)
+            n += 2 * len(q)
+            if best is None or n < best[0]:
+                best = n, q, False
+        _, q, is_raw = best
+        if is_raw:
+            result = "{0}r{1}{2}{1}".format(prefix, q, raw)
+        else:
+            result = "{0}{1}{2}{1}".format(prefix, q,
+                                           self.encode_string(s, True, q))
+        if memo:
+            if len(self._reprs) >= self._reprs_max:
+                self._reprs.clear()
+            self._reprs[key] = result
+        return result
 
     def visit_Str(self, node):
         self.emit(self.shortest_string_repr(node.s))
 
     def visit_Subscript(self, node):
-        with SavePrecedence(self, Prec.Attribute, Assoc.Left):
-            self.prec = Prec.Attribute
-            self.assoc = Assoc.Left
-            self.visit(node.value)
-            self.emit('[')
-            self.prec = Prec.Tuple
-            self.visit(node.slice)
-            self.emit(']')
+        saved = self.push(Prec.Attribute, Assoc.Left)
+        self.prec = Prec.Attribute
+        self.assoc = Assoc.Left
+        self.visit(node.value)
+        self.emit('[')
+        self.prec = Prec.Tuple
+        self.visit(node.slice)
+        self.emit(']')
+        self.pop(saved)
 
     def visit_TryExcept(self, node):
         self.emit('try')
@@ -732,13 +939,14 @@ class SerializeVisitor(NodeVisitor):
         for h in node.handlers:
             self.newline()
             self.emit('except')
-            with SavePrecedence(self):
-                self.prec = Prec.Tuple
-                if h.type:
-                    self.visit(h.type)
-                if h.name:
-                    self.comma()
-                    self.visit(h.name)
+            saved = self.push()
+            self.prec = Prec.Tuple
+            if h.type:
+                self.visit(h.type)
+            if h.name:
+                self.comma()
+                self.visit(h.name)
+            self.pop(saved)
             self.visit_body(h.body)
         self.visit_orelse(node)
 
@@ -754,22 +962,24 @@ class SerializeVisitor(NodeVisitor):
             self.visit_body(node.finalbody)
 
     def visit_Tuple(self, node):
-        with SavePrecedence(self, Prec.Tuple, force=not node.elts):
-            self.prec = Prec.Tuple
-            for i, e in enumerate(node.elts):
-                self.comma(i)
-                self.visit(e)
-            if len(node.elts) == 1:
-                self.comma()
+        saved = self.push(Prec.Tuple, force=not node.elts)
+        self.prec = Prec.Tuple
+        for i, e in enumerate(node.elts):
+            self.comma(i)
+            self.visit(e)
+        if len(node.elts) == 1:
+            self.comma()
+        self.pop(saved)
 
     def visit_UnaryOp(self, node):
         name, prec, assoc = self.ops[type(node.op)]
-        with SavePrecedence(self, prec, assoc):
-            self.prec = prec
-            self.assoc = assoc
-            self.operator = name
-            self.emit(name)
-            self.visit(node.operand)
+        saved = self.push(prec, assoc)
+        self.prec = prec
+        self.assoc = assoc
+        self.operator = name
+        self.emit(name)
+        self.visit(node.operand)
+        self.pop(saved)
 
     def visit_While(self, node):
         self.emit('while')
@@ -783,9 +993,10 @@ class SerializeVisitor(NodeVisitor):
             self.visit(node.context_expr)
             if node.optional_vars:
                 self.emit('as')
-                with SavePrecedence(self, Prec.Tuple):
-                    self.prec = Prec.Tuple
-                    self.visit(node.optional_vars)
+                saved = self.push(Prec.Tuple)
+                self.prec = Prec.Tuple
+                self.visit(node.optional_vars)
+                self.pop(saved)
             if len(node.body) == 1 and isinstance(node.body[0], With):
                 self.comma()
                 node = node.body[0]
@@ -794,10 +1005,53 @@ class SerializeVisitor(NodeVisitor):
         self.visit_body(node.body)
 
     def visit_Yield(self, node):
-        with SavePrecedence(self, Prec.Tuple):
-            self.emit('yield')
-            if node.value:
-                self.visit(node.value)
+        saved = self.push(Prec.Tuple)
+        self.emit('yield')
+        if node.value:
+            self.visit(node.value)
+        self.pop(saved)
+
+def compare_ast(a, b, renaming=None):
+    """Compare two abstract syntax trees, field by field, stopping at the
+    first difference it finds. Return
+    None if they are the same (that is, if dump would give the same
+    result for both). Otherwise return a tuple (x, y, s), where x and y
+    are the smallest subtrees of a and b that differ, and s is the
+    statement in a that contains x. If renaming is a Renaming, compare
+    b with a as renamed by it.
+
+    """
+    stack = [(a, b, a)]
+    while stack:
+        x, y, s = stack.pop()
+        if type(x) is not type(y):
+            return x, y, s
+        if isinstance(x, stmt):
+            s = x
+        pairs = []
+        renamed = renaming is not None and renaming.fields.get(type(x), ())
+        for f in x._fields:
+            if renamed and f in renamed:
+                u = renaming.field(x, f)
+            else:
+                u = getattr(x, f, None)
+            v = getattr(y, f, None)
+            if isinstance(u, list) and isinstance(v, list):
+                if len(u) != len(v):
+                    return x, y, s
+                pairs.extend(zip(u, v))
+            else:
+                pairs.append((u, v))
+        for u, v in pairs:
+            if isinstance(u, AST):
+                continue
+            if (type(u) is not type(v)
+                or isinstance(u, (float, complex)) and repr(u) != repr(v)
+                or u != v and repr(u) != repr(v)):
+                return x, y, s
+        stack.extend((u, v, s) for u, v in reversed(pairs)
+                     if isinstance(u, AST))
+    return None
 
 def serialize_ast(tree, **kwargs):
     """Serialize an abstract syntax tree according to the options and
@@ -808,108 +1062,426 @@ def serialize_ast(tree, **kwargs):
     encoding   -- Encoding for the result (default: 'latin1')
     indent     -- Number of spaces for each indentation level (default: 1)
     joinlines  -- Join lines if possible (default: True)
+    renaming   -- Renaming to apply to the names (see find_renaming), or
+                  None (default: None)
     selftest   -- Reparse the result and check that it's identical to the
                   tree (default: True)
+    tabs       -- Indent with a tab for each 8 columns, and spaces for
+                  the rest, which Python 2 accepts unless run with -tt
+                  (default: False)
 
     """
     return SerializeVisitor(**kwargs).serialize(tree)
 
-class FindReserved(NodeVisitor):
-    def reserve(self, tree):
-        import __builtin__
-        self.reserved = set(dir(__builtin__))
+def locate_module(name):
+    """Find the module with the given (possibly dotted) name on sys.path,
+    without importing it, and return a pair (path, kind), where kind is
+    one of the module types from the imp module. For a package, path
+    is its __init__ file. Raise ImportError if it can't be found.
+
+    """
+    path = None
+    for part in name.split('.'):
+        if path is not None and kind != PKG_DIRECTORY:
+            raise ImportError("{0} is not a package".format(path))
+        f, path, (_, _, kind) = find_module(part, path and [path])
+        if f:
+            f.close()
+    if kind == PKG_DIRECTORY:
+        f, init, (_, _, init_kind) = find_module('__init__', [path])
+        if f:
+            f.close()
+        return init, init_kind
+    return path, kind
+
+class FindExports(NodeVisitor):
+    """Find the names bound at the top level of a module, that is, the
+    names that dir() would report after importing it. Names imported
+    by "from module import *" are looked up in an ExportIndex.
+
+    """
+    def __init__(self, index, package, seen):
+        self.index = index
+        self.package = package
+        self.seen = seen
+
+    def find(self, tree):
+        """Return a pair: the set of names bound at the top level, and the
+        list assigned to __all__, or None if there isn't a literal one.
+
+        """
+        self.names = set('__builtins__ __doc__ __file__ __name__ __package__'
+                         .split())
+        self.all = None
+        for node in walk(tree):
+            if isinstance(node, Global):
+                self.names.update(node.names)
         self.visit(tree)
+        return self.names, self.all
+
+    def visit_Assign(self, node):
+        if (len(node.targets) == 1 and isinstance(node.targets[0], Name)
+            and node.targets[0].id == '__all__'
+            and isinstance(node.value, (List, Tuple))
+            and all(isinstance(e, Str) for e in node.value.elts)):
+            self.all = [e.s for e in node.value.elts]
+        self.generic_visit(node)
+
+    def visit_ClassDef(self, node):
+        self.names.add(node.name)
+        for d in node.decorator_list + node.bases:
+            self.visit(d)
+
+    def visit_FunctionDef(self, node):
+        self.names.add(node.name)
+        for d in node.decorator_list + node.args.defaults:
+            self.visit(d)
+
+    def visit_Lambda(self, node):
+        pass
+
+    visit_DictComp = visit_GeneratorExp = visit_SetComp = visit_Lambda
+
+    def visit_Import(self, node):
+        for a in node.names:
+            self.names.add(a.asname or a.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        if node.level == 1 and node.module and self.package:
+            # Importing a submodule binds it in its package.
+            self.names.add(node.module.split('.')[0])
+        for a in node.names:
+            if a.name != '*':
+                self.names.add(a.asname or a.name)
+                continue
+            module = node.module
+            if node.level:
+                base = self.package.rsplit('.', node.level - 1)[0]
+                module = '.'.join(filter(None, (base, module)))
+            self.names.update(self.index.public(module, self.seen))
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, Store):
+            self.names.add(node.id)
+
+class ExportIndex(object):
+    """Index of the names exported by modules, found without importing
+    them into this process. The exports of a module with Python source
+    are found by analysing the source (see FindExports). Other modules
+    (compiled or built in) are imported in a separate Python process
+    and scanned with dir(). The results are kept in memory and, if
+    filename is given, saved to that file, keyed by the path and
+    modification time of each module, so that each module is only
+    analysed once.
+
+    """
+    def __init__(self, filename=None):
+        import os
+        self.filename = filename
+        self.entries = dict()   # Map from path to [mtime, names].
+        self.dirty = False
+        if filename and os.path.exists(filename):
+            self.entries.update(self.load())
+
+    def __reduce__(self):
+        # Unpickle to the process's shared instance, as for MinifyCache.
+        return open_index, (self.filename,)
+
+    def load(self):
+        import json
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def save(self):
+        """Save the index to its file, merging in any entries saved by
+        other processes since it was loaded.
+
+        """
+        import json
+        import os
+        from tempfile import mkstemp
+        if not self.filename or not self.dirty:
+            return
+        entries = self.load() if os.path.exists(self.filename) else {}
+        entries.update(self.entries)
+        fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)),
+                          prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.filename)
+        self.dirty = False
+
+    def exports(self, name, seen=frozenset()):
+        """Return the set of names exported by the named module, or the
+        empty set if it can't be found.
+
+        """
+        return frozenset(self.entry(name, seen)[1])
+
+    def public(self, name, seen=frozenset()):
+        """Return the set of names imported from the named module by
+        "from module import *".
+
+        """
+        _, names, all = self.entry(name, seen)
+        if all is None:
+            return frozenset(n for n in names if not n.startswith('_'))
+        return frozenset(all)
+
+    def entry(self, name, seen):
+        """Return the index entry [mtime, names, all] for the named
+        module, analysing or scanning the module if necessary.
+
+        """
+        import os
+        if name is None or name in seen:
+            return [None, [], []]
+        try:
+            path, kind = locate_module(name)
+            key = path
+        except ImportError:
+            # A module like os.path only exists once its parent has been
+            # imported, so scan it, keyed by the parent's file.
+            try:
+                path, kind = locate_module(name.split('.')[0])
+            except ImportError:
+                return [None, [], []]
+            if kind != C_BUILTIN:   # A built-in parent has no file.
+                kind = None
+            key = '{0}:{1}'.format(path, name)
+        mtime = None if kind == C_BUILTIN else os.path.getmtime(path)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != mtime:
+            result = None
+            if kind == PY_SOURCE:
+                result = self.analyse(name, path, seen | set([name]))
+            if result is None:
+                result = self.scan(name)
+            names, all = result
+            entry = self.entries[key] = [mtime, sorted(names), all]
+            self.dirty = True
+        return entry
+
+    def analyse(self, name, path, seen):
+        """Return the names bound at the top level of the module with
+        source in path, and its __all__ (see FindExports.find), or None
+        if it can't be parsed.
+
+        """
+        import os
+        try:
+            tree = parse(open(path).read(), path)
+        except (SyntaxError, TypeError, ValueError):
+            return None
+        init = os.path.splitext(os.path.basename(path))[0] == '__init__'
+        package = name if init else name.rpartition('.')[0]
+        names, all = FindExports(self, package, seen).find(tree)
+        if init:
+            names.add('__path__')
+        return names, all
+
+    def scan(self, name):
+        """Import the named module in a separate Python process and
+        return the names reported by dir(), and its __all__ (or None).
+
+        """
+        import json
+        import os
+        import signal
+        from subprocess import Popen, PIPE
+        from sys import executable
+        script = ("import json, sys; __import__(sys.argv[1]); "
+                  "m = sys.modules[sys.argv[1]]; "
+                  "json.dump([dir(m), getattr(m, '__all__', None)], sys.stdout)")
+        # Pause the timer for minify_job's timeout, if any, while the
+        # process starts, so that a timeout can't leave it running.
+        timer = hasattr(signal, 'setitimer')
+        delay, interval = (signal.setitimer(signal.ITIMER_REAL, 0) if timer
+                           else (0, 0))
+        try:
+            with open(os.devnull, 'w') as devnull:
+                p = Popen([executable, '-c', script, name],
+                          stdout=PIPE, stderr=devnull)
+        finally:
+            if delay:
+                signal.setitimer(signal.ITIMER_REAL, delay, interval)
+        try:
+            output, _ = p.communicate()
+        except BaseException:
+            # Interrupted, say by MinifyTimeout: stop the process.
+            p.kill()
+            p.wait()
+            raise
+        try:
+            names, all = json.loads(output)
+            return set(names), all and list(all)
+        except (TypeError, ValueError):
+            return set(), None
+
+_indexes = dict()
+def open_index(filename=None):
+    """Return the ExportIndex for the file, creating it the first time
+    it is opened in this process. With no filename, return an index
+    kept only in memory.
+
+    """
+    if filename not in _indexes:
+        _indexes[filename] = ExportIndex(filename)
+    return _indexes[filename]
+
+class FindReserved(object):
+    """Find the reserved names in an abstract syntax tree (see
+    reserved_names_in_ast). The method note looks at one node, so that
+    another traversal (see FindNames and FindScopes) can find the
+    reserved names as it goes.
+
+    """
+    builtins = frozenset(dir(__builtin__))
+
+    def __init__(self, index=None, local=frozenset()):
+        self.index = index or open_index()
+        self.local = local      # Imports within a package: see Package.
+        self.reserved = set(self.builtins)
+
+    def reserve(self, tree):
+        for node in walk(tree):
+            self.note(node)
         return self.reserved
 
-    def reserve_import(self, n):
+    def note(self, node):
+        """Add the names reserved by node (but not by its children)."""
+        method = self.methods.get(type(node))
+        if method is not None:
+            method(self, node)
+
+    def reserve_module(self, n):
         self.reserved.add(n)
-        try:
-            self.reserved.update(dir(load_module(n, *find_module(n))))
-        except:
-            pass
+        self.reserved.update(self.index.exports(n))
 
-    def visit_alias(self, node):
-        self.reserved.add(node.name)
-        self.generic_visit(node)
+    def note_alias(self, node):
+        if node not in self.local:
+            self.reserved.add(node.name)
 
-    def visit_Assign(self, node):
+    def note_Assign(self, node):
         if (len(node.targets) == 1 and isinstance(node.targets[0], Name)
             and node.targets[0].id == '__all__'):
             expr = copy_location(Expression(node.value), node)
             self.reserved.update(eval(compile(expr, '<string>', 'eval')))
-        self.generic_visit(node)
 
-    def visit_Attribute(self, node):
+    def note_Attribute(self, node):
         self.reserved.add(node.attr)
-        self.generic_visit(node)
 
-    def visit_Call(self, node):
+    def note_Call(self, node):
         for k in node.keywords:
             self.reserved.add(k.arg)
-        self.generic_visit(node)
 
-    def visit_Import(self, node):
+    def note_Import(self, node):
         for i in node.names:
             self.reserved.add(i.name)
-        self.generic_visit(node)
+            # "import a.b" binds a.
+            self.reserved.add(i.name.split('.')[0])
 
-    def visit_ImportFrom(self, node):
-        self.reserve_import(node.module)
-        self.generic_visit(node)
+    def note_ImportFrom(self, node):
+        if node not in self.local:
+            self.reserve_module(node.module)
+
+    methods = {
+        alias: note_alias, Assign: note_Assign, Attribute: note_Attribute,
+        Call: note_Call, Import: note_Import, ImportFrom: note_ImportFrom,
+        }
 
-def reserved_names_in_ast(tree):
+def reserved_names_in_ast(tree, index=None):
     """Make a best effort to find reserved names (that is, names that
     cannot be changed without changing the meaning of the program) in
-    an abstract syntax tree. Return the set of words found.
+    an abstract syntax tree. Return the set of words found. The names
+    exported by imported modules are looked up in index, an
+    ExportIndex (default: an index kept in memory for the life of the
+    process).
+
+    """
+    return FindReserved(index).reserve(tree)
+
+class Renaming(object):
+    """A renaming of the names in an abstract syntax tree (see
+    find_renaming). SerializeVisitor and compare_ast apply it to the
+    names as they come to them, so the tree itself is unchanged, unless
+    apply is called. The attribute mapping is a dictionary mapping old
+    names to new. If uses is not None, it is a dictionary mapping pairs
+    (node, field) to the new name in that field of that node (for the
+    names field of a Global node, the field is the index in names),
+    and mapping only covers the names at module and class level (see
+    FindScopes). The imports in the set local are within a package
+    (see Package).
 
     """
-    return FindReserved().reserve(tree)
+    # The fields holding names that are renamed, for each type of node.
+    fields = {
+        Name: ('id',), alias: ('name', 'asname'),
+        arguments: ('vararg', 'kwarg'), keyword: ('arg',),
+        ClassDef: ('name',), FunctionDef: ('name',), Global: ('names',),
+        }
 
-class Rename(NodeTransformer):
-    def __init__(self, mapping):
+    def __init__(self, mapping, local=frozenset(), uses=None):
         self.mapping = mapping
+        self.local = local
+        self.uses = uses
 
-    def rename(self, name):
+    def rename(self, node, field, name):
+        if self.uses is not None:
+            return self.uses.get((node, field), name)
         return self.mapping.get(name, name)
 
-    def visit_alias(self, node):
+    def alias(self, node):
+        """Return the pair (name, asname) for the alias node."""
+        if self.uses is not None:
+            if node.asname is not None:
+                return node.name, self.rename(node, 'asname', node.asname)
+            # A bare import gets an alias if it's renamed.
+            return node.name, self.uses.get((node, 'alias'))
+        if node in self.local:
+            # The imported name is renamed in its own module too.
+            return (self.rename(node, 'name', node.name),
+                    self.rename(node, 'asname', node.asname))
         # Add an alias if the imported module has an entry in the
-        # mapping. See rename_ast below for the logic behind the
+        # mapping. See find_renaming below for the logic behind the
         # selection of modules to rename.
         if node.asname is None and node.name in self.mapping:
-            node.asname = self.rename(node.name)
-        else:
-            node.asname = self.rename(node.asname)
-        return self.generic_visit(node)
+            return node.name, self.mapping[node.name]
+        return node.name, self.rename(node, 'asname', node.asname)
 
-    def visit_arguments(self, node):
-        node.vararg = self.rename(node.vararg)
-        node.kwarg = self.rename(node.kwarg)
-        return self.generic_visit(node)
+    def field(self, node, field):
+        """Return the value of the field of node (one of those in
+        fields) after renaming.
 
-    def visit_Call(self, node):
-        for k in node.keywords:
-            k.arg = self.rename(k.arg)
-        return self.generic_visit(node)
+        """
+        value = getattr(node, field)
+        t = type(node)
+        if t is alias:
+            return self.alias(node)[field == 'asname']
+        elif t is Global:
+            return [self.rename(node, i, n) for i, n in enumerate(value)]
+        elif self.uses is not None:
+            return self.uses.get((node, field), value)
+        return self.mapping.get(value, value)
+
+    def apply(self, tree):
+        """Rename the names in tree in place."""
+        for node in walk(tree):
+            fields = self.fields.get(type(node), ())
+            values = [self.field(node, f) for f in fields]
+            for f, v in zip(fields, values):
+                setattr(node, f, v)
 
-    def visit_ClassDef(self, node):
-        node.name = self.rename(node.name)
-        return self.generic_visit(node)
+class FindNames(NodeVisitor):
+    def __init__(self, local=frozenset(), reserve=None):
+        self.local = local      # Imports within a package: see Package.
+        self.reserve = reserve  # FindReserved to note each node, or None.
 
-    def visit_FunctionDef(self, node):
-        node.name = self.rename(node.name)
-        return self.generic_visit(node)
+    def visit(self, node):
+        if self.reserve is not None:
+            self.reserve.note(node)
+        return NodeVisitor.visit(self, node)
 
-    def visit_Global(self, node):
-        for i, n in enumerate(node.names):
-            node.names[i] = self.rename(n)
-        return self.generic_visit(node)
-
-    def visit_Name(self, node):
-        node.id = self.rename(node.id)
-        return self.generic_visit(node)
-
-class FindNames(NodeVisitor):
     def newname(self):
         result = [0, self.count]
         self.count += 1
@@ -935,7 +1507,9 @@ class FindNames(NodeVisitor):
         self.name[name][0] += 1
 
     def visit_alias(self, node):
-        if node.asname is None:
+        if node in self.local:
+            self.learn(node.name)
+        elif node.asname is None:
             self.imports.add(node.name)
         self.learn(node.asname)
         self.generic_visit(node)
@@ -968,46 +1542,2017 @@ class FindNames(NodeVisitor):
         self.generic_visit(node)
 
 letters = ascii_lowercase + ascii_uppercase
-letters_len = len(letters)
-def make_name(n):
-    """Return the nth name."""
+def make_name(n, letters=letters):
+    """Return the nth name made from letters."""
     name = ''
     n += 1
+    letters_len = len(letters)
     while n:
         n -= 1
         name = letters[n % letters_len] + name
         n //= letters_len
     return name
 
-def rename_ast(tree, reserved=set()):
-    """Change all names in an abstract syntax tree, except for a set of
-    reserved names. The new names are as short as possible.
+# The keywords in the code for each type of node, for letter_order.
+_node_keywords = {
+    And: 'and', Assert: 'assert', Break: 'break', ClassDef: 'class',
+    Continue: 'continue', Delete: 'del', ExceptHandler: 'except',
+    Exec: 'exec', For: 'for in', FunctionDef: 'def', Global: 'global',
+    If: 'if', IfExp: 'if else', Import: 'import', ImportFrom: 'from import',
+    In: 'in', Is: 'is', IsNot: 'is not', Lambda: 'lambda', Not: 'not',
+    NotIn: 'not in', Or: 'or', Pass: 'pass', Print: 'print',
+    Raise: 'raise', Return: 'return', TryExcept: 'try',
+    TryFinally: 'try finally', While: 'while', With: 'with as',
+    Yield: 'yield', comprehension: 'for in',
+    }
+
+def letter_order(tree, reserved):
+    """Return the letters for new names, ordered by how often they
+    appear in the code for tree that renaming doesn't change: keywords,
+    reserved names, attributes and strings. Using the common letters
+    for the most frequent names helps compression (see rename_ast).
 
     """
-    from keyword import iskeyword
-    names, imports = FindNames().find(tree)
-
-    # Add aliases for import statements if there are enough uses to
-    # justify the transformation. See Rename.visit_alias for the
-    # insertion of the aliases.
-    for module in imports:
-        if (len(module) - 1) * names[module][0] > 5:
-            reserved.remove(module)
+    from collections import Counter
+    count = Counter()
+    for node in walk(tree):
+        if isinstance(node, Name):
+            if node.id in reserved:
+                count.update(node.id)
+        elif isinstance(node, Attribute):
+            count.update(node.attr)
+        elif isinstance(node, keyword):
+            count.update(node.arg)
+        elif isinstance(node, Str) and isinstance(node.s, str):
+            count.update(node.s)
+        else:
+            count.update(_node_keywords.get(type(node), ''))
+    return ''.join(sorted(letters, key=lambda c: (-count[c], letters.index(c))))
+
+def shortest_names(names, reserved, avoid=frozenset(), letters=letters,
+                   frequency=True):
+    """Return a dictionary mapping names to new names, as short as
+    possible, with the most frequent names getting the shortest (or if
+    frequency is False, the first to appear). The argument names is a
+    dictionary mapping each name to a pair [n, m] as returned by
+    FindNames.find. Reserved names, and names starting and ending with
+    two underscores, are not renamed. New names are made from letters
+    (see make_name), and are not reserved, not keywords, and not in
+    the set avoid; they start with the same number of underscores (up
+    to two) as the old.
 
+    """
+    from keyword import iskeyword
     mapping = dict()
     n = [0] * 3
     sorted_names = sorted(((i, j, k) for k, (i, j) in names.items()),
-                          key = lambda (i, j, k): (-i, j, k))
+                          key = lambda (i, j, k): (-i * frequency, j, k))
     for _, _, name in sorted_names:
         if name is None or name[:2] == name[-2:] == '__' or name in reserved:
             continue
         underscores = name.startswith('_') + name.startswith('__')
         while name not in mapping:
-            newname = '_' * underscores + make_name(n[underscores])
+            newname = '_' * underscores + make_name(n[underscores], letters)
             n[underscores] += 1
-            if newname not in reserved and not iskeyword(newname):
+            if (newname not in reserved and newname not in avoid
+                and not iskeyword(newname)):
                 mapping[name] = newname
-    Rename(mapping).visit(tree)
+    return mapping
+
+def rename_ast(tree, reserved=set(), stats=None, local=frozenset(),
+               scoped=False, target='raw'):
+    """Change all names in an abstract syntax tree, except for a set of
+    reserved names. The new names are as short as possible. Return a
+    dictionary mapping the old names to the new. If stats is a
+    dictionary, record in it the number of reserved names, and the
+    number of names renamed and kept. The imports in the set local are
+    within a package (see Package).
+
+    If scoped is True, the variables local to each function are
+    renamed separately (see FindScopes), so that they can reuse the
+    shortest names, and the returned mapping is for the names at
+    module and class level only. This is not compatible with local.
+
+    The target is 'raw' to make the code as small as possible, or
+    'gzip' to make the compressed code small: then the new names use
+    the letters that are common in the rest of the code first (see
+    letter_order), and if scoped, each function's variables are named
+    in order of appearance, so that similar functions get the same
+    names. The uncompressed code is the same size either way.
+
+    To leave the tree unchanged, and rename the names as it is
+    serialized, use find_renaming instead.
+
+    """
+    renaming = find_renaming(tree, reserved, stats, local, scoped, target)
+    renaming.apply(tree)
+    return renaming.mapping
+
+def find_renaming(tree, reserved=(), stats=None, local=frozenset(),
+                  scoped=False, target='raw', reserve=None):
+    """Work out how to rename the names in an abstract syntax tree, as
+    rename_ast does, but leave the tree unchanged and return a
+    Renaming, to pass to SerializeVisitor. If reserve is a
+    FindReserved, it finds the names that the tree reserves (see
+    reserved_names_in_ast) in the same traversal, and these are
+    reserved as well as those in reserved.
+
+    """
+    if target not in ('raw', 'gzip'):
+        raise ValueError("unknown target {0!r}".format(target))
+    if scoped:
+        finder = FindScopes(reserve)
+        finder.find(tree)
+    else:
+        names, imports = FindNames(local, reserve).find(tree)
+    reserved = set(reserved)
+    if reserve is not None:
+        reserved.update(reserve.reserved)
+    if stats is not None:
+        stats['reserved'] = len(reserved)
+    alphabet = letters
+    if target == 'gzip':
+        alphabet = letter_order(tree, reserved)
+    if scoped:
+        return finder.renaming(reserved, stats, alphabet, target == 'raw')
+
+    # Add aliases for import statements if there are enough uses to
+    # justify the transformation. See Renaming.alias for the insertion
+    # of the aliases.
+    for module in imports:
+        if (len(module) - 1) * names[module][0] > 5:
+            reserved.remove(module)
+
+    mapping = shortest_names(names, reserved, letters=alphabet)
+    if stats is not None:
+        stats['renamed'] = len(mapping)
+        stats['kept'] = len(names) - (None in names) - len(mapping)
+    return Renaming(mapping, local)
+
+class Scope(object):
+    """A scope in which names are bound: a module, a class, or a function
+    (including a lambda, generator expression, or set or dictionary
+    comprehension, each of which is compiled as a function).
+
+    """
+    def __init__(self, parent=None, function=False):
+        self.parent = parent
+        self.function = function
+        self.bound = set()      # Names bound in this scope.
+        self.globals = set()    # Names declared global in this scope.
+        self.children = []      # Scopes nested directly in this scope.
+        self.names = dict()     # Map from local name to [n, m] (see FindNames).
+        self.external = set()   # Pairs (scope, name) for names used here
+                                # or in nested scopes but bound outside.
+        self.mapping = dict()   # Map from local name to new name.
+        if parent:
+            parent.children.append(self)
+
+    def resolve(self, name):
+        """Return the scope in which name, used in this scope, is bound."""
+        if name in self.globals:
+            return self.module()
+        if name in self.bound or self.parent is None:
+            return self
+        # Names bound in class scopes are not visible in nested scopes.
+        s = self.parent
+        while s.parent is not None and not (
+            s.function and name in s.bound and name not in s.globals):
+            s = s.parent
+        return s
+
+    def module(self):
+        s = self
+        while s.parent is not None:
+            s = s.parent
+        return s
+
+class FindScopes(NodeVisitor):
+    """Find the scopes in an abstract syntax tree, and the scope in which
+    each name is used, and rename the variables local to each
+    function separately from the names at module and class level,
+    which all share one mapping, as in rename_ast. Each function's
+    variables get the shortest names that don't clash with the names
+    from enclosing scopes (including the module) that are used in the
+    function or in its nested scopes.
+
+    """
+    def __init__(self, reserve=None):
+        self.reserve = reserve  # FindReserved to note each node, or None.
+
+    def visit(self, node):
+        if self.reserve is not None:
+            self.reserve.note(node)
+        return NodeVisitor.visit(self, node)
+
+    def find(self, tree):
+        """Find the scopes in tree and the uses of names in them."""
+        self.scope = Scope()
+        self.uses = []          # List of (node, attribute, scope, name).
+        self.imports = set()    # Bare imports, as for FindNames.
+        self.dotted = set()     # Names bound by "import a.b".
+        self.visit(tree)
+
+    def renaming(self, reserved=set(), stats=None, letters=letters,
+                 frequency=True):
+        """Work out how to rename the names found by find, as for
+        find_renaming, and return a Renaming. New names are made from
+        letters. If frequency is False, each function's variables are
+        named in order of appearance rather than frequency.
+
+        """
+        # Count the uses of each name in the scope that binds it: the
+        # module for names at module and class level.
+        module = self.scope
+        first = dict()
+        for _, _, scope, name in self.uses:
+            if name not in first:
+                first[name] = len(first)
+            owner = scope.resolve(name)
+            if not owner.function:
+                owner = module
+            if name not in owner.names:
+                # Order of appearance: in the file, or in the function.
+                order = first[name]
+                if owner.function and not frequency:
+                    order = len(owner.names)
+                owner.names[name] = [0, order]
+            owner.names[name][0] += 1
+            s = scope
+            while s is not owner and s is not None:
+                if s.function:
+                    s.external.add((owner, name))
+                s = s.parent
+
+        # See find_renaming. A name bound by "import a.b" can't be aliased,
+        # so it must keep its name in every scope. (The import itself
+        # isn't counted as a use.)
+        for name in self.imports - self.dotted:
+            if (name in module.names and name in reserved
+                and (len(name) - 1) * (module.names[name][0] - 1) > 5):
+                reserved.remove(name)
+
+        module.mapping = shortest_names(module.names, reserved,
+                                        letters=letters)
+        renamed = len(module.mapping)
+        kept = len(module.names) - renamed
+        stack = [module]
+        while stack:
+            s = stack.pop()
+            if s.function:
+                avoid = set(o.mapping.get(name, name)
+                            for o, name in s.external)
+                s.mapping = shortest_names(s.names, reserved, avoid, letters,
+                                           frequency)
+                renamed += len(s.mapping)
+                kept += len(s.names) - len(s.mapping)
+            stack.extend(reversed(s.children))
+
+        uses = dict()
+        for node, attr, scope, name in self.uses:
+            owner = scope.resolve(name)
+            if not owner.function:
+                owner = module
+            newname = owner.mapping.get(name, name)
+            if newname != name:
+                # For a bare import, the attribute is 'alias': see
+                # Renaming.alias.
+                uses[node, attr] = newname
+        if stats is not None:
+            stats['renamed'] = renamed
+            stats['kept'] = kept
+        return Renaming(module.mapping, uses=uses)
+
+    def use(self, node, attr, name, bind=False):
+        if bind:
+            self.scope.bound.add(name)
+        self.uses.append((node, attr, self.scope, name))
+
+    def enter(self, function=False):
+        self.scope = Scope(self.scope, function)
+
+    def leave(self):
+        self.scope = self.scope.parent
+
+    def visit_alias(self, node):
+        if node.asname is not None:
+            self.use(node, 'asname', node.asname, True)
+        elif node.name == '*':
+            pass
+        elif '.' in node.name:
+            self.scope.bound.add(node.name.split('.')[0])
+            self.dotted.add(node.name.split('.')[0])
+        else:
+            self.imports.add(node.name)
+            self.use(node, 'alias', node.name, True)
+
+    def visit_arguments(self, node):
+        # Only the parameters: the defaults belong to the enclosing scope.
+        for a in node.args:
+            self.visit(a)
+        if node.vararg is not None:
+            self.use(node, 'vararg', node.vararg, True)
+        if node.kwarg is not None:
+            self.use(node, 'kwarg', node.kwarg, True)
+
+    def visit_Call(self, node):
+        for k in node.keywords:
+            self.uses.append((k, 'arg', self.scope.module(), k.arg))
+        self.generic_visit(node)
+
+    def visit_ClassDef(self, node):
+        self.use(node, 'name', node.name, True)
+        for n in node.bases + node.decorator_list:
+            self.visit(n)
+        self.enter()
+        for n in node.body:
+            self.visit(n)
+        self.leave()
+
+    def visit_FunctionDef(self, node):
+        self.use(node, 'name', node.name, True)
+        for n in node.args.defaults + node.decorator_list:
+            self.visit(n)
+        self.enter(True)
+        self.visit(node.args)
+        for n in node.body:
+            self.visit(n)
+        self.leave()
+
+    def visit_Global(self, node):
+        for i, n in enumerate(node.names):
+            self.scope.globals.add(n)
+            self.use(node, i, n)
+
+    def visit_Lambda(self, node):
+        for n in node.args.defaults:
+            self.visit(n)
+        self.enter(True)
+        self.visit(node.args)
+        self.visit(node.body)
+        self.leave()
+
+    def visit_GeneratorExp(self, node):
+        # The first iterable is evaluated in the enclosing scope.
+        self.visit(node.generators[0].iter)
+        self.enter(True)
+        for i, g in enumerate(node.generators):
+            self.visit(g.target)
+            if i:
+                self.visit(g.iter)
+            for n in g.ifs:
+                self.visit(n)
+        for field in 'elt', 'key', 'value':
+            if hasattr(node, field):
+                self.visit(getattr(node, field))
+        self.leave()
+
+    visit_DictComp = visit_SetComp = visit_GeneratorExp
+
+    def visit_Name(self, node):
+        self.use(node, 'id', node.id, not isinstance(node.ctx, Load))
+
+def module_name(path):
+    """Return the dotted name of the module whose source is in path,
+    found by walking up through the package directories (those with
+    an __init__.py) that contain it. The name of a package's own
+    module ends with ".__init__".
+
+    """
+    import os
+    directory, filename = os.path.split(os.path.abspath(path))
+    parts = [os.path.splitext(filename)[0]]
+    while os.path.exists(os.path.join(directory, '__init__.py')):
+        directory, part = os.path.split(directory)
+        parts.append(part)
+    return '.'.join(reversed(parts))
+
+class Package(object):
+    """The modules of a package (or any set of modules that import one
+    another), renamed consistently: a name is renamed in the same way
+    in every module, so that a function, class or constant imported
+    by one module from another is renamed at its definition and at
+    each import site. Names reserved in any module (see FindReserved)
+    are reserved in all of them, as are the names of the modules
+    themselves. Create it with the list of the modules' filenames and
+    call analyse to work out the mapping; then call rename on the
+    tree of each module.
+
+    """
+    def __init__(self, filenames):
+        import os
+        self.names = dict((os.path.abspath(f), module_name(f))
+                          for f in filenames)
+        self.modules = frozenset(self.names.values())
+        self.mapping = dict()
+
+    def find(self, name):
+        """Return the name of the package's module called name (which
+        may be a package, that is, its __init__), or None.
+
+        """
+        for m in name, name + '.__init__':
+            if m in self.modules:
+                return m
+        return None
+
+    def local_imports(self, filename, tree):
+        """Return the set of imports in tree (the module with source in
+        filename) that are within the package: the ImportFrom nodes
+        that import from one of the package's modules, and their alias
+        nodes, except for those that import submodules.
+
+        """
+        import os
+        package = self.names[os.path.abspath(filename)].rpartition('.')[0]
+        local = set()
+        for node in walk(tree):
+            if not isinstance(node, ImportFrom):
+                continue
+            if node.level:
+                base = package.rsplit('.', node.level - 1)[0]
+                candidates = ['.'.join(filter(None, (base, node.module)))]
+            else:
+                # An implicit relative import, or an absolute import.
+                candidates = [package + '.' + node.module, node.module]
+            for c in candidates:
+                module = self.find(c)
+                if module:
+                    break
+            else:
+                continue
+            if module.endswith('.__init__'):
+                module = module[:-len('.__init__')]
+            local.add(node)
+            local.update(a for a in node.names
+                         if a.name != '*' and not self.find(module + '.' + a.name))
+        return local
+
+    def analyse(self, index=None, preserve=(), stats=None, target='raw'):
+        """Parse the modules, work out the mapping from old names to new,
+        and return it. The names exported by imported modules outside
+        the package are looked up in index, an ExportIndex. The names in
+        preserve are not renamed. If stats is a dictionary, record in it
+        the number of reserved names and names renamed and kept. The
+        target is as for rename_ast.
+
+        """
+        if not isinstance(index, ExportIndex):
+            index = open_index(index)
+        reserved = set(preserve)
+        for module in self.modules:
+            reserved.update(module.split('.'))
+        local = set()
+        body = []
+        for filename in sorted(self.names):
+            tree = parse(open(filename).read(), filename)
+            imports = self.local_imports(filename, tree)
+            reserved.update(FindReserved(index, imports).reserve(tree))
+            local.update(imports)
+            body.extend(tree.body)
+        index.save()
+        # Renaming all the modules as one gives the mapping.
+        self.mapping = find_renaming(Module(body), reserved, stats, local,
+                                     target=target).mapping
+        return self.mapping
+
+    def renaming(self, filename, tree):
+        """Return the Renaming of tree, the module with source in
+        filename, according to the mapping.
+
+        """
+        return Renaming(self.mapping, self.local_imports(filename, tree))
+
+    def rename(self, filename, tree):
+        """Rename the names in tree, the module with source in filename,
+        according to the mapping.
+
+        """
+        self.renaming(filename, tree).apply(tree)
+
+def module_constants(tree):
+    """Return the list of candidate module constants in tree: the
+    top-level assignments of one value to one name written in upper
+    case, like "TIMEOUT = 30". (Call this before renaming, which loses
+    the case; fold_constants checks which of them are really constant.)
+
+    """
+    return [node for node in tree.body
+            if isinstance(node, Assign) and len(node.targets) == 1
+            and isinstance(node.targets[0], Name)
+            and re.match(r'_*[A-Z][A-Z0-9_]*$', node.targets[0].id)]
+
+class FoldConstants(NodeTransformer):
+    """Fold constant expressions (operators applied to numbers and
+    strings) into their values, and replace the names of module
+    constants with their values, in each case only when the result is
+    no longer than what it replaces.
+
+    """
+    # Bounds on the size of the values computed, so that folding can't
+    # take much time or memory: "'a' * 10 ** 9" is left alone.
+    max_bits = 4096
+    max_length = 4096
+
+    def __init__(self, tree, constants=(), encoding='latin1', renaming=None):
+        import operator
+        self.binops = {
+            Add: operator.add, Sub: operator.sub, Mult: operator.mul,
+            Div: operator.div, FloorDiv: operator.floordiv,
+            Mod: operator.mod, Pow: operator.pow,
+            LShift: operator.lshift, RShift: operator.rshift,
+            BitOr: operator.or_, BitXor: operator.xor,
+            BitAnd: operator.and_,
+            }
+        self.unaryops = {
+            Invert: operator.invert, Not: operator.not_,
+            UAdd: operator.pos, USub: operator.neg,
+            }
+        self.cmpops = {
+            Eq: operator.eq, NotEq: operator.ne, Lt: operator.lt,
+            LtE: operator.le, Gt: operator.gt, GtE: operator.ge,
+            In: lambda a, b: a in b, NotIn: lambda a, b: a not in b,
+            }
+        self.serializer = SerializeVisitor(encoding=encoding,
+                                           renaming=renaming)
+        for node in tree.body:
+            if isinstance(node, ImportFrom) and node.module == '__future__':
+                for n in node.names:
+                    if n.name == 'division':
+                        self.binops[Div] = operator.truediv
+                    elif n.name == 'unicode_literals':
+                        self.serializer.unicode_literals = True
+
+        # Count the bindings of each name anywhere in the tree. A name
+        # that's bound more than once (even as a local variable in a
+        # function) isn't treated as a constant.
+        bindings = dict()
+
+        def bind(name):
+            bindings[name] = bindings.get(name, 0) + 1
+
+        unknown = False         # Are there bindings we can't see?
+        for node in walk(tree):
+            if isinstance(node, Name) and not isinstance(node.ctx, Load):
+                bind(node.id)
+            elif isinstance(node, (FunctionDef, ClassDef)):
+                bind(node.name)
+            elif isinstance(node, arguments):
+                for name in filter(None, (node.vararg, node.kwarg)):
+                    bind(name)
+            elif isinstance(node, Global):
+                for name in node.names:
+                    bind(name)
+            elif isinstance(node, alias):
+                unknown = unknown or node.name == '*'
+                bind(node.asname or node.name.split('.')[0])
+            elif isinstance(node, Exec):
+                unknown = True
+        self.bools = not (bindings.get('True') or bindings.get('False'))
+        self.constants = set()
+        if not unknown:
+            self.constants.update(n for n in constants
+                                  if bindings[n.targets[0].id] == 1)
+        self.inline = dict()    # Name -> value, after its assignment.
+
+    def length(self, node):
+        # Length of the serialization of the expression node.
+        return len(self.serializer.unparse(node))
+
+    def constant(self, node):
+        # Return a tuple containing the value of node if it's a number
+        # or string constant, or the empty tuple if not.
+        if isinstance(node, Num):
+            return node.n,
+        elif isinstance(node, Str):
+            return node.s,
+        return ()
+
+    def fold(self, node, compute):
+        # Return a node for the value computed by the function compute,
+        # if it can be represented and is no longer than node; otherwise
+        # return node.
+        try:
+            value = compute()
+        except Exception:
+            return node         # Leave the error for run time.
+        if isinstance(value, bool):
+            if not self.bools:
+                return node
+            new = Name(id=repr(value), ctx=Load())
+        elif isinstance(value, (int, long, float)):
+            if isinstance(value, float) and (isinf(value) or value != value):
+                return node
+            new = Num(n=value)
+        elif isinstance(value, basestring):
+            new = Str(s=value)
+        else:
+            return node
+        if self.length(new) > self.length(node):
+            return node
+        return copy_location(new, node)
+
+    def safe(self, op, a, b):
+        # Is it safe to compute a op b without using much time or memory?
+        if isinstance(op, Pow) and isinstance(b, (int, long)):
+            if isinstance(a, (int, long)):
+                return b <= 0 or abs(a).bit_length() * b <= self.max_bits
+            return abs(b) <= self.max_bits
+        elif isinstance(op, LShift) and isinstance(a, (int, long)):
+            return b < 0 or a.bit_length() + b <= self.max_bits
+        elif isinstance(op, Mult):
+            for s, n in (a, b), (b, a):
+                if isinstance(s, basestring) and isinstance(n, (int, long)):
+                    return len(s) * n <= self.max_length
+        elif isinstance(op, Mod) and isinstance(a, basestring):
+            # Avoid huge field widths like "%999999999s".
+            return not re.search(r'\d{4}|\*', a)
+        return True
+
+    def visit_Module(self, node):
+        for stmt in node.body:
+            self.visit(stmt)
+            if stmt in self.constants and self.constant(stmt.value):
+                name = stmt.targets[0]
+                if self.length(stmt.value) <= self.length(name):
+                    self.inline[name.id] = stmt.value
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left = self.constant(node.left)
+        right = self.constant(node.right)
+        if (not right and isinstance(node.op, Mod) and left
+            and isinstance(left[0], basestring)
+            and isinstance(node.right, Tuple)):
+            values = map(self.constant, node.right.elts)
+            if all(values):
+                right = tuple(v[0] for v in values),
+        if left and right and self.safe(node.op, left[0], right[0]):
+            op = self.binops[type(node.op)]
+            return self.fold(node, lambda: op(left[0], right[0]))
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        # A constant operand either decides the result, or drops out.
+        values = node.values
+        while len(values) > 1:
+            value = self.constant(values[0])
+            if not value:
+                break
+            elif bool(value[0]) == isinstance(node.op, Or):
+                values = values[:1]
+            else:
+                values = values[1:]
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        values = map(self.constant, [node.left] + node.comparators)
+        if (all(values) and all(type(op) in self.cmpops for op in node.ops)):
+            def compute():
+                for (a,), op, (b,) in zip(values, node.ops, values[1:]):
+                    if not self.cmpops[type(op)](a, b):
+                        return False
+                return True
+            return self.fold(node, compute)
+        return node
+
+    def visit_Expr(self, node):
+        # Don't turn an expression statement into a docstring.
+        value = self.visit(node.value)
+        if not isinstance(value, Str):
+            node.value = value
+        return node
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, Load) and node.id in self.inline:
+            value = self.inline[node.id]
+            return copy_location(type(value)(**dict(iter_fields(value))), node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = self.constant(node.operand)
+        if operand:
+            op = self.unaryops[type(node.op)]
+            return self.fold(node, lambda: op(operand[0]))
+        return node
+
+def fold_constants(tree, constants=(), encoding='latin1', renaming=None):
+    """Fold the constant expressions in the module tree, and replace the
+    names of the module constants in the list constants (found by
+    module_constants) with their values. A constant is only replaced
+    after its assignment, and if its name is bound nowhere else. The
+    encoding is that of the output, and renaming (a Renaming, or None)
+    is to be applied to the output, which are used to work out the
+    lengths of strings and names.
+
+    """
+    FoldConstants(tree, constants, encoding, renaming).visit(tree)
+
+def private_functions(tree):
+    """Return the list of the private functions at the top level of the
+    module tree: those whose names start with an underscore (but not
+    two underscores at both ends) and which have no decorators. (Call
+    this before renaming, which loses the underscore.)
+
+    """
+    return [node for node in tree.body
+            if isinstance(node, FunctionDef) and not node.decorator_list
+            and re.match(r'_(?!_.*__$)', node.name)]
+
+def own_scope(nodes):
+    """Generate the nodes in the scope in which the nodes appear,
+    skipping the bodies of nested scopes.
+
+    """
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, FunctionDef):
+            stack.extend(node.decorator_list + node.args.defaults)
+        elif isinstance(node, ClassDef):
+            stack.extend(node.decorator_list + node.bases)
+        elif isinstance(node, Lambda):
+            stack.extend(node.args.defaults)
+        elif isinstance(node, (GeneratorExp, SetComp, DictComp)):
+            stack.append(node.generators[0].iter)
+        else:
+            stack.extend(iter_child_nodes(node))
+
+def all_names(tree):
+    """Return the set of names that appear in the tree as variables,
+    functions, classes, arguments, globals or imports.
+
+    """
+    names = set()
+    for node in walk(tree):
+        if isinstance(node, Name):
+            names.add(node.id)
+        elif isinstance(node, (FunctionDef, ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, arguments):
+            names.update((node.vararg, node.kwarg))
+        elif isinstance(node, Global):
+            names.update(node.names)
+        elif isinstance(node, alias):
+            names.update((node.asname, node.name.split('.')[0]))
+    names.discard(None)
+    return names
+
+def bound_names(nodes):
+    """Return a dictionary mapping the names bound by the nodes to the
+    number of times they are bound.
+
+    """
+    bindings = dict()
+    for node in nodes:
+        if isinstance(node, Name) and not isinstance(node.ctx, Load):
+            names = [node.id]
+        elif isinstance(node, (FunctionDef, ClassDef)):
+            names = [node.name]
+        elif isinstance(node, arguments):
+            names = filter(None, (node.vararg, node.kwarg))
+        elif isinstance(node, (Import, ImportFrom)):
+            names = [a.asname or a.name.split('.')[0] for a in node.names]
+        else:
+            continue
+        for name in names:
+            bindings[name] = bindings.get(name, 0) + 1
+    return bindings
+
+def dotted_name(node):
+    """Return the list of names in node if it's a dotted name like
+    a.b.c, or None if not.
+
+    """
+    names = []
+    while isinstance(node, Attribute):
+        names.append(node.attr)
+        node = node.value
+    if isinstance(node, Name):
+        names.append(node.id)
+        return names[::-1]
+
+def imported_modules(tree):
+    """Return a dictionary mapping each name that is bound in the
+    module tree only by a top-level import statement, like "import os"
+    or "import os.path as p", to the pair (module, statement), like
+    ('os', node) or ('os.path', node). Names declared global anywhere
+    are left out, since a function might rebind them.
+
+    """
+    bindings = bound_names(own_scope(tree.body))
+    declared = set(name for node in walk(tree)
+                   if isinstance(node, Global) for name in node.names)
+    modules = dict()
+    for node in tree.body:
+        if isinstance(node, Import):
+            for a in node.names:
+                name = a.asname or a.name.split('.')[0]
+                if bindings[name] == 1 and name not in declared:
+                    modules[name] = a.name if a.asname else name, node
+    return modules
+
+def module_attribute(index, module, attrs):
+    """Does the named module have the chain of attributes in the list
+    attrs as soon as it's imported (as os has path.join), according to
+    index, an ExportIndex?
+
+    """
+    for attr in attrs:
+        if attr not in index.exports(module):
+            return False
+        module += '.' + attr
+    return True
+
+class EliminateDeadCode(NodeTransformer):
+    """Remove code that can't run: the branches of if statements and
+    while loops with constant tests that can't be taken, and statements
+    following return, raise, break, continue or an endless loop, in the
+    same suite. Then remove the unused private functions (see
+    private_functions) and unused imports.
+
+    Removing code must not change which variables are local to a
+    function, so code that binds a variable that's used elsewhere in
+    the function is only removed if the variable is bound elsewhere
+    too. Code containing yield, global or exec, or "import *", is
+    never removed.
+
+    """
+    # Modules that are imported for the side effects of importing them.
+    keep = frozenset('''__future__ antigravity encodings pkg_resources
+        readline rlcompleter setuptools site sitecustomize this threading
+        user usercustomize'''.split())
+
+    def __init__(self, tree, private=(), keep=(), preserve=(), init=False):
+        self.tree = tree
+        self.private = private
+        self.keep = self.keep.union(keep)
+        self.preserve = preserve
+        self.init = init        # Is the module a package's __init__?
+
+        # Without __all__, any public name might be imported from the
+        # module by another module.
+        self.exports = any(isinstance(n, Assign)
+                           and any(isinstance(t, Name) and t.id == '__all__'
+                                   for t in n.targets)
+                           for n in tree.body)
+
+        # Names bound anywhere, to see if constants are rebound.
+        bound = set(n.id for n in walk(tree)
+                    if isinstance(n, Name) and not isinstance(n.ctx, Load))
+        self.constants = set(['True', 'False', 'None']) - bound
+
+    def eliminate(self):
+        # Remove the unreachable code first, so that the uses in it
+        # don't count.
+        self.used = None        # Name -> number of uses, once known.
+        self.dead_functions = set()
+        self.scopes = []        # (bindings, uses) for each nested scope.
+        self.guarded = 0        # Depth of try statements with handlers.
+        self.visit(self.tree)
+
+        used = dict((name, 1) for name in self.preserve)
+        for name, n in self.uses(self.tree).items():
+            used[name] = used.get(name, 0) + n
+        changed = True
+        while changed:
+            changed = False
+            for f in self.private:
+                if (f not in self.dead_functions and f in self.tree.body
+                    and not used.get(f.name)):
+                    self.dead_functions.add(f)
+                    for name, n in self.uses(f).items():
+                        used[name] -= n
+                    changed = True
+        self.used = used
+        self.visit(self.tree)
+
+    def unused(self, name):
+        return self.used is not None and not self.used.get(name)
+
+    def uses(self, node):
+        # Return a dictionary mapping names to the number of times they
+        # are used in node, counting (conservatively) the string
+        # constants that might be names.
+        uses = dict()
+        for n in walk(node):
+            if isinstance(n, Name) and not isinstance(n.ctx, (Store, Param)):
+                name = n.id
+            elif isinstance(n, AugAssign) and isinstance(n.target, Name):
+                name = n.target.id
+            elif isinstance(n, Str) and isinstance(n.s, str):
+                name = n.s
+            else:
+                continue
+            uses[name] = uses.get(name, 0) + 1
+        return uses
+
+    def bindings(self, nodes):
+        # Return a dictionary mapping the names bound by nodes in their
+        # own scope to the number of bindings, or None if the nodes
+        # contain something that mustn't be removed.
+        bindings = dict()
+        for node in own_scope(nodes):
+            if isinstance(node, (Global, Yield, Exec)):
+                return None
+            elif isinstance(node, Name) and not isinstance(node.ctx, Load):
+                names = [node.id]
+            elif isinstance(node, (FunctionDef, ClassDef)):
+                names = [node.name]
+            elif isinstance(node, arguments):
+                names = filter(None, (node.vararg, node.kwarg))
+            elif isinstance(node, alias):
+                if node.name == '*':
+                    return None
+                names = [node.asname or node.name.split('.')[0]]
+            else:
+                continue
+            for name in names:
+                bindings[name] = bindings.get(name, 0) + 1
+        return bindings
+
+    def removable(self, nodes):
+        # Can the nodes be removed? If so, update the count of bindings
+        # in the current scope.
+        bindings = self.bindings(nodes)
+        if bindings is None:
+            return False
+        if not self.scopes:
+            return True         # Module scope.
+        bound, used = self.scopes[-1]
+        uses = dict()
+        for node in nodes:
+            for name, n in self.uses(node).items():
+                uses[name] = uses.get(name, 0) + n
+        for name, n in bindings.items():
+            if (used.get(name, 0) > uses.get(name, 0)
+                and bound.get(name, 0) <= n):
+                return False
+        for name, n in bindings.items():
+            bound[name] = bound.get(name, 0) - n
+        for name, n in uses.items():
+            used[name] -= n
+        return True
+
+    def constant(self, node):
+        # Return a tuple containing the truth value of node if it's a
+        # constant, or the empty tuple if not.
+        if isinstance(node, (Num, Str)):
+            return bool(node.n if isinstance(node, Num) else node.s),
+        elif isinstance(node, Name) and node.id in self.constants:
+            return node.id == 'True',
+        return ()
+
+    def terminates(self, node):
+        # Does control never pass to the statement after node?
+        if isinstance(node, (Return, Raise, Break, Continue)):
+            return True
+        elif isinstance(node, If):
+            return (node.body and node.orelse
+                    and self.terminates(node.body[-1])
+                    and self.terminates(node.orelse[-1]))
+        elif isinstance(node, While):
+            return self.constant(node.test) == (True,) and not any(
+                isinstance(n, Break) for n in self.loop_nodes(node.body))
+        return False
+
+    def loop_nodes(self, body):
+        # Generate the statements in body that belong to the loop (and
+        # not to nested loops, functions or classes).
+        stack = list(body)
+        while stack:
+            node = stack.pop()
+            yield node
+            if not isinstance(node, (For, While, FunctionDef, ClassDef)):
+                stack.extend(n for n in iter_child_nodes(node)
+                             if isinstance(n, (stmt, excepthandler)))
+            elif isinstance(node, (For, While)):
+                stack.extend(node.orelse)
+
+    def block(self, body, required=True):
+        # Return the suite body with the dead code removed. If required,
+        # the result must not be empty.
+        result = []
+        for i, node in enumerate(body):
+            new = self.visit(node)
+            if new is None:
+                new = []
+            elif isinstance(new, AST):
+                new = [new]
+            result.extend(new)
+            if (result and self.terminates(result[-1])
+                and i + 1 < len(body) and self.removable(body[i + 1:])):
+                break
+        if required and not result:
+            result = [copy_location(Pass(), body[0])]
+        return result
+
+    def splice(self, node, body):
+        # Return body to replace node, unless it would turn a string
+        # into a docstring.
+        if (body and isinstance(body[0], Expr)
+            and isinstance(body[0].value, Str)):
+            return node
+        return body
+
+    def scope(self, node, fields):
+        # Visit the suites in fields of node, which has its own scope.
+        bound = self.bindings([node.args] if isinstance(node, FunctionDef)
+                              else []) or dict()
+        for name, n in (self.bindings(node.body) or dict()).items():
+            bound[name] = bound.get(name, 0) + n
+        self.scopes.append((bound, self.uses(node)))
+        for field in fields:
+            setattr(node, field, self.block(getattr(node, field)))
+        self.scopes.pop()
+        return node
+
+    def visit_ClassDef(self, node):
+        return self.scope(node, ['body'])
+
+    def visit_FunctionDef(self, node):
+        if node in self.dead_functions:
+            return None
+        return self.scope(node, ['body'])
+
+    def visit_For(self, node):
+        node.body = self.block(node.body)
+        node.orelse = self.block(node.orelse, False)
+        return node
+
+    def visit_If(self, node):
+        value = self.constant(node.test)
+        if value:
+            live, dead = node.body, node.orelse
+            if not value[0]:
+                live, dead = dead, live
+            if self.removable(dead):
+                return self.splice(node, self.block(live, False))
+        node.body = self.block(node.body)
+        node.orelse = self.block(node.orelse, False)
+        return node
+
+    def visit_Import(self, node):
+        if self.guarded or (self.init and not self.scopes):
+            return node
+        node.names = [a for a in node.names
+                      if not self.unused(a.asname or a.name.split('.')[0])
+                      or any(a.name == k or a.name.startswith(k + '.')
+                             for k in self.keep)]
+        return node if node.names else None
+
+    def visit_ImportFrom(self, node):
+        if (self.guarded or (self.init and not self.scopes)
+            or node.names[0].name == '*'):
+            return node
+        module = node.module or ''
+        if not node.level and any(module == k or module.startswith(k + '.')
+                                  for k in self.keep):
+            return node
+        node.names = [a for a in node.names
+                      if not self.unused(a.asname or a.name)
+                      or not (self.scopes or self.exports
+                              or (a.asname or a.name).startswith('_'))]
+        return node if node.names else None
+
+    def visit_Module(self, node):
+        node.body = self.block(node.body, False)
+        return node
+
+    def visit_TryExcept(self, node):
+        if (all(isinstance(b, Pass) for b in node.body)
+            and self.removable(node.handlers)):
+            # Nothing can raise an exception.
+            return self.splice(node, self.block(node.orelse, False))
+        self.guarded += 1
+        node.body = self.block(node.body)
+        self.guarded -= 1
+        for h in node.handlers:
+            h.body = self.block(h.body)
+        node.orelse = self.block(node.orelse, False)
+        return node
+
+    def visit_TryFinally(self, node):
+        node.body = self.block(node.body)
+        node.finalbody = self.block(node.finalbody)
+        return node
+
+    def visit_With(self, node):
+        node.body = self.block(node.body)
+        return node
+
+    def visit_While(self, node):
+        value = self.constant(node.test)
+        if value == (False,) and self.removable(node.body):
+            return self.splice(node, self.block(node.orelse, False))
+        elif value == (True,) and self.removable(node.orelse):
+            node.orelse = []
+        node.body = self.block(node.body)
+        node.orelse = self.block(node.orelse, False)
+        return node
+
+    def generic_visit(self, node):
+        # Other statements have no suites, and expressions can't contain
+        # statements.
+        return node
+
+def eliminate_dead_code(tree, private=(), keep=(), preserve=(), init=False):
+    """Remove the dead code from the module tree, as described under
+    EliminateDeadCode. Private functions in the list private (found by
+    private_functions) are removed if they are not used. Unused imports
+    are removed, except for imports of the modules in keep (in addition
+    to EliminateDeadCode.keep), which have side effects, and imports in
+    the bodies of try statements with exception handlers, and imports
+    at module level of public names from modules, unless the module has
+    __all__, since other modules might import those names from it.
+    Names in preserve count as used. If init is True, the module is a
+    package's __init__, whose imports at module level are all kept.
+
+    """
+    EliminateDeadCode(tree, private, keep, preserve, init).eliminate()
+
+class HoistLiterals(NodeTransformer):
+    """Bind number and string literals that are repeated often enough to
+    short names at the top of the module, and replace each occurrence
+    by the name, where that makes the code shorter: see hoist_literals.
+
+    """
+    def __init__(self, tree, encoding='latin1', renaming=None):
+        self.serializer = SerializeVisitor(encoding=encoding,
+                                           renaming=renaming)
+
+        # The new names must not clash with any name in the module, as
+        # it is written out.
+        avoid = all_names(tree) | FindReserved.builtins
+        self.unknown = any(isinstance(node, Exec)      # Unseen bindings?
+                           or isinstance(node, alias) and node.name == '*'
+                           for node in walk(tree))
+        for node in tree.body:
+            if isinstance(node, ImportFrom) and node.module == '__future__':
+                if any(n.name == 'unicode_literals' for n in node.names):
+                    self.serializer.unicode_literals = True
+        if renaming is not None:
+            avoid.update(renaming.mapping.values())
+            avoid.update((renaming.uses or {}).values())
+        self.avoid = avoid
+        self.counts = dict()    # Literal -> [uses, node].
+        self.names = None       # Literal -> new name, when replacing.
+
+    def literal(self, node):
+        # The key identifying the literal node.
+        value = node.s if isinstance(node, Str) else node.n
+        return type(value), repr(value)
+
+    def hoist(self, tree):
+        """Hoist the literals in the module tree, and return a list of
+        tuples (name, node, uses, saved) for the hoisted literals.
+
+        """
+        if self.unknown:
+            return []
+        self.visit(tree)
+
+        # Give the shortest names to the literals with the most bytes
+        # in all their uses, and hoist each one if the uses of the name
+        # (allowing for a space before each) and its share of the
+        # assignment "a,b=x,y" are shorter than the uses of the literal.
+        literals = sorted(
+            ((uses, len(self.serializer.unparse(node)), key, node)
+             for key, (uses, node) in self.counts.items() if uses > 1),
+            key=lambda (uses, length, key, node): (-uses * length, key))
+        hoisted = []
+        n = 0
+        for uses, length, key, node in literals:
+            name = '_' + make_name(n)
+            while name in self.avoid:
+                n += 1
+                name = '_' + make_name(n)
+            saved = uses * (length - len(name) - 1) - (len(name) + length + 2)
+            if saved > 0:
+                hoisted.append((name, node, uses, saved))
+                n += 1
+        if not hoisted:
+            return []
+        self.names = dict((self.literal(node), name)
+                          for name, node, _, _ in hoisted)
+        self.visit(tree)
+
+        targets = [Name(id=name, ctx=Store()) for name, _, _, _ in hoisted]
+        values = [type(node)(**dict(iter_fields(node)))
+                  for _, node, _, _ in hoisted]
+        if len(hoisted) == 1:
+            assign = Assign(targets=targets, value=values[0])
+        else:
+            assign = Assign(targets=[Tuple(elts=targets, ctx=Store())],
+                            value=Tuple(elts=values, ctx=Load()))
+        # After the docstring and the future imports.
+        i = 0
+        if (tree.body and isinstance(tree.body[0], Expr)
+            and isinstance(tree.body[0].value, Str)):
+            i = 1
+        while (i < len(tree.body) and isinstance(tree.body[i], ImportFrom)
+               and tree.body[i].module == '__future__'):
+            i += 1
+        tree.body.insert(i, assign)
+        return hoisted
+
+    def visit_Assign(self, node):
+        # Leave __all__ as it is, for tools that read it.
+        if any(isinstance(t, Name) and t.id == '__all__'
+               for t in node.targets):
+            return node
+        return self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        # Leave docstrings (and other strings on their own) alone.
+        if isinstance(node.value, Str):
+            return node
+        return self.generic_visit(node)
+
+    def visit_Num(self, node):
+        key = self.literal(node)
+        if self.names is None:
+            self.counts.setdefault(key, [0, node])[0] += 1
+        elif key in self.names:
+            return copy_location(Name(id=self.names[key], ctx=Load()), node)
+        return node
+
+    visit_Str = visit_Num
+
+def hoist_literals(tree, encoding='latin1', renaming=None, stats=None):
+    """Bind each number or string literal that is repeated often enough
+    in the module tree to a short name, assigned at the top of the
+    module, and replace the literal by the name, where that makes the
+    code shorter. The names start with an underscore, so that "from
+    module import *" doesn't export them, and clash with no other
+    name in the module. The encoding and renaming (a Renaming, or
+    None) are those of the output. Nothing is hoisted if the module
+    uses exec or "from module import *", which could bind the names.
+
+    If stats is a dictionary, record in stats['hoist'] a list with a
+    dictionary for each hoisted literal, giving its name, the literal
+    (as written out, decoded with the encoding), its number of uses and
+    the number of bytes saved (at least: the count allows for a space
+    before each use of the name, which isn't always needed).
+
+    """
+    hoisting = HoistLiterals(tree, encoding, renaming)
+    hoisted = hoisting.hoist(tree)
+    if stats is not None:
+        stats['hoist'] = [
+            dict(name=name, uses=uses, saved=saved,
+                 literal=hoisting.serializer.unparse(node).decode(
+                    encoding, 'replace'))
+            for name, node, uses, saved in hoisted]
+
+class LocalizeLoops(NodeTransformer):
+    """Speed up the loops in functions by looking up, once before each
+    loop, the global names that it uses and the functions and methods
+    that it calls, and binding them to local variables: see
+    localize_loops.
+
+    """
+    # Names that fold_constants and eliminate_dead_code look for.
+    constants = frozenset(['None', 'True', 'False'])
+
+    # Builtin types whose instances are created by displays.
+    displays = {List: list, ListComp: list, Dict: dict, DictComp: dict,
+                Set: set, SetComp: set}
+
+    def __init__(self, tree, index=None):
+        self.tree = tree
+        self.index = index or open_index()
+        self.avoid = all_names(tree) | FindReserved.builtins
+        self.names = dict()     # Dotted name -> local variable.
+        self.locals = dict()    # Local variable -> dotted name.
+        self.localized = 0
+        self.scopes = []        # Local names of the enclosing functions.
+        self.active = False     # Localizing in the current scope?
+        self.bound = dict()     # Local name -> builtin type of its value.
+
+        # A global name can only be rebound while a function runs if
+        # it's bound outside the module's top-level imports, function
+        # definitions and class definitions (which bind it once and for
+        # all when the module is imported). A function can only rely on
+        # the builtins it doesn't shadow, and on the names bound by the
+        # top-level statements before it (see visit_Module): it might
+        # run before the later statements have.
+        self.unknown = any(isinstance(node, Exec)
+                           or isinstance(node, alias) and node.name == '*'
+                           or isinstance(node, Name) and node.id == 'globals'
+                           for node in walk(tree))
+        bindings = bound_names(own_scope(tree.body))
+        defined = bound_names(node for node in tree.body
+                              if isinstance(node, (Import, ImportFrom,
+                                                   FunctionDef, ClassDef)))
+        declared = set(name for node in walk(tree)
+                       if isinstance(node, Global) for name in node.names)
+        self.defined = set(name for name, n in bindings.items()
+                           if defined.get(name) == n) - declared
+        self.builtins = (FindReserved.builtins - set(bindings)
+                         - self.constants - declared)
+        self.globals = set(self.builtins)
+
+        # Global name -> module, for modules imported at the top level.
+        self.modules = dict((name, module) for name, (module, _)
+                            in imported_modules(tree).items())
+
+    def container(self, node):
+        # Return the builtin type (list, dict or set) of the value of the
+        # expression node, or None if it's not known.
+        if isinstance(node, Call) and isinstance(node.func, Name):
+            name = self.locals.get(node.func.id, node.func.id)
+            if (name in ('list', 'dict', 'set')
+                and name in self.globals.difference(*self.scopes)):
+                return dict(list=list, dict=dict, set=set)[name]
+        return self.displays.get(type(node))
+
+    def block(self, body, bound):
+        # Localize the lookups in the loops in the suite body, where the
+        # local names in the dictionary bound have been assigned values
+        # of the given builtin types, and return the suite.
+        result = []
+        bound = dict(bound)
+        for node in body:
+            if self.active and isinstance(node, (For, While)):
+                result.extend(self.localize(node, bound))
+            self.bound = bound
+            result.append(self.visit(node))
+            for name in bound_names(own_scope([node])):
+                bound.pop(name, None)
+            if (isinstance(node, Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], Name)):
+                kind = self.container(node.value)
+                if kind is not None:
+                    bound[node.targets[0].id] = kind
+        return result
+
+    def localize(self, loop, bound):
+        # Replace the lookups in the loop that can be made once before
+        # it by local variables, and return the assignments to them.
+        if isinstance(loop, For):
+            nodes = [loop.target] + loop.body
+        else:
+            nodes = [loop.test] + loop.body
+        stored = bound_names(own_scope(nodes))
+        self.lookup_attrs = set(
+            n.attr for n in own_scope(nodes)
+            if isinstance(n, Attribute) and not isinstance(n.ctx, Load))
+        self.lookup_globals = self.globals.difference(*self.scopes)
+        self.lookup_locals = dict((name, kind) for name, kind in bound.items()
+                                  if name not in stored)
+        self.lookups = []       # (dotted name, local variable) pairs.
+        self.performed = set(performed(loop))
+        if isinstance(loop, While):
+            loop.test = self.lookup(loop.test)
+        loop.body = map(self.lookup, loop.body)
+        assignments = []
+        for dotted, name in self.lookups:
+            parts = dotted.split('.')
+            value = copy_location(Name(id=parts[0], ctx=Load()), loop)
+            for attr in parts[1:]:
+                value = copy_location(Attribute(value=value, attr=attr,
+                                                ctx=Load()), loop)
+            assignments.append(copy_location(Assign(
+                targets=[copy_location(Name(id=name, ctx=Store()), loop)],
+                value=value), loop))
+        self.localized += len(assignments)
+        return assignments
+
+    def exported(self, names):
+        # Is the dotted name a function in a module imported at the top
+        # level, like os.path.join, which is sure to exist?
+        return (names[0] in self.modules
+                and module_attribute(self.index, self.modules[names[0]],
+                                     names[1:]))
+
+    def local(self, node, names):
+        # Return a local variable to replace the lookup of the dotted
+        # name by node, or node if it can't be replaced.
+        base = names[0]
+        if self.lookup_attrs.intersection(names[1:]):
+            return node
+        elif base in self.lookup_locals:
+            if len(names) != 2 or not hasattr(self.lookup_locals[base],
+                                              names[1]):
+                return node
+        elif base not in self.lookup_globals:
+            return node
+        elif len(names) > 1 and not self.exported(names):
+            return node
+        elif base not in self.builtins and node not in self.performed:
+            # Look up module globals before the loop only if the loop
+            # looks them up every time round.
+            return node
+        dotted = '.'.join(names)
+        name = self.names.get(dotted)
+        if name is None:
+            name = '_' + '_'.join(names)
+            while name in self.avoid:
+                name += '_'
+            self.avoid.add(name)
+            self.names[dotted] = name
+            self.locals[name] = dotted
+        if (dotted, name) not in self.lookups:
+            self.lookups.append((dotted, name))
+        return copy_location(Name(id=name, ctx=Load()), node)
+
+    def lookup(self, node):
+        # Replace the lookups in node, which is in the loop, and return
+        # node or the local variable to replace it with.
+        if isinstance(node, Name) and isinstance(node.ctx, Load):
+            return self.local(node, [node.id])
+        elif isinstance(node, FunctionDef):
+            node.decorator_list = map(self.lookup, node.decorator_list)
+            node.args.defaults = map(self.lookup, node.args.defaults)
+        elif isinstance(node, ClassDef):
+            node.decorator_list = map(self.lookup, node.decorator_list)
+            node.bases = map(self.lookup, node.bases)
+        elif isinstance(node, Lambda):
+            node.args.defaults = map(self.lookup, node.args.defaults)
+        elif isinstance(node, (GeneratorExp, SetComp, DictComp)):
+            node.generators[0].iter = self.lookup(node.generators[0].iter)
+        else:
+            if isinstance(node, Call):
+                names = dotted_name(node.func)
+                if names and len(names) > 1:
+                    node.func = self.local(node.func, names)
+            for field, value in iter_fields(node):
+                if isinstance(value, list):
+                    setattr(node, field, [self.lookup(v) if isinstance(v, AST)
+                                          else v for v in value])
+                elif isinstance(value, AST):
+                    setattr(node, field, self.lookup(value))
+        return node
+
+    def suites(self, node):
+        # Visit the suites of a compound statement. The local names that
+        # it binds anywhere might have been rebound on entry to any of
+        # them.
+        stored = bound_names(own_scope([node]))
+        bound = dict((name, kind) for name, kind in self.bound.items()
+                     if name not in stored)
+        for field in 'body', 'orelse', 'finalbody':
+            if hasattr(node, field):
+                setattr(node, field, self.block(getattr(node, field), bound))
+        for h in getattr(node, 'handlers', ()):
+            h.body = self.block(h.body, bound)
+        return node
+
+    visit_For = visit_If = visit_TryExcept = suites
+    visit_TryFinally = visit_While = visit_With = suites
+
+    def visit_ClassDef(self, node):
+        active, self.active = self.active, False
+        node.body = self.block(node.body, {})
+        self.active = active
+        return node
+
+    def visit_FunctionDef(self, node):
+        # Adding local variables would change the results of locals(),
+        # vars() and dir() with no arguments.
+        nodes = list(own_scope([node.args] + node.body))
+        active = not any(isinstance(n, (Global, Exec))
+                         or isinstance(n, alias) and n.name == '*'
+                         or isinstance(n, Name)
+                         and n.id in ('locals', 'vars', 'dir')
+                         for n in nodes)
+        saved, self.active = self.active, active
+        self.scopes.append(set(bound_names(nodes)))
+        node.body = self.block(node.body, {})
+        self.scopes.pop()
+        self.active = saved
+        return node
+
+    def visit_Module(self, node):
+        body = []
+        for statement in node.body:
+            body.extend(self.block([statement], {}))
+            self.globals.update(name for name in bound_names([statement])
+                                if name in self.defined)
+        node.body = body
+        return node
+
+    def generic_visit(self, node):
+        # Other statements have no suites.
+        return node
+
+def performed(loop):
+    """Generate the expression nodes in the for or while loop that are
+    evaluated every time round the loop (or, for the test of a while
+    loop, at least once), before anything can skip them: the leading
+    simple statements of the body, and the tests and context managers
+    (or iterables) of the compound statement that follows them, but not
+    the short-circuited parts of expressions.
+
+    """
+    if isinstance(loop, While):
+        stack = [loop.test]
+    else:
+        stack = []
+    for statement in loop.body:
+        if isinstance(statement, (If, While)):
+            stack.append(statement.test)
+        elif isinstance(statement, For):
+            stack.append(statement.iter)
+        elif isinstance(statement, With):
+            stack.append(statement.context_expr)
+        elif isinstance(statement, (Expr, Assign, AugAssign, Print, Return,
+                                    Raise)):
+            stack.extend(iter_child_nodes(statement))
+        if not isinstance(statement, (Expr, Assign, AugAssign, Print)):
+            break
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, BoolOp):
+            stack.append(node.values[0])
+        elif isinstance(node, IfExp):
+            stack.append(node.test)
+        elif isinstance(node, Compare):
+            stack.extend((node.left, node.comparators[0]))
+        elif isinstance(node, (ListComp, GeneratorExp, SetComp, DictComp)):
+            stack.append(node.generators[0].iter)
+        elif not isinstance(node, Lambda):
+            stack.extend(iter_child_nodes(node))
+
+def localize_loops(tree, index=None, stats=None):
+    """Speed up the for and while loops in the functions in the module
+    tree, by looking up the global names they use (like len), and the
+    functions and methods they call (like math.sqrt or out.append), once
+    before the loop rather than on every iteration, and binding them to
+    new local variables. A lookup is only moved if nothing in the loop
+    rebinds its names or assigns to its attributes, and if it's sure to
+    succeed:
+
+    * Global names must be builtins that the module doesn't bind, or
+      bound in the module only by its top-level imports and function
+      and class definitions, before the top-level statement containing
+      the function (which might run before the later ones have), and
+      not declared global anywhere.
+    * Calls like os.path.join(...) are to a module imported at the top
+      level (likewise), which exports the attributes according to
+      index, an ExportIndex.
+    * Global names other than builtins, and calls like
+      os.path.join(...), are only looked up before the loop if the loop
+      looks them up every time round (see performed), and not, for
+      example, only in an if statement.
+    * Calls like out.append(...) are to methods of a list, dictionary
+      or set that the function assigned to a local variable earlier in
+      the same suite. Calls through other objects, like
+      self.out.append(...), are left alone, since a method called in
+      the loop might replace the object, or the object might not have
+      the method.
+    * None, True and False are left alone, since fold_constants and
+      eliminate_dead_code look for them.
+
+    Nothing is changed in a module that uses exec, globals() or "from
+    module import *", or in a function that uses global, locals(),
+    vars() or dir(). If stats is a dictionary, record in
+    stats['localized'] the number of lookups moved out of loops.
+
+    """
+    localizing = LocalizeLoops(tree, index)
+    if not localizing.unknown:
+        localizing.visit(tree)
+    if stats is not None:
+        stats['localized'] = localizing.localized
+
+class AliasChains(NodeTransformer):
+    """Bind the constants of imported modules, like errno.EINTR, that
+    are used often enough, to short names after the import, and
+    replace each use by the name, where that makes the code shorter:
+    see alias_chains.
+
+    """
+    def __init__(self, tree, index=None, encoding='latin1', renaming=None):
+        self.tree = tree
+        self.index = index or open_index()
+        self.renaming = renaming
+        self.serializer = SerializeVisitor(encoding=encoding,
+                                           renaming=renaming)
+        self.modules = imported_modules(tree)
+        self.unknown = any(isinstance(node, Exec)
+                           or isinstance(node, alias) and node.name == '*'
+                           or isinstance(node, Name) and node.id == 'globals'
+                           for node in walk(tree))
+        avoid = all_names(tree) | FindReserved.builtins
+        if renaming is not None:
+            avoid.update(renaming.mapping.values())
+            avoid.update((renaming.uses or {}).values())
+        self.avoid = avoid
+
+        # Chains that are assigned or deleted, like os.environ in
+        # "os.environ = {}".
+        self.assigned = set()
+        for node in walk(tree):
+            if isinstance(node, Attribute) and not isinstance(node.ctx, Load):
+                names = dotted_name(node)
+                if names:
+                    self.assigned.add(tuple(names))
+        self.safe = dict()      # Dotted name -> can it be aliased?
+        self.shadowed = set()   # Names bound in the enclosing scopes.
+        self.outer = set()      # The same, for nested functions.
+        self.counts = dict()    # Dotted name -> [uses, node].
+        self.names = None       # Dotted name -> new name, when replacing.
+
+    def chain(self, node):
+        # Return the pair (prefix, dotted name) for the longest prefix
+        # of the dotted name node that can be aliased, or (None, None).
+        names = dotted_name(node)
+        if (not names or names[0] not in self.modules
+            or names[0] in self.shadowed):
+            return None, None
+        while len(names) > 1:
+            dotted = '.'.join(names)
+            if dotted not in self.safe:
+                # The chain mustn't be assigned, nor any prefix of it,
+                # and must exist as soon as the module is imported. It
+                # must be named like a constant, since other variables
+                # (like sys.stdout) get rebound, and functions (like
+                # linecache.getlines) get replaced by other modules.
+                key = tuple(names)
+                self.safe[dotted] = (
+                    not any(key[:i] in self.assigned
+                            for i in range(2, len(key) + 1))
+                    and names[-1].isupper()
+                    and module_attribute(self.index,
+                                         self.modules[names[0]][0],
+                                         names[1:]))
+            if self.safe[dotted]:
+                return node, dotted
+            names.pop()
+            node = node.value
+        return None, None
+
+    def alias(self, tree):
+        """Alias the chains in the module tree, and return a list of
+        tuples (name, chain, uses, saved) for the aliased chains.
+
+        """
+        if self.unknown:
+            return []
+        self.visit(tree)
+
+        # Give the shortest names to the chains with the most bytes in
+        # all their uses, and alias each one if the uses of the name
+        # and its share of the assignment "a,b=x,y" are shorter than
+        # the uses of the chain.
+        chains = sorted(
+            ((uses, len(self.serializer.unparse(node)), dotted)
+             for dotted, (uses, node) in self.counts.items() if uses > 1),
+            key=lambda (uses, length, dotted): (-uses * length, dotted))
+        aliased = []
+        n = 0
+        for uses, length, dotted in chains:
+            name = '_' + make_name(n)
+            while name in self.avoid:
+                n += 1
+                name = '_' + make_name(n)
+            saved = uses * (length - len(name)) - (len(name) + length + 2)
+            if saved > 0:
+                aliased.append((name, dotted, uses, saved))
+                n += 1
+        if not aliased:
+            return []
+        self.names = dict((dotted, name) for name, dotted, _, _ in aliased)
+        self.visit(tree)
+
+        # Assign the aliases after the import of each module.
+        after = dict()
+        for name, dotted, _, _ in aliased:
+            statement = self.modules[dotted.split('.')[0]][1]
+            after.setdefault(statement, []).append((name, dotted))
+        body = []
+        for statement in tree.body:
+            body.append(statement)
+            if statement not in after:
+                continue
+            targets, values = [], []
+            for name, dotted in after[statement]:
+                names = dotted.split('.')
+                value = Name(id=names[0], ctx=Load())
+                if (self.renaming is not None
+                    and self.renaming.uses is not None):
+                    # The new name isn't in the scoped renaming, so give
+                    # it the name the import binds after renaming.
+                    a, = [a for a in statement.names
+                          if (a.asname or a.name.split('.')[0]) == names[0]]
+                    module, asname = self.renaming.alias(a)
+                    self.renaming.uses[value, 'id'] = (
+                        asname or module.split('.')[0])
+                for attr in names[1:]:
+                    value = Attribute(value=value, attr=attr, ctx=Load())
+                targets.append(Name(id=name, ctx=Store()))
+                values.append(value)
+            if len(targets) == 1:
+                assign = Assign(targets=targets, value=values[0])
+            else:
+                assign = Assign(targets=[Tuple(elts=targets, ctx=Store())],
+                                value=Tuple(elts=values, ctx=Load()))
+            body.append(fix_missing_locations(copy_location(assign,
+                                                            statement)))
+        tree.body = body
+        return aliased
+
+    def scope(self, node, nodes, fields, function=True):
+        # Visit the fields of node, which has its own scope binding
+        # the names bound by nodes. Functions nested in a class don't
+        # see the names bound in the class.
+        shadowed, outer = self.shadowed, self.outer
+        bound = set(bound_names(own_scope(nodes)))
+        self.shadowed = outer | bound
+        if function:
+            self.outer = self.shadowed
+        for field in fields:
+            value = getattr(node, field)
+            if isinstance(value, list):
+                setattr(node, field, [self.visit(v) for v in value])
+            else:
+                setattr(node, field, self.visit(value))
+        self.shadowed, self.outer = shadowed, outer
+        return node
+
+    def visit_Attribute(self, node):
+        prefix, dotted = self.chain(node)
+        if prefix is None:
+            return self.generic_visit(node)
+        elif self.names is None:
+            self.counts.setdefault(dotted, [0, prefix])[0] += 1
+        elif dotted in self.names:
+            name = copy_location(Name(id=self.names[dotted], ctx=Load()),
+                                 prefix)
+            if prefix is node:
+                return name
+            parent = node
+            while parent.value is not prefix:
+                parent = parent.value
+            parent.value = name
+        return node
+
+    def visit_ClassDef(self, node):
+        node.bases = [self.visit(b) for b in node.bases]
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        return self.scope(node, node.body, ['body'], function=False)
+
+    def visit_FunctionDef(self, node):
+        node.args.defaults = [self.visit(d) for d in node.args.defaults]
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        return self.scope(node, [node.args] + node.body, ['body'])
+
+    def visit_GeneratorExp(self, node):
+        # The names bound by the generators shadow the module names
+        # everywhere in the expression (even in the first iterable,
+        # to be on the safe side).
+        fields = [f for f, _ in iter_fields(node)]
+        return self.scope(node, [g.target for g in node.generators], fields)
+
+    visit_DictComp = visit_SetComp = visit_GeneratorExp
+
+    def visit_Lambda(self, node):
+        node.args.defaults = [self.visit(d) for d in node.args.defaults]
+        return self.scope(node, [node.args, node.body], ['body'])
+
+def alias_chains(tree, index=None, encoding='latin1', renaming=None,
+                 stats=None):
+    """Bind each attribute chain of a module that is named like a
+    constant, like errno.EINTR or stat.S_IFDIR, and is used often
+    enough in the module tree, to a short name, assigned after the
+    statement that imports the module, and replace the chain by the
+    name, where that makes the code shorter. The module must be
+    imported at the top level, and not bound any other way. The chain
+    must not be assigned to, and must exist as soon as the module is
+    imported, according to index (an ExportIndex). Other attributes,
+    even functions, might be replaced at run time, as doctest replaces
+    linecache.getlines, so they are left alone. Names start with an
+    underscore and don't clash with any other name in the module. The
+    encoding and renaming (a Renaming, or None) are those of the
+    output. Nothing is aliased if the module uses exec, globals() or
+    "from module import *".
+
+    If stats is a dictionary, record in stats['chains'] a list with a
+    dictionary for each aliased chain, giving its name, the chain, its
+    number of uses and the number of bytes saved.
+
+    """
+    aliasing = AliasChains(tree, index, encoding, renaming)
+    aliased = aliasing.alias(tree)
+    if stats is not None:
+        stats['chains'] = [dict(name=name, chain=dotted, uses=uses,
+                                saved=saved)
+                           for name, dotted, uses, saved in aliased]
+
+class DeferImports(NodeVisitor):
+    """Find the top-level imports whose names are only used inside
+    functions, and move each one into the outermost functions that use
+    it: see defer_imports.
+
+    """
+    def __init__(self, tree, keep=(), init=False):
+        self.tree = tree
+        self.unknown = init or any(
+            isinstance(node, Exec)
+            or isinstance(node, alias) and node.name == '*'
+            or isinstance(node, Name) and node.id == 'globals'
+            for node in walk(tree))
+
+        # Names that are bound more than once at the top level, declared
+        # global, or bound in a class body (which looks them up in the
+        # class and then the module, never in an enclosing function)
+        # stay put, as do the names in __all__.
+        bindings = bound_names(own_scope(tree.body))
+        fixed = set(name for name, n in bindings.items() if n > 1)
+        for node in walk(tree):
+            if isinstance(node, Global):
+                fixed.update(node.names)
+            elif isinstance(node, ClassDef):
+                fixed.update(bound_names(own_scope(node.body)))
+        exports = False
+        for node in tree.body:
+            if (isinstance(node, Assign)
+                and any(isinstance(t, Name) and t.id == '__all__'
+                        for t in node.targets)):
+                exports = True
+                fixed.update(n.s for n in walk(node.value)
+                             if isinstance(n, Str))
+
+        # Without __all__, another module might import any public name
+        # bound by an import (as for EliminateDeadCode.visit_ImportFrom),
+        # like os in "from shutil import os". Modules imported for
+        # their side effects stay where they are, as do modules built
+        # into the interpreter, which cost next to nothing to import.
+        from sys import builtin_module_names
+        keep = EliminateDeadCode.keep.union(keep, builtin_module_names)
+        self.imports = []       # List of (statement, alias, name, module).
+        for node in tree.body:
+            if isinstance(node, Import):
+                names = [(a, a.asname or a.name.split('.')[0], a.name)
+                         for a in node.names]
+            elif (isinstance(node, ImportFrom) and not node.level
+                  and node.names[0].name != '*'):
+                names = [(a, a.asname or a.name, node.module)
+                         for a in node.names]
+            else:
+                continue
+            for a, name, module in names:
+                if ((exports or name.startswith('_'))
+                    and name not in fixed
+                    and not any(module == k or module.startswith(k + '.')
+                                for k in keep)):
+                    self.imports.append((node, a, name, module))
+        self.names = set(name for _, _, name, _ in self.imports)
+        self.function = None    # The outermost function being visited.
+        self.visible = True     # Would it see new local variables?
+        self.shadowed = set()   # Names bound in the enclosing functions.
+        self.uses = dict()      # Name -> outermost functions using it.
+        self.blocked = set()    # Names that must stay at the top level.
+
+    def defer(self):
+        """Move the imports, and return a list of tuples (name, module,
+        functions) for the moved names.
+
+        """
+        if self.unknown or not self.imports:
+            return []
+        self.visit(self.tree)
+        moved = [(statement, a, name, module)
+                 for statement, a, name, module in self.imports
+                 if name in self.uses and name not in self.blocked]
+
+        # Import the names used by each function at its start (after
+        # its docstring), in the order of the original statements.
+        imports = dict()        # Function -> statement -> aliases.
+        for statement, a, name, _ in moved:
+            for f in self.uses[name]:
+                imports.setdefault(f, dict()).setdefault(
+                    statement, []).append(a)
+        statements = [node for node in self.tree.body
+                      if isinstance(node, (Import, ImportFrom))]
+        for f, aliases in imports.items():
+            body = []
+            for statement in statements:
+                if statement not in aliases:
+                    continue
+                if isinstance(statement, Import):
+                    node = Import(names=aliases[statement])
+                else:
+                    node = ImportFrom(module=statement.module,
+                                      names=aliases[statement], level=0)
+                body.append(fix_missing_locations(copy_location(node,
+                                                                statement)))
+            docstring = int(isinstance(f.body[0], Expr)
+                            and isinstance(f.body[0].value, Str))
+            f.body[docstring:docstring] = body
+
+        # Remove the moved names from the top-level imports.
+        removed = set(a for _, a, _, _ in moved)
+        body = []
+        for node in self.tree.body:
+            if node in statements:
+                node.names = [a for a in node.names if a not in removed]
+                if not node.names:
+                    continue
+            body.append(node)
+        self.tree.body = body
+        return [(name, module, len(self.uses[name]))
+                for _, _, name, module in moved]
+
+    def scope(self, node, nodes, fields):
+        # Visit the fields of node, which has its own scope binding the
+        # names bound by nodes.
+        shadowed = self.shadowed
+        self.shadowed = shadowed | set(bound_names(own_scope(nodes)))
+        for field in fields:
+            value = getattr(node, field)
+            for child in value if isinstance(value, list) else [value]:
+                self.visit(child)
+        self.shadowed = shadowed
+
+    def visit_Name(self, node):
+        name = node.id
+        if name not in self.names or name in self.shadowed:
+            return
+        elif self.function is None or not self.visible:
+            self.blocked.add(name)
+        elif self.function not in self.uses.setdefault(name, []):
+            self.uses[name].append(self.function)
+
+    def visit_FunctionDef(self, node):
+        for child in node.decorator_list + node.args.defaults:
+            self.visit(child)
+        if self.function is not None:
+            self.scope(node, [node.args] + node.body, ['body'])
+            return
+        # A new local variable (or free variable, in a nested function)
+        # would change the results of locals(), vars() and dir() with
+        # no arguments.
+        self.function = node
+        self.visible = not any(isinstance(n, Name)
+                               and n.id in ('locals', 'vars', 'dir')
+                               for n in walk(node))
+        self.scope(node, [node.args] + node.body, ['body'])
+        self.function = None
+        self.visible = True
+
+    def visit_GeneratorExp(self, node):
+        # The first iterable is evaluated in the enclosing scope.
+        self.visit(node.generators[0].iter)
+        self.scope(node, [g.target for g in node.generators],
+                   [f for f, _ in iter_fields(node)])
+
+    visit_DictComp = visit_SetComp = visit_GeneratorExp
+
+    def visit_Lambda(self, node):
+        for child in node.args.defaults:
+            self.visit(child)
+        self.scope(node, [node.args, node.body], ['body'])
+
+def defer_imports(tree, keep=(), init=False, stats=None):
+    """Speed up importing the module tree, by moving each top-level
+    import statement whose names are only used inside functions into
+    the outermost functions that use them, so that the modules are
+    only imported when they are first needed. An imported name is only
+    moved if:
+
+    * it's bound only by the import, and not declared global anywhere,
+      nor bound in a class body;
+    * it's used only inside functions (not in their default arguments
+      or decorators), none of which uses locals(), vars() or dir();
+    * it's not in __all__, and either the module has __all__ or the
+      name is private (like _os in "import os as _os"), so that other
+      modules don't import it;
+    * the import is of a module in neither EliminateDeadCode.keep nor
+      keep, nor built into the interpreter, and is absolute, and isn't
+      in a try statement or any other compound statement.
+
+    This is unsafe for a module imported for its side effects (for
+    example, registering a codec or patching another module), which
+    would then happen later, or never: the only protection is the
+    list of such modules in EliminateDeadCode.keep, so pass any others
+    in keep.
+
+    Nothing is moved in a package's __init__ module (if init is true),
+    where importing a submodule binds it in the package, nor in a
+    module that uses exec, globals() or "from module import *". If
+    stats is a dictionary, record in stats['deferred'] a list with a
+    dictionary for each moved name, giving its name, its module and
+    the number of functions it was moved into.
+
+    """
+    deferring = DeferImports(tree, keep, init)
+    deferred = deferring.defer()
+    if stats is not None:
+        stats['deferred'] = [dict(name=name, module=module,
+                                  functions=functions)
+                             for name, module, functions in deferred]
 
 def detect_encoding(filename):
     """Detect input encoding of Python source code by looking for the
@@ -1018,61 +3563,1061 @@ def detect_encoding(filename):
     if any, and the line containing the encoding cookie, if any.
 
     """
+    with open(filename, 'rb') as f:
+        return _detect_encoding(f.readline)
+
+def source_encoding(source):
+    """Like detect_encoding, but for Python source code in a string."""
+    from cStringIO import StringIO
+    return _detect_encoding(StringIO(source).readline)
+
+def _detect_encoding(readline):
     copied = ''
     coding_re = re.compile("#.*coding[:=]\s*([-\w.]+)")
-    with open(filename, 'rb') as f:
-        first = f.readline()
-        m = coding_re.search(first)
-        if first[:2] == '#!' or m:
-            copied = first
-        if not m:
-            second = f.readline()
-            m = coding_re.search(second)
-            if m:
-                copied += second
-        encoding = m.group(1) if m else 'latin1'
-        return encoding, copied
+    first = readline()
+    m = coding_re.search(first)
+    if first[:2] == '#!' or m:
+        copied = first
+    if not m:
+        second = readline()
+        m = coding_re.search(second)
+        if m:
+            copied += second
+    encoding = m.group(1) if m else 'latin1'
+    return encoding, copied
+
+class MinifyCache(object):
+    """Persistent cache of minified output, stored one entry per file in
+    a directory. Entries are keyed by a hash of their inputs and of the
+    minipy version. When the entries take up more than max_bytes, the
+    least recently used ones are evicted. If fingerprint is True,
+    minify also looks up entries by a hash of the parse tree, so that
+    changes to comments and whitespace still hit. The attributes hits
+    and misses count the lookups (one per module minified).
+
+    """
+    def __init__(self, directory, max_bytes=1 << 28, fingerprint=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self.hits = self.misses = 0
+        self.size = None
+
+    def __reduce__(self):
+        # Unpickle (say, in a worker process) to the process's shared
+        # instance, so that the counters and size are kept across jobs.
+        return open_cache, (self.directory, self.max_bytes, self.fingerprint)
+
+    def key(self, *parts):
+        from hashlib import sha1
+        h = sha1(__version__)
+        for p in parts:
+            h.update('{0}:'.format(len(p)))
+            h.update(p)
+        return h.hexdigest()
+
+    def path(self, key):
+        import os
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key, retry=False):
+        """Return the entry for key, or None if there is none. If retry
+        is true, the caller looks up another key when this one misses,
+        so the miss isn't counted.
+
+        """
+        import os
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += not retry
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store data as the entry for key."""
+        import os
+        from tempfile import mkstemp
+        path = self.path(key)
+        d = os.path.dirname(path)
+        try:
+            os.makedirs(d)
+        except OSError:
+            pass                # Already exists.
+        fd, tmp = mkstemp(dir=d, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """Generate triples (mtime, size, path) for the entries."""
+        import os
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if not f.startswith('.tmp'):
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue    # Evicted by another process.
+                    yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        """Remove least recently used entries until the cache is down to
+        three quarters of max_bytes (so that it is not evicting again
+        on the next put).
+
+        """
+        import os
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+_caches = dict()
+def open_cache(directory, max_bytes=1 << 28, fingerprint=False):
+    """Return the MinifyCache for the directory, creating it the first
+    time it is opened in this process.
+
+    """
+    key = directory, max_bytes, fingerprint
+    if key not in _caches:
+        _caches[key] = MinifyCache(directory, max_bytes, fingerprint)
+    return _caches[key]
+
+def split_statements(readline):
+    """Read Python source code a line at a time by calling readline, and
+    generate pairs (source, lineno), where source contains one or more
+    complete top-level statements (together with any comments and
+    blank lines before them), and lineno is the number of its first
+    line.
+
+    """
+    import tokenize
+    lines = []
+    first = 1                   # Line number of lines[0].
+    def read():
+        line = readline()
+        lines.append(line)
+        return line
+    ignored = tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER
+    depth = 0                   # Indentation depth.
+    start = True                # Next token starts a logical line?
+    decorator = False           # Last top-level logical line was a decorator?
+    for kind, text, (row, _), _, _ in tokenize.generate_tokens(read):
+        if kind == tokenize.INDENT:
+            depth += 1
+        elif kind == tokenize.DEDENT:
+            depth -= 1
+        elif kind == tokenize.NEWLINE:
+            start = True
+        elif kind not in ignored and start:
+            start = False
+            if depth == 0:
+                if (row > first and not decorator
+                    and text not in ('elif', 'else', 'except', 'finally')):
+                    yield ''.join(lines[:row - first]), first
+                    del lines[:row - first]
+                    first = row
+                decorator = text == '@'
+    rest = ''.join(lines)
+    if rest.strip():
+        yield rest, first
+
+def parse_statements(readline, encoding='latin1', filename='<unknown>'):
+    """Read Python source code a line at a time by calling readline, and
+    generate pairs (tree, flags), where each tree is the parse tree for
+    some of the top-level statements, and flags are the compiler flags
+    for the future features in effect. The source is parsed as if it
+    were declared to be in the given encoding (see detect_encoding).
+
+    """
+    import __future__
+    cookie = '# -*- coding: {0} -*-\n'.format(encoding)
+    def future(node):
+        return isinstance(node, ImportFrom) and node.module == '__future__'
+    def prologue(node):
+        return future(node) or isinstance(node, Expr) and isinstance(node.value, Str)
+    def features(tree, flags):
+        for node in filter(future, tree.body):
+            for a in node.names:
+                feature = getattr(__future__, a.name, None)
+                if feature:
+                    flags |= feature.compiler_flag
+        return flags
+    flags = 0
+    held = []               # Statements that might precede a future import.
+    for source, lineno in split_statements(readline):
+        if held or lineno == 1:
+            # A future statement affects the parsing of the whole module,
+            # including the docstring, so hold on to the docstring and
+            # future statements until we reach the end of them, and
+            # parse them together with the statements that follow.
+            held.append((source, lineno))
+            source, lineno = ''.join(s for s, _ in held), held[0][1]
+            tree = compile(cookie + source, filename, 'exec', PyCF_ONLY_AST)
+            if all(map(prologue, tree.body)):
+                continue
+            held = []
+        else:
+            tree = compile(cookie + source, filename, 'exec',
+                           PyCF_ONLY_AST | flags)
+        increment_lineno(tree, lineno - 2)
+        flags = features(tree, flags)
+        yield tree, flags
+    if held:
+        # The module is all docstring and future statements.
+        increment_lineno(tree, held[0][1] - 2)
+        yield tree, features(tree, flags)
+
+def bytes_literal(data):
+    """Return a string literal for the byte string data, escaping only
+    the bytes that must be escaped in a source file in Latin-1.
+
+    """
+    quote = "'" if data.count("'") <= data.count('"') else '"'
+    escapes = {'\\': r'\\', '\n': r'\n', '\r': r'\r', quote: '\\' + quote}
+
+    def escape(m):
+        c = m.group(1)
+        if c == '\0':
+            return r'\000' if m.group(2).isdigit() else r'\0'
+        return escapes[c]
+
+    pattern = r'([\\\n\r\0{0}])(?=(.?))'.format(quote)
+    return quote + re.sub(pattern, escape, data, flags=re.S) + quote
+
+def compress_source(source, copied='', encoding='latin1', stats=None):
+    """Return the shortest self-extracting form of the Python source code
+    in the string source (encoded in encoding), preceded by copied, the
+    #! and coding lines from detect_encoding: a statement that
+    decompresses the source (with zlib or bz2) from a string literal
+    (base64, or raw bytes if the file can be in Latin-1), and executes
+    it. Or, if none of these is shorter, return the source as it is.
+
+    If stats is a dictionary, record in it under the key 'compress' a
+    dictionary giving the chosen form (or None), the sizes before and
+    after, and the time taken to decompress and compile the source,
+    which is added to the time taken to import a module in that form.
+    (A module's .pyc file only holds the decompressing statement.)
+
+    """
+    import bz2
+    import codecs
+    import zlib
+    from base64 import b64encode
+    best = copied + source + '\n'
+    chosen = None
+    # The coding line is needed to decode the source, but a file with a
+    # raw literal must be in Latin-1.
+    payload = copied + source
+    raw_header = None
+    if not re.search(r'coding[:=]', copied):
+        raw_header = copied + '#coding:latin1\n'
+    elif codecs.lookup(encoding).name == 'iso8859-1':
+        raw_header = copied
+    for module, compress in (('zlib', lambda s: zlib.compress(s, 9)),
+                             ('bz2', lambda s: bz2.compress(s, 9))):
+        data = compress(payload)
+        forms = [('base64', copied,
+                  "{0!r}.decode('base64')".format(b64encode(data)))]
+        if raw_header is not None:
+            forms.append(('raw', raw_header, bytes_literal(data)))
+        for literal, header, expr in forms:
+            result = "{0}exec __import__('{1}').decompress({2})\n".format(
+                header, module, expr)
+            if len(result) < len(best):
+                best, chosen = result, (module, literal, data)
+    if stats is not None:
+        info = stats['compress'] = dict(form=None, bytes_before=len(
+                copied + source + '\n'), bytes_after=len(best))
+        if chosen:
+            from time import time
+            module, literal, data = chosen
+            start = time()
+            decompressed = __import__(module).decompress(data)
+            middle = time()
+            compile(decompressed, '<string>', 'exec', 0, True)
+            end = time()
+            info.update(form=module + '+' + literal,
+                        decompress_seconds=middle - start,
+                        compile_seconds=end - middle)
+    return best
+
+def _dump_modules(modules):
+    for tree, flags in modules:
+        stderr.write(dump(tree))
+        stderr.write('\n')
+        yield tree, flags
 
 def minify(filename, debug=False, preserve='', output=stdout, rename=False,
-           **kwargs):
+           cache=None, index=None, stream=False, stats=None, package=None,
+           scoped=False, fold=False, deadcode=False, keep_imports='',
+           compress=False, target='raw', pyc=None, hoist=False,
+           localize=False, chains=False, defer=False, **kwargs):
     """Read Python code from the file named by the first argument, and
     write a minified version to standard output. Takes keyword
     arguments:
 
+    cache    -- MinifyCache, or name of the cache directory, in which to
+                look up and store the output (default: None, meaning
+                don't use a cache)
+    compress -- Compress the output into a self-extracting form, if that
+                is smaller: see compress_source (default: False)
+    deadcode -- Remove code that can't run, unused private functions and
+                unused imports (default: False)
     debug    -- Dump the parse tree to stderr (default: False)
+    defer    -- Move imports whose names are only used inside functions
+                into those functions, to make importing the module
+                faster: see defer_imports (default: False)
+    fold     -- Fold constant expressions, and replace module constants
+                (assigned once, with names in upper case) by their
+                values, where that's no longer (default: False)
+    chains   -- Bind the constants of imported modules (like
+                errno.EINTR) to short names, where that's shorter: see
+                alias_chains (default: False)
+    hoist    -- Bind repeated literals to short names, where that's
+                shorter: see hoist_literals (default: False)
+    localize -- Look up the global names and functions and methods used
+                in loops in functions once, before the loop, to make
+                the loops faster: see localize_loops (default: False)
+    index    -- ExportIndex, or name of the index file, recording the
+                names exported by imported modules (default: None,
+                meaning keep them in memory for the life of the process)
+    keep_imports -- String containing the names of modules, joined by
+                commas, that are imported for the side effects of
+                importing them, so their imports are kept (when
+                deadcode=True) and not moved (when defer=True; default:
+                the empty string)
     preserve -- String containing additional names to preserve (when
                 rename=True), joined by commas (default: the empty
                 string, meaning preserve no additional names)
-    output   -- File to write output to, or filename (default: stdout)
+    output   -- File to write output to, or filename (default: stdout),
+                or None to write only the bytecode (see pyc)
+    package  -- Package containing the file, whose mapping is used to
+                rename it (when rename=True) consistently with the
+                other modules in the package; preserve, index and
+                target are then ignored, as Package.analyse has already
+                used them
+                (default: None, meaning rename the file on its own)
+    pyc      -- File to write the compiled output to as bytecode, or
+                filename: see write_bytecode (default: None, meaning
+                don't compile it)
     rename   -- Rename non-preserved variables (default: False)
+    scoped   -- Rename the variables local to each function separately,
+                so that they can reuse the shortest names (when
+                rename=True and package=None; default: False)
+    stats    -- Dictionary in which to record statistics (default: None,
+                meaning don't record them). See below.
+    target   -- 'raw' to rename for the smallest output, or 'gzip' for
+                the smallest output after compression (when rename=True
+                and package=None): see rename_ast (default: 'raw')
+    stream   -- Parse, serialize and write the top-level statements one
+                at a time, so that memory use depends on the size of the
+                largest statement rather than the size of the file. Not
+                compatible with rename, cache, fold, deadcode, defer,
+                chains, hoist, localize, compress or pyc. (default:
+                False)
 
     The remaining keyword arguments are passed to serialize_ast.
 
+    The statistics are: bytes_in and bytes_out; seconds, a dictionary
+    mapping the name of each phase to its wall time; nodes, a
+    dictionary mapping the name of each type of node in the parse tree
+    to the number of occurrences; and if renaming, reserved, the number
+    of reserved names, and renamed and kept, the number of names that
+    were and were not renamed; if deferring imports, deferred (see
+    defer_imports); if aliasing chains, chains (see alias_chains); if
+    hoisting, hoist (see hoist_literals); if localizing, localized (see
+    localize_loops); and if compressing, compress (see
+    compress_source). On a cache hit there is no parse tree, so only
+    the sizes and times are recorded.
+
     """
-    encoding, copied = detect_encoding(filename)
-    tree = parse(open(filename).read())
-    if debug:
-        stderr.write(dump(tree))
-        stderr.write('\n')
-    if rename:
-        r = reserved_names_in_ast(tree)
-        if preserve:
-            r.update(preserve.split(','))
-        rename_ast(tree, r)
-    minified = serialize_ast(tree, encoding=encoding, **kwargs)
+    from time import time
+    if stats is not None:
+        stats['seconds'] = dict()
+    phase = _phase_timer(stats)
+    t = time()
+    if stream:
+        if (rename or cache is not None or fold or deadcode or defer
+            or chains or hoist or localize or compress or pyc is not None):
+            raise ValueError("stream is not compatible with rename, cache, "
+                             "fold, deadcode, defer, chains, hoist, "
+                             "localize, compress or pyc")
+        encoding, copied = detect_encoding(filename)
+        t = phase('detect_encoding', t)
+        if not hasattr(output, 'write'):
+            output = open(output, 'wb')
+        bytes_out = [0]
+
+        def write(data):
+            bytes_out[0] += len(data)
+            output.write(data)
+
+        def counted(modules):
+            for tree, flags in modules:
+                _count_nodes(stats, tree)
+                yield tree, flags
+
+        write(copied)
+        with open(filename) as f:
+            modules = parse_statements(f.readline, encoding, filename)
+            if debug:
+                modules = _dump_modules(modules)
+            if stats is not None:
+                modules = counted(modules)
+            SerializeVisitor(encoding=encoding, **kwargs).serialize_stream(
+                modules, write)
+            bytes_in = f.tell()
+        write('\n')
+        phase('stream', t)
+        if stats is not None:
+            stats.update(bytes_in=bytes_in, bytes_out=bytes_out[0])
+        return
+    source = open(filename).read()
+    phase('read', t)
+    minify_source(source, output, filename, debug=debug, preserve=preserve,
+                  rename=rename, cache=cache, index=index, stats=stats,
+                  package=package, scoped=scoped, fold=fold,
+                  deadcode=deadcode, keep_imports=keep_imports,
+                  compress=compress, target=target, pyc=pyc, hoist=hoist,
+                  localize=localize, chains=chains, defer=defer, **kwargs)
+
+def minify_source(data, output=None, filename='<string>', debug=False,
+                  preserve='', rename=False, cache=None, index=None,
+                  stats=None, package=None, scoped=False, fold=False,
+                  deadcode=False, keep_imports='', compress=False,
+                  target='raw', pyc=None, hoist=False, localize=False,
+                  chains=False, defer=False, **kwargs):
+    """Minify the Python code in data, which is a string or a buffer
+    such as a memoryview or mmap (read once, and not otherwise
+    touched), with its encoding detected from the encoding cookie as by
+    detect_encoding. If data is unicode, it's encoded as its encoding
+    cookie says or, without one, as UTF-8, adding a cookie if it isn't
+    all ASCII. If output is None, return the minified code;
+    otherwise write it to output (a file or filename) and return None.
+    filename names the module (for package, for recognizing __init__.py
+    when deadcode=True, and in the bytecode if pyc is not the name of a
+    .pyc file). The other keyword arguments and the statistics are as
+    for minify.
+
+    """
+    import os
+    from time import time
+    init = os.path.basename(filename) == '__init__.py'
+    if isinstance(data, memoryview):
+        source = data.tobytes()
+    elif isinstance(data, str):
+        source = data
+    elif isinstance(data, unicode):
+        encoded = data.encode('utf-8')
+        encoding, copied = source_encoding(encoded)
+        if re.search("#.*coding[:=]", copied):
+            source = data.encode(encoding)
+        elif len(encoded) == len(data):    # It's all ASCII.
+            source = encoded
+        else:
+            # The cookie goes after the #! line, if any.
+            source = (copied + '# -*- coding: utf-8 -*-\n'
+                      + encoded[len(copied):])
+    else:
+        source = str(data[:])
+    if stats is not None:
+        stats.setdefault('seconds', dict())
+    phase = _phase_timer(stats)
+    t = time()
+    result = checked = None
+    missed = []                 # Cache keys that missed.
+    if cache is not None:
+        if not isinstance(cache, MinifyCache):
+            cache = open_cache(cache)
+        options = preserve, rename, sorted(kwargs.items())
+        if package is not None:
+            # Imports within the package depend on where the module is.
+            options += (sorted(package.mapping.items()),
+                        sorted(package.modules),
+                        package.names.get(os.path.abspath(filename)))
+        if scoped:
+            options += 'scoped',
+        if fold:
+            options += 'fold',
+        if deadcode:
+            options += 'deadcode', keep_imports, init
+        if defer:
+            options += 'defer', keep_imports, init
+        if chains:
+            options += 'chains',
+        if hoist:
+            options += 'hoist',
+        if localize:
+            options += 'localize',
+        if compress:
+            options += 'compress',
+        if target != 'raw':
+            options += target,
+        options = repr(options)
+        missed.append(cache.key(source, options))
+        result = cache.get(missed[-1], retry=cache.fingerprint)
+        t = phase('cache', t)
+    if result is None:
+        encoding, copied = source_encoding(source)
+        t = phase('detect_encoding', t)
+        tree = parse(source)
+        t = phase('parse', t)
+        if cache is not None and cache.fingerprint:
+            key = cache.key(copied, dump(tree), options)
+            result = cache.get(key)
+            if result is None:
+                missed.append(key)
+            t = phase('cache', t)
+        if result is None:
+            _count_nodes(stats, tree)
+            if debug:
+                stderr.write(dump(tree))
+                stderr.write('\n')
+            t = time()
+            if fold:
+                constants = module_constants(tree)
+            if deadcode:
+                private = private_functions(tree)
+            if localize:
+                if not isinstance(index, ExportIndex):
+                    index = open_index(index)
+                localize_loops(tree, index, stats)
+                index.save()
+                t = phase('localize_loops', t)
+            renaming = None
+            if rename and package is not None:
+                renaming = package.renaming(filename, tree)
+                t = phase('rename_ast', t)
+            elif rename:
+                if not isinstance(index, ExportIndex):
+                    index = open_index(index)
+                renaming = find_renaming(
+                    tree, preserve.split(',') if preserve else (), stats,
+                    scoped=scoped, target=target, reserve=FindReserved(index))
+                index.save()
+                t = phase('rename_ast', t)
+            if fold:
+                fold_constants(tree, constants, encoding, renaming)
+                t = phase('fold_constants', t)
+            if deadcode:
+                eliminate_dead_code(
+                    tree, private, filter(None, (keep_imports or '').split(',')),
+                    filter(None, (preserve or '').split(',')), init)
+                t = phase('eliminate_dead_code', t)
+            if defer:
+                defer_imports(
+                    tree, filter(None, (keep_imports or '').split(',')), init,
+                    stats)
+                t = phase('defer_imports', t)
+            if chains:
+                if not isinstance(index, ExportIndex):
+                    index = open_index(index)
+                alias_chains(tree, index, encoding, renaming, stats)
+                index.save()
+                t = phase('alias_chains', t)
+            if hoist:
+                hoist_literals(tree, encoding, renaming, stats)
+                t = phase('hoist_literals', t)
+            visitor = SerializeVisitor(encoding=encoding, renaming=renaming,
+                                       **kwargs)
+            minified = visitor.unparse(tree)
+            t = phase('serialize', t)
+            checked = visitor.test(tree, minified)
+            t = phase('selftest', t)
+            if compress:
+                result = compress_source(minified, copied, encoding, stats)
+                checked = None
+                t = phase('compress', t)
+            else:
+                result = copied + minified + '\n'
+        if missed:
+            for key in missed:
+                cache.put(key, result)
+            t = phase('cache', t)
+    if stats is not None:
+        stats.update(bytes_in=len(source), bytes_out=len(result))
+    mtime = None
+    if output is not None:
+        if not hasattr(output, 'write'):
+            output = open(output, 'wb')
+        output.write(result)
+        if pyc is not None and hasattr(output, 'fileno'):
+            import stat
+            output.flush()
+            st = os.fstat(output.fileno())
+            if stat.S_ISREG(st.st_mode):
+                mtime = st.st_mtime
+        t = phase('write', t)
+    if pyc is not None:
+        if checked is not None:
+            # Compile the parse tree from the self-test rather than
+            # parsing the output again.
+            increment_lineno(checked, copied.count('\n'))
+            code = checked
+        else:
+            code = result
+        if isinstance(pyc, str) and pyc.endswith(('.pyc', '.pyo')):
+            code = compile(code, pyc[:-1], 'exec')
+        else:
+            code = compile(code, filename, 'exec')
+        write_bytecode(code, pyc, mtime)
+        phase('bytecode', t)
+    if output is None:
+        return result
+
+def write_bytecode(code, output, mtime=None):
+    """Write the code object to output (a file or filename) in the
+    format of a .pyc file: the magic number, the modification time of
+    the source (mtime, default: now), and the marshalled code. Python
+    only imports a .pyc next to its source if the times match, but
+    imports one without a source whatever its time.
+
+    """
+    from imp import get_magic
+    from marshal import dumps
+    from struct import pack
+    from time import time
+    if mtime is None:
+        mtime = time()
     if not hasattr(output, 'write'):
         output = open(output, 'wb')
-    output.write(copied)
-    output.write(minified)
-    output.write('\n')
+    output.write(get_magic() + pack('<I', int(mtime) & 0xFFFFFFFF)
+                 + dumps(code))
+
+def _phase_timer(stats):
+    # Return a function phase(name, start) that adds the time since
+    # start to the named phase in stats['seconds'] (if stats is not
+    # None), and returns the time.
+    from time import time
+    seconds = dict() if stats is None else stats['seconds']
+
+    def phase(name, start):
+        now = time()
+        seconds[name] = seconds.get(name, 0.0) + now - start
+        return now
+    return phase
+
+def _count_nodes(stats, tree):
+    # Count the nodes in tree by type in stats['nodes'] (if stats is
+    # not None).
+    if stats is not None:
+        from collections import Counter
+        nodes = stats.setdefault('nodes', Counter())
+        nodes.update(type(n).__name__ for n in walk(tree))
+
+def find_sources(paths, outdir):
+    """Generate pairs (source, destination) for the Python files named by
+    the list paths. A directory is searched recursively for files
+    ending in .py and its structure is mirrored under outdir; a file
+    is copied to outdir under its own base name.
 
-def main():
-    # Handle command-line arguments.
+    """
+    import os
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.join(outdir, os.path.basename(path))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith('.py'):
+                    source = os.path.join(root, f)
+                    rel = os.path.relpath(source, path)
+                    yield source, os.path.join(outdir, rel)
+
+class MinifyTimeout(BaseException):
+    """Raised when minifying a file takes too long. Like
+    KeyboardInterrupt, it's not an Exception, so that the handlers for
+    Exception in the passes (like FoldConstants.fold) don't catch it.
+
+    """
+
+def _raise_timeout(signum, frame):
+    raise MinifyTimeout()
+
+def minify_job(job):
+    """Minify one file for minify_files and return its manifest entry.
+    The argument is a tuple (source, destination, timeout, stats,
+    kwargs).
+
+    """
+    import os
+    import signal
+    from time import time
+    source, destination, timeout, stats, kwargs = job
+    kwargs = dict(kwargs)
+    bytecode = kwargs.pop('bytecode', False)
+    if bytecode:
+        kwargs['pyc'] = destination + 'c'
+    entry = dict(input=source, output=destination,
+                 bytes_in=os.path.getsize(source), bytes_out=0,
+                 status='ok')
+    if bytecode == 'only':
+        destination = entry['output'] = kwargs['pyc']
+    cache = kwargs.get('cache')
+    if cache is not None:
+        hits = cache.hits
+    start = time()
+    timer = timeout and hasattr(signal, 'setitimer')
+    if timer:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        try:
+            d = os.path.dirname(destination)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            if bytecode == 'only':
+                minify(source, output=None, stats=stats, **kwargs)
+            else:
+                with open(destination, 'wb') as f:
+                    minify(source, output=f, stats=stats, **kwargs)
+        finally:
+            if timer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        entry['bytes_out'] = os.path.getsize(destination)
+        if cache is not None:
+            entry['cache'] = 'hit' if cache.hits > hits else 'miss'
+    except MinifyTimeout:
+        entry['status'] = 'timeout'
+    except Exception as e:
+        entry['status'] = 'error'
+        entry['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    if entry['status'] != 'ok':
+        for f in (destination, kwargs.get('pyc')):
+            if f and os.path.exists(f):
+                os.remove(f)
+    entry['seconds'] = time() - start
+    if stats is not None:
+        entry['stats'] = stats
+    return entry
+
+def minify_files(paths, outdir, jobs=None, timeout=None, manifest=None,
+                 stats=False, **kwargs):
+    """Minify the Python files named by the list paths (files or
+    directories, which are searched recursively) into the directory
+    outdir, mirroring the directory structure. Return a list of
+    manifest entries, one for each file, in the order the files were
+    found. Takes keyword arguments:
+
+    jobs     -- Number of worker processes (default: None, meaning one
+                per CPU). With jobs=1 the files are minified in this
+                process.
+    timeout  -- Number of seconds after which to abandon a file
+                (default: None, meaning no limit)
+    manifest -- File to write the manifest to as JSON, or filename
+                (default: None, meaning don't write it)
+    stats    -- Record statistics for each file (default: False)
+    bytecode -- True to write the compiled bytecode of each file as
+                well, to its destination with 'c' appended, or 'only'
+                to write just that (default: False)
+
+    The remaining keyword arguments are passed to minify. Each
+    manifest entry is a dictionary with keys input, output, bytes_in,
+    bytes_out, seconds and status (one of 'ok', 'timeout' or 'error',
+    in which case the key error describes the exception). If a cache
+    is used, the key cache says whether the file was a 'hit' or a
+    'miss'. If stats=True, the key stats has the statistics recorded
+    by minify.
+
+    """
+    import os
+    if kwargs.get('cache') is not None and not isinstance(kwargs['cache'],
+                                                          MinifyCache):
+        kwargs['cache'] = open_cache(kwargs['cache'])
+    sources = list(find_sources(paths, outdir))
+    order = dict((s, i) for i, (s, _) in enumerate(sources))
+    # Start the largest files first so that a big file found late does
+    # not hold up the end of the run.
+    work = sorted(((s, d, timeout, dict() if stats else None, kwargs)
+                   for s, d in sources),
+                  key=lambda job: -os.path.getsize(job[0]))
+    if jobs == 1:
+        entries = map(minify_job, work)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        try:
+            entries = list(pool.imap_unordered(minify_job, work, 1))
+        finally:
+            pool.close()
+            pool.join()
+    entries.sort(key=lambda e: order[e['input']])
+    if manifest is not None:
+        import json
+        if not hasattr(manifest, 'write'):
+            manifest = open(manifest, 'w')
+        json.dump(entries, manifest, indent=1, sort_keys=True)
+        manifest.write('\n')
+    return entries
+
+# The start of a bundle written by write_bundle: an importer for the
+# modules in the bundle, each a pair (is_package, marshalled code).
+_bundle_importer = '''import imp, marshal, os, sys
+
+class BundleImporter(object):
+    """Import the modules in a bundle written by minipy."""
+    def __init__(self, modules):
+        self.modules = modules
+
+    def find_module(self, name, path=None):
+        if name in self.modules:
+            return self
+
+    def load_module(self, name):
+        if name in sys.modules:
+            return sys.modules[name]
+        package, code = self.modules[name]
+        module = imp.new_module(name)
+        path = os.path.join(__file__, *name.split('.'))
+        module.__loader__ = self
+        if package:
+            module.__file__ = os.path.join(path, '__init__.py')
+            module.__path__ = [path]
+            module.__package__ = name
+        else:
+            module.__file__ = path + '.py'
+            module.__package__ = name.rpartition('.')[0] or None
+        sys.modules[name] = module
+        try:
+            exec marshal.loads(code) in module.__dict__
+        except:
+            del sys.modules[name]
+            raise
+        return module
+
+sys.meta_path.insert(0, BundleImporter({
+'''
+
+def write_bundle(modules, output):
+    """Write a bundle of modules to output (a file or filename): a
+    Python module that, when imported, installs an import hook (on
+    sys.meta_path) that imports the modules from the bundle. The
+    argument modules is a list of pairs (name, source), where name is
+    the dotted name of the module (ending with ".__init__" for a
+    package) and source is its source code. The modules are compiled
+    now, so importing them only needs the bundle, which is read from
+    one file and compiled once.
+
+    """
+    from marshal import dumps
+    if not hasattr(output, 'write'):
+        output = open(output, 'wb')
+    output.write(_bundle_importer)
+    for name, source in modules:
+        filename = name.replace('.', '/') + '.py'
+        package = name.endswith('.__init__')
+        if package:
+            name = name[:-len('.__init__')]
+        code = compile(source, filename, 'exec', 0, True)
+        output.write('{0!r}: ({1!r}, {2!r}),\n'.format(
+                name, package, dumps(code)))
+    output.write('}))\n')
+
+def bundle(paths, output, **kwargs):
+    """Minify the Python files named by the list paths (files or
+    directories, which are searched recursively), and write them to
+    output (a file or filename) as a bundle: see write_bundle. Each
+    module is named according to the packages containing it (see
+    module_name). Takes the same keyword arguments as minify_files,
+    and returns the list of manifest entries. Only the files that
+    were minified successfully are in the bundle.
+
+    """
+    import os
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    outdir = mkdtemp()
+    try:
+        entries = minify_files(paths, outdir, **kwargs)
+        write_bundle([(module_name(e['input']), open(e['output']).read())
+                      for e in entries if e['status'] == 'ok'], output)
+    finally:
+        rmtree(outdir)
+    return entries
+
+def read_frame(f):
+    """Read a request or response from the file f and return it, or None
+    at end of file. Each is a JSON object, preceded by a line giving
+    its length in bytes.
+
+    """
+    import json
+    line = '\n'
+    while line.isspace():
+        line = f.readline()
+    if not line:
+        return None
+    return json.loads(f.read(int(line)))
+
+def write_frame(f, obj):
+    """Write a request or response to the file f (see read_frame)."""
+    import json
+    data = json.dumps(obj)
+    f.write('{0}\n{1}'.format(len(data), data))
+    f.flush()
+
+def serve_request(request):
+    """Handle a server request and return the response. The request is
+    a dictionary with keys:
+
+    id       -- Identifier copied to the response (optional)
+    filename -- Name of the file to minify
+    source   -- Code to minify instead of the file, decoded as latin1
+                (optional; filename then only names the module, and may
+                be omitted)
+    options  -- Dictionary of keyword arguments for minify (optional)
+    argv     -- Command-line arguments, as for minipy with --socket but
+                without --output, giving the filename and options
+                instead (optional; used by minipy_client.py)
+    cwd      -- Directory relative to which to find the filename in
+                argv (optional)
+
+    The response has the key id and either output (the minified code,
+    decoded as latin1) or error (describing the exception).
+
+    """
+    import os
+    from StringIO import StringIO
+    response = dict(id=request.get('id'))
+    try:
+        output = StringIO()
+        if 'argv' in request:
+            def error(message):
+                raise ValueError(message)
+            p = option_parser(add_help_option=False, version=None)
+            p.error = error
+            opts, args = p.parse_args(list(request['argv']))
+            filename, options = server_options(opts, args, error)
+            filename = os.path.join(request.get('cwd', ''), filename)
+        else:
+            filename = request.get('filename')
+            options = dict(request.get('options', ()))
+        options.pop('debug', None)
+        if 'source' in request:
+            minify_source(request['source'].encode('latin1'), output,
+                          filename or '<string>', **options)
+        else:
+            minify(filename, output=output, **options)
+        response['output'] = output.getvalue().decode('latin1')
+    except Exception as e:
+        response['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    return response
+
+def serve_connection(rfile, wfile, pool):
+    """Read requests from rfile until end of file, hand them to the
+    worker pool, and write each response to wfile as soon as it is
+    ready (so not necessarily in the order of the requests).
+
+    """
+    from threading import Lock
+    lock = Lock()
+    def respond(response):
+        with lock:
+            write_frame(wfile, response)
+    pending = []
+    while True:
+        request = read_frame(rfile)
+        if request is None:
+            break
+        pending.append(pool.apply_async(serve_request, (request,),
+                                        callback=respond))
+    for p in pending:
+        p.wait()
+
+def serve(socket_path=None, jobs=None):
+    """Run a minify server, keeping the reserved names and module
+    exports loaded between requests. Requests (see serve_request) are
+    handled by a pool of jobs worker processes (default: one per CPU).
+    If socket_path is None, read requests from standard input and
+    write responses to standard output; otherwise, listen for
+    connections on a Unix socket at socket_path.
+
+    """
+    from multiprocessing import Pool
+    from threading import Thread
+    pool = Pool(jobs)
+    try:
+        if socket_path is None:
+            serve_connection(stdin, stdout, pool)
+            return
+        import os
+        import signal
+        import socket
+        # Exit cleanly on SIGTERM so that the socket is removed.
+        signal.signal(signal.SIGTERM, lambda *_: exit(0))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        try:
+            listener.listen(64)
+            while True:
+                conn, _ = listener.accept()
+                t = Thread(target=serve_connection,
+                           args=(conn.makefile('rb'), conn.makefile('wb'), pool))
+                t.daemon = True
+                t.start()
+                conn.close()    # The thread has its own file objects.
+        finally:
+            listener.close()
+            os.remove(socket_path)
+    finally:
+        pool.close()
+        pool.join()
+
+def client(socket_path, filename, **kwargs):
+    """Ask the server listening on the Unix socket at socket_path to
+    minify the file named by the second argument, and return the
+    result. The keyword arguments are passed to minify.
+
+    """
+    import os
+    import socket
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    try:
+        write_frame(conn.makefile('wb'),
+                    dict(filename=os.path.abspath(filename), options=kwargs))
+        conn.shutdown(socket.SHUT_WR)
+        response = read_frame(conn.makefile('rb'))
+    finally:
+        conn.close()
+    if response is None:
+        raise IOError("no response from server")
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['output'].encode('latin1')
+
+def option_parser(**kwargs):
+    """Return a parser for the command-line options of minipy. The
+    keyword arguments are passed to optparse.OptionParser.
+
+    """
     import optparse
-    p = optparse.OptionParser(usage="usage: %prog [options] [-o OUTPUT] FILE",
-                              version='%prog {0}'.format(__version__))
+    kwargs.setdefault('version', '%prog {0}'.format(__version__))
+    p = optparse.OptionParser(usage="usage: %prog [options] [-o OUTPUT] FILE\n"
+                              "       %prog [options] -o OUTDIR FILE|DIR ...",
+                              **kwargs)
     p.add_option('--output', '-o', default=stdout,
-                 help="output file (default: stdout)")
+                 help="output file, or directory when minifying several "
+                 "files or a directory (default: stdout)")
     p.add_option('--docstrings', '-D',
                  action='store_true', default=False,
                  help="remove docstrings and other statements with no side effects "
@@ -1083,6 +4628,10 @@ def main():
     p.add_option('--indent', '-i',
                  type='int', default=1,
                  help="number of spaces per indentation level")
+    p.add_option('--tabs',
+                 action='store_true', default=False,
+                 help="indent with a tab for each 8 spaces, which saves "
+                 "bytes in deeply nested code (rejected by python -tt)")
     p.add_option('--preserve', '-p',
                  help="preserve words from renaming (separate by commas)")
     p.add_option('--nojoinlines', dest='joinlines',
@@ -1094,10 +4643,201 @@ def main():
     p.add_option('--debug',
                  action='store_true', default=False,
                  help="dump the parse tree")
-    opts, args = p.parse_args()
+    p.add_option('--jobs', '-j',
+                 type='int', default=None,
+                 help="number of worker processes when minifying several "
+                 "files (default: one per CPU)")
+    p.add_option('--timeout',
+                 type='float', default=None,
+                 help="abandon a file after this many seconds when "
+                 "minifying several files")
+    p.add_option('--manifest',
+                 help="write a JSON manifest of input and output sizes "
+                 "when minifying several files")
+    p.add_option('--stream',
+                 action='store_true', default=False,
+                 help="minify one top-level statement at a time, to save "
+                 "memory on huge files (not compatible with --rename, "
+                 "--fold, --deadcode, --defer, --chains, --hoist, "
+                 "--localize, --compress or --pyc)")
+    p.add_option('--fold',
+                 action='store_true', default=False,
+                 help="fold constant expressions and replace module "
+                 "constants by their values, where that's shorter")
+    p.add_option('--deadcode',
+                 action='store_true', default=False,
+                 help="remove code that can't run, unused private functions "
+                 "and unused imports")
+    p.add_option('--keep-imports',
+                 help="with --deadcode or --defer, modules imported for "
+                 "their side effects, whose imports are kept where they "
+                 "are (separate by commas)")
+    p.add_option('--defer',
+                 action='store_true', default=False,
+                 help="make importing the module faster by moving imports "
+                 "that are only used inside functions into those functions")
+    p.add_option('--chains',
+                 action='store_true', default=False,
+                 help="bind constants of imported modules, like "
+                 "errno.EINTR, to short names after the import, where "
+                 "that's shorter")
+    p.add_option('--hoist',
+                 action='store_true', default=False,
+                 help="bind repeated literals to short names at the top "
+                 "of the module, where that's shorter")
+    p.add_option('--localize',
+                 action='store_true', default=False,
+                 help="make loops in functions faster by looking up global "
+                 "names and the functions and methods they call before "
+                 "the loop")
+    p.add_option('--compress',
+                 action='store_true', default=False,
+                 help="compress the output into a self-extracting form, "
+                 "if that is smaller")
+    p.add_option('--pyc', dest='bytecode',
+                 action='store_const', const=True, default=False,
+                 help="also write the compiled bytecode to OUTPUT with 'c' "
+                 "appended (or alongside each output file)")
+    p.add_option('--pyc-only', dest='bytecode',
+                 action='store_const', const='only',
+                 help="write only the compiled bytecode, to OUTPUT with 'c' "
+                 "appended (or instead of each output file)")
+    p.add_option('--index',
+                 help="file in which to record the names exported by "
+                 "imported modules")
+    p.add_option('--scoped',
+                 action='store_true', default=False,
+                 help="with --rename, rename the variables local to each "
+                 "function separately, so they can reuse short names")
+    p.add_option('--target',
+                 type='choice', choices=['raw', 'gzip'], default='raw',
+                 help="with --rename, choose names to make the output "
+                 "smallest as it is (raw) or when compressed (gzip)")
+    p.add_option('--package',
+                 action='store_true', default=False,
+                 help="with --rename, rename consistently across all the "
+                 "files, as modules of one package")
+    p.add_option('--mapping',
+                 help="with --package, write the renaming to this file "
+                 "as JSON")
+    p.add_option('--bundle',
+                 help="write the minified files to this file as a bundle: "
+                 "a module that, when imported, imports them from itself")
+    p.add_option('--cache',
+                 help="directory in which to cache minified output")
+    p.add_option('--cache-ast',
+                 action='store_true', default=False,
+                 help="also look up the cache by parse tree, so that changes "
+                 "to comments and whitespace still hit")
+    p.add_option('--stats',
+                 action='store_true', default=False,
+                 help="write the time taken by each phase, and other "
+                 "statistics, to stderr as JSON")
+    p.add_option('--serve',
+                 action='store_true', default=False,
+                 help="run a server handling requests on standard input "
+                 "(or on the Unix socket given by --socket)")
+    p.add_option('--socket',
+                 help="Unix socket for --serve to listen on; without "
+                 "--serve, ask the server listening there to minify FILE")
+    return p
+
+def server_options(opts, args, error):
+    """Check that the options opts and arguments args, parsed by the
+    parser from option_parser, can be handled by the server, calling
+    error with a message if not. Return the name of the file to minify
+    and a dictionary of keyword arguments for minify.
+
+    """
     if len(args) != 1:
+        error("the server minifies one FILE at a time")
+    kwargs = dict(opts.__dict__)
+    if kwargs['bytecode']:
+        error("the server doesn't write bytecode")
+    for k in ('serve socket output jobs timeout manifest cache_ast debug '
+              'index stats package mapping bundle bytecode').split():
+        del kwargs[k]
+    return args[0], kwargs
+
+def main():
+    # Handle command-line arguments.
+    p = option_parser()
+    opts, args = p.parse_args()
+    if opts.serve:
+        serve(opts.socket, opts.jobs)
+        return
+    if not args:
         p.error("missing FILE")
-    minify(args[0], **opts.__dict__)
+    if opts.socket is not None:
+        filename, kwargs = server_options(opts, args, p.error)
+        result = client(opts.socket, filename, **kwargs)
+        output = opts.output
+        if not hasattr(output, 'write'):
+            output = open(output, 'wb')
+        output.write(result)
+        return
+    kwargs = opts.__dict__
+    del kwargs['serve'], kwargs['socket']
+    if kwargs['cache'] is not None:
+        kwargs['cache'] = open_cache(kwargs['cache'],
+                                     fingerprint=kwargs['cache_ast'])
+    del kwargs['cache_ast']
+    jobs = kwargs.pop('jobs')
+    timeout = kwargs.pop('timeout')
+    manifest = kwargs.pop('manifest')
+    stats = kwargs.pop('stats')
+    package = kwargs.pop('package')
+    mapping = kwargs.pop('mapping')
+    bundle_file = kwargs.pop('bundle')
+    if package and not kwargs['rename']:
+        p.error("--package needs --rename")
+    if bundle_file and kwargs['bytecode']:
+        p.error("a bundle is already compiled")
+    import json
+    import os
+    if (len(args) == 1 and not os.path.isdir(args[0]) and not package
+        and not bundle_file):
+        result = dict(input=args[0]) if stats else None
+        bytecode = kwargs.pop('bytecode')
+        if bytecode:
+            if not isinstance(kwargs['output'], str):
+                p.error("--pyc needs an OUTPUT file")
+            kwargs['pyc'] = kwargs['output'] + 'c'
+            if bytecode == 'only':
+                kwargs['output'] = None
+        minify(args[0], stats=result, **kwargs)
+        if stats:
+            json.dump(result, stderr, indent=1, sort_keys=True)
+            stderr.write('\n')
+        return
+    outdir = kwargs.pop('output')
+    if outdir is stdout and not bundle_file:
+        p.error("minifying several files needs an output directory")
+    if package:
+        package = Package([s for s, _ in find_sources(args, '')])
+        package.analyse(kwargs['index'],
+                        (kwargs['preserve'] or '').split(','),
+                        target=kwargs['target'])
+        kwargs['package'] = package
+        if mapping:
+            with open(mapping, 'w') as f:
+                json.dump(package.mapping, f, indent=1, sort_keys=True)
+                f.write('\n')
+    if bundle_file:
+        entries = bundle(args, bundle_file, jobs=jobs, timeout=timeout,
+                         manifest=manifest, stats=stats, **kwargs)
+    else:
+        entries = minify_files(args, outdir, jobs=jobs, timeout=timeout,
+                               manifest=manifest, stats=stats, **kwargs)
+    if stats:
+        json.dump(entries, stderr, indent=1, sort_keys=True)
+        stderr.write('\n')
+    failed = [e for e in entries if e['status'] != 'ok']
+    for e in failed:
+        stderr.write('{0}: {1}\n'.format(e['input'],
+                                         e.get('error', e['status'])))
+    if failed:
+        exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Client for the minipy server.
+
+usage: minipy_client.py SOCKET [options] [-o OUTPUT] FILE
+
+Ask the server listening on the Unix socket SOCKET (started by
+"minipy --serve --socket=SOCKET") to minify FILE, and write the result
+to OUTPUT (default: stdout). The options are those of minipy, and are
+parsed by the server. This script doesn't import minipy, so it starts
+much faster than "minipy --socket=SOCKET".
+
+"""
+
+import json
+import os
+import socket
+import sys
+
+def read_frame(f):
+    # As minipy.read_frame.
+    line = '\n'
+    while line.isspace():
+        line = f.readline()
+    if not line:
+        return None
+    return json.loads(f.read(int(line)))
+
+def write_frame(f, obj):
+    # As minipy.write_frame.
+    data = json.dumps(obj)
+    f.write('{0}\n{1}'.format(len(data), data))
+    f.flush()
+
+def split_output(args):
+    """Remove the --output option from the list of command-line
+    arguments args, and return its value (or None) and the remaining
+    arguments.
+
+    """
+    output = None
+    rest = []
+    args = iter(args)
+    for arg in args:
+        if arg == '--':
+            rest.append(arg)
+            rest.extend(args)
+        elif arg in ('-o', '--output'):
+            output = next(args, None)
+        elif arg.startswith('--output='):
+            output = arg[len('--output='):]
+        elif arg.startswith('-o'):
+            output = arg[len('-o'):]
+        else:
+            rest.append(arg)
+    return output, rest
+
+def client(socket_path, argv):
+    """Ask the server listening on the Unix socket at socket_path to
+    minify the file given by the command-line arguments argv (without
+    --output), and return the result.
+
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    try:
+        write_frame(conn.makefile('wb'), dict(argv=argv, cwd=os.getcwd()))
+        conn.shutdown(socket.SHUT_WR)
+        response = read_frame(conn.makefile('rb'))
+    finally:
+        conn.close()
+    if response is None:
+        raise IOError("no response from server")
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['output'].encode('latin1')
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__.split('\n\n')[1] + '\n')
+        sys.exit(2)
+    output, argv = split_output(sys.argv[2:])
+    try:
+        result = client(sys.argv[1], argv)
+    except (IOError, RuntimeError) as e:
+        sys.stderr.write('{0}: {1}\n'.format(os.path.basename(sys.argv[0]), e))
+        sys.exit(1)
+    if output is None:
+        sys.stdout.write(result)
+    else:
+        with open(output, 'wb') as f:
+            f.write(result)
+
+if __name__ == '__main__':
+    main()
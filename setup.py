@@ -25,7 +25,8 @@ setup(
     maintainer = minipy.__maintainer__,
     maintainer_email = minipy.__email__,
     name = 'minipy',
-    py_modules = ['minipy', 'test_minipy'],
+    py_modules = ['minipy', 'minipy_client', 'test_minipy'],
+    scripts = ['minipy_client.py'],
     url = 'https://github.com/gareth-rees/minipy',
     version = minipy.__version__,
     entry_points = {
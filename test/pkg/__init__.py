@@ -0,0 +1,9 @@
+"""A package for testing renaming across modules (see testPackage)."""
+
+from pkg.shapes import make_square, DEFAULT_SIDE
+
+def total_area(shapes):
+    return sum(shape.area() for shape in shapes)
+
+def answer():
+    return total_area([make_square(DEFAULT_SIDE), make_square(3)])
@@ -0,0 +1,9 @@
+from math import *
+
+ORIGIN = (0, 0)
+
+def square_area(side):
+    return pow(side, 2)
+
+def offset(point):
+    return sum(point)
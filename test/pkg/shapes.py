@@ -0,0 +1,15 @@
+from .geometry import square_area as area_of_square, ORIGIN
+import geometry
+
+DEFAULT_SIDE = 2
+
+class Square(object):
+    def __init__(self, side, corner=ORIGIN):
+        self.side = side
+        self.corner = corner
+
+    def area(self):
+        return area_of_square(self.side) + geometry.offset(self.corner)
+
+def make_square(side):
+    return Square(side)
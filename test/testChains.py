@@ -0,0 +1,17 @@
+'Aliasing attribute chains of modules.';import errno;_a=errno.EINTR;import os;_b,_c=os.SEEK_END,os.SEEK_SET;import sys
+def walk(top):
+ for name in os.listdir(top):
+  path=os.path.join(top,name)
+  if os.path.isdir(path):print os.path.join(path,'')
+  else:print os.path.join(top,os.path.basename(path))
+def retry(f):
+ while True:
+  try:return f()
+  except OSError,e:
+   if e.errno not in(_a,errno.EAGAIN):raise
+def shadow(os):return os.path.join('a','b'),os.path.join('c','d')
+def seek(f,whence=_c):
+ if whence==_b:return f.seek(0,_b)
+ return f.seek(0,_c)
+def error(code):return _a,_a,errno.errorcode[code]
+sys.stdout.write(os.path.join('x','y')+'\n');sys.stdout.write(os.path.join('x','z')+'\n');print retry(lambda:_a),error(_a);print[os.path.join(p,'q')for p in'ab'],shadow(os)
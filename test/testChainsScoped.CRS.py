@@ -0,0 +1,36 @@
+"""Aliasing attribute chains of modules renamed in scopes."""
+import errno
+import os
+import sys
+
+def walk(top):
+    for name in os.listdir(top):
+        path = os.path.join(top, name)
+        if os.path.isdir(path):
+            print os.path.join(path, '')
+        else:
+            print os.path.join(top, os.path.basename(path))
+
+def retry(f):
+    while True:
+        try:
+            return f()
+        except OSError, e:
+            if e.errno not in (errno.EINTR, errno.EAGAIN):
+                raise
+
+def shadow(os):
+    return os.path.join('a', 'b'), os.path.join('c', 'd')
+
+def seek(f, whence=os.SEEK_SET):
+    if whence == os.SEEK_END:
+        return f.seek(0, os.SEEK_END)
+    return f.seek(0, os.SEEK_SET)
+
+def error(code):
+    return errno.EINTR, errno.EINTR, errno.errorcode[code]
+
+sys.stdout.write(os.path.join('x', 'y') + '\n')
+sys.stdout.write(os.path.join('x', 'z') + '\n')
+print retry(lambda: errno.EINTR), error(errno.EINTR)
+print [os.path.join(p, 'q') for p in 'ab'], shadow(os)
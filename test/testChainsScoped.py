@@ -0,0 +1,17 @@
+'Aliasing attribute chains of modules renamed in scopes.';import errno as b;_a=b.EINTR;import os as a;_b,_c=a.SEEK_END,a.SEEK_SET;import sys
+def g(b):
+ for c in a.listdir(b):
+  path=a.path.join(b,c)
+  if a.path.isdir(path):print a.path.join(path,'')
+  else:print a.path.join(b,a.path.basename(path))
+def c(a):
+ while True:
+  try:return a()
+  except OSError,c:
+   if c.errno not in(_a,b.EAGAIN):raise
+def d(a):return a.path.join('a','b'),a.path.join('c','d')
+def seek(b,c=_c):
+ if c==_b:return b.seek(0,_b)
+ return b.seek(0,_c)
+def e(a):return _a,_a,b.errorcode[a]
+sys.stdout.write(a.path.join('x','y')+'\n');sys.stdout.write(a.path.join('x','z')+'\n');print c(lambda:_a),e(_a);print[a.path.join(f,'q')for f in'ab'],d(a)
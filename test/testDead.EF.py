@@ -0,0 +1,68 @@
+"""Dead code, unused private functions and unused imports."""
+import os
+import readline
+import sys
+from collections import OrderedDict, namedtuple
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+VERBOSE = 0
+
+def _helper(x):
+    return x + os.sep
+
+def _unused(x):
+    return _helper(x)
+
+def _used(x):
+    return x * 2
+
+def classify(n):
+    if VERBOSE:
+        print 'classifying', n
+    if 0:
+        import re
+        return re
+    elif n < 0:
+        return 'negative'
+    else:
+        return 'positive'
+    print 'unreachable'
+
+def spin():
+    while 1:
+        pass
+    return 'unreachable'
+
+def first(items):
+    for item in items:
+        if item:
+            break
+        continue
+        print 'unreachable'
+    return item
+
+def unbound():
+    return late
+    late = 1
+
+def generator():
+    return
+    yield
+
+while 0:
+    print 'never'
+else:
+    print 'always'
+
+if False:
+    debug = True
+
+try:
+    pass
+except ValueError:
+    error = True
+
+print _used(2), namedtuple, sys.argv, classify(1), spin, first, unbound, generator
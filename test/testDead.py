@@ -0,0 +1,18 @@
+'Dead code, unused private functions and unused imports.';import readline;import sys;from collections import OrderedDict,namedtuple
+try:import cPickle as pickle
+except ImportError:pass
+VERBOSE=0
+def _used(x):return x*2
+def classify(n):
+ if n<0:return'negative'
+ else:return'positive'
+def spin():
+ while 1:pass
+def first(items):
+ for item in items:
+  if item:break
+  continue
+ return item
+def unbound():return late;late=1
+def generator():return;yield
+print'always';print _used(2),namedtuple,sys.argv,classify(1),spin,first,unbound,generator
@@ -0,0 +1,38 @@
+"""Deferring imports."""
+import json, sys
+import base64
+import textwrap
+from collections import OrderedDict as _OrderedDict
+from string import ascii_letters
+
+__all__ = ['dump', 'ordered', 'encode', 'count', 'Lines', 'gen']
+
+WIDTH = textwrap.fill('a b', 1)
+
+def dump(obj):
+    """Dump obj as JSON."""
+    return json.dumps(obj, sort_keys=True)
+
+def ordered(pairs):
+    def inner():
+        return _OrderedDict(pairs)
+    return list(inner().keys())
+
+def shadow(json):
+    return json
+
+def encode(data):
+    return base64.b64encode(data) + sys.platform[:0]
+
+def count(value):
+    return len(locals()), base64.b64decode(value)
+
+class Lines(object):
+    def wrap(self, s):
+        return textwrap.fill(s, 3)
+
+def gen(xs):
+    return list(json.dumps(x) for x in xs)
+
+print dump({'b': 1, 'a': 2}), ordered([(1, 2)]), shadow(3), encode('hi')
+print count('aGk='), Lines().wrap('a b c'), gen([1]), ascii_letters[:3], WIDTH
@@ -0,0 +1,13 @@
+"""Deferring imports in a module without __all__."""
+import json
+import base64 as _base64
+from collections import OrderedDict
+from textwrap import fill as _fill
+
+def dump(obj):
+    return json.dumps(OrderedDict(obj))
+
+def encode(data):
+    return _fill(_base64.b64encode(data), 4)
+
+print dump([('b', 1), ('a', 2)]), encode('hello')
@@ -0,0 +1,4 @@
+'Deferring imports in a module without __all__.';import json;from collections import OrderedDict
+def dump(obj):return json.dumps(OrderedDict(obj))
+def encode(data):import base64 as _base64;from textwrap import fill as _fill;return _fill(_base64.b64encode(data),4)
+print dump([('b',1),('a',2)]),encode('hello')
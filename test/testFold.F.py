@@ -0,0 +1,22 @@
+"""Constant folding and module constants."""
+from __future__ import division
+
+SECONDS_PER_DAY = 60 * 60 * 24
+DEBUG = 0
+GREETING = 'Hello' + ', ' + 'world'
+RETRIES = 3
+RETRIES += 1
+HUGE = 'x' * 10 ** 9
+
+def timeout(days, verbose=False):
+    if DEBUG or verbose:
+        print 'days: %d' % days
+    return days * SECONDS_PER_DAY + (1 << 4) - 1 / 2
+
+half = 1 / 2
+label = '%s-%s' % ('a', 'b') + GREETING
+flags = not 0, 'abc' == 'abd', 1 < 2 < 1
+mask = ~0xff & 0xffff
+first = 0 or half
+error = 1 // 0 if DEBUG else None
+print timeout(2), label, flags, mask, RETRIES, -(1)
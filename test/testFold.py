@@ -0,0 +1,5 @@
+'Constant folding and module constants.';from __future__ import division;SECONDS_PER_DAY=86400;DEBUG=0;GREETING='Hello, world';RETRIES=3;RETRIES+=1;HUGE='x'*10**9
+def timeout(days,verbose=False):
+ if verbose:print'days: %d'%days
+ return days*86400+16-0.5
+half=0.5;label='a-b'+GREETING;flags=True,False,False;mask=65280;first=half;error=1//0if 0 else None;print timeout(2),label,flags,mask,RETRIES,-1
@@ -0,0 +1,11 @@
+def area(width, height):
+    return width * height
+
+def perimeter(width, height):
+    return 2 * (width + height)
+
+def describe(shape, width, height):
+    return '%s: area %s, perimeter %s' % (
+        shape, area(width, height), perimeter(width, height))
+
+print describe('rectangle', 3, 4)
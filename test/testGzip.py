@@ -0,0 +1,4 @@
+def e(e,r):return e*r
+def r(e,r):return 2*(e+r)
+def t(t,n,a):return'%s: area %s, perimeter %s'%(t,e(n,a),r(n,a))
+print t('rectangle',3,4)
@@ -0,0 +1,23 @@
+"""Hoisting repeated literals."""
+from __future__ import print_function
+
+__all__ = ['render', 'render']
+
+TEMPLATE = 'application/x-www-form-urlencoded'
+
+def render(value, scale=2.54):
+    """Render the value."""
+    if value > 1000000:
+        print('application/x-www-form-urlencoded', value * 2.54)
+    elif value < -1000000:
+        print('application/x-www-form-urlencoded', -value * 2.54)
+    return scale * 2.54, TEMPLATE, 'short', 'short', 'short'
+
+class Widget(object):
+    kind = 'application/x-www-form-urlencoded'
+    limit = 1000000
+
+    def size(self, a):
+        return a * 2.54 + 1000000
+
+print(render(3), render(2000000), Widget().size(1), Widget.kind)
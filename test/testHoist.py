@@ -0,0 +1,10 @@
+'Hoisting repeated literals.';from __future__ import print_function;_a,_b,_c='application/x-www-form-urlencoded',1000000,'short';__all__=['render','render'];c=_a
+def render(a,d=2.54):
+ 'Render the value.'
+ if a>_b:print(_a,a*2.54)
+ elif a<-1000000:print(_a,-a*2.54)
+ return d*2.54,c,_c,_c,_c
+class b(object):
+ kind=_a;f=_b
+ def size(g,e):return e*2.54+_b
+print(render(3),render(2000000),b().size(1),b.kind)
@@ -0,0 +1,62 @@
+"""Localizing lookups in loops."""
+import math
+from os.path import join
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+counter = 0
+
+def norms(points, out):
+    for x, y in points:
+        out.append(math.sqrt(x * x + y * y))
+    return out
+
+class Grid(object):
+    def __init__(self):
+        self.cells = []
+
+    def fill(self, n):
+        i = 0
+        while i < len(self.cells[:n]) + n:
+            self.cells.append(join('a', str(i)))
+            i += 1
+        for c in self.cells[:n]:
+            self.cells = self.cells + [c]
+            self.cells.append(StringIO(c).read())
+        return self.cells
+
+def count(xs):
+    global counter
+    for x in xs:
+        counter += len(x)
+    return counter
+
+def generate(xs):
+    result = []
+    for x in xs:
+        result.append(x)
+        yield max(x, 0)
+
+def nested(rows, sorted=sorted):
+    result = []
+    for row in rows:
+        seen = set()
+        for x in row:
+            if x not in seen:
+                seen.add(x)
+                result.append(x)
+    return sorted(result)
+
+def closure(xs):
+    abs = lambda x: -x
+    def inner():
+        return [abs(x) for x in xs if x is not None]
+    for x in xs:
+        print abs(x), inner()
+
+print norms([(3, 4)], []), Grid().fill(2), count(['ab', 'c'])
+print list(generate([1, -1])), nested([[1, 2, 2], [3]])
+closure([1, 2])
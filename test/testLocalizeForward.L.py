@@ -0,0 +1,30 @@
+"""Localizing lookups of names bound later in the module."""
+import os
+
+def run(xs):
+    total = 0
+    for x in xs:
+        total += helper(x)
+    return total
+
+print run([])
+
+def helper(x):
+    return x * 2
+
+def guarded(xs):
+    for x in xs:
+        if hasattr(os, 'no_such_function'):
+            os.no_such_function(x)
+        if x and math.floor(x):
+            pass
+    return len(xs)
+
+def later(xs):
+    result = []
+    for x in xs:
+        result.append(helper(x) + math.floor(x))
+    return result
+
+import math
+print run([1, 2]), guarded([1]), later([1.5])
@@ -0,0 +1,20 @@
+import os
+import os.path
+
+def join_all(first, second=os.sep):
+    joined = first + second
+    def append(suffix):
+        return joined + suffix + os.path.basename(first)
+    return append
+
+def record(values):
+    global counter
+    counter = len(values)
+    return [item for item in values] + list(value * 2 for value in values)
+
+class Counter(object):
+    step = 1
+    def incrementer(self, amount):
+        return lambda value: value + amount + self.step
+
+counter = 0
@@ -0,0 +1,10 @@
+import os;import os.path
+def b(a,b=os.sep):
+ c=a+b
+ def d(b):return c+b+os.path.basename(a)
+ return d
+def c(b):global a;a=len(b);return[c for c in b]+list(a*2for a in b)
+class d(object):
+ step=1
+ def e(a,b):return lambda c:c+b+a.step
+a=0
@@ -0,0 +1,35 @@
+# A state machine nested deeply enough for tabs to pay off.
+
+def step(state, data):
+    for c in data:
+        if state == 0:
+            if c == 'a':
+                state = 1
+            elif c == 'b':
+                while c:
+                    try:
+                        if c.isdigit():
+                            with open(c) as f:
+                                for line in f:
+                                    if line:
+                                        if line[0] == '#':
+                                            continue
+                                        else:
+                                            def inner(x):
+                                                if x:
+                                                    return x
+                                                return None
+                                            state = inner(line)
+                                        state += 1
+                                    state -= 1
+                                state *= 2
+                            state //= 3
+                        c = c[1:]
+                    except ValueError:
+                        state = -1
+                        break
+        else:
+            state = 0
+    return state
+
+print step(0, 'ab')
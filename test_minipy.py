@@ -31,6 +31,15 @@ class MinipyTests(unittest.TestCase):
                         'D': ('--docstrings', dict(docstrings=True)),
                         'R': ('--rename', dict(rename=True)),
                         '4': ('--indent=4', dict(indent=4)),
+                        'S': ('--scoped', dict(scoped=True)),
+                        'F': ('--fold', dict(fold=True)),
+                        'E': ('--deadcode', dict(deadcode=True)),
+                        'G': ('--target=gzip', dict(target='gzip')),
+                        'T': ('--tabs', dict(tabs=True)),
+                        'H': ('--hoist', dict(hoist=True)),
+                        'L': ('--localize', dict(localize=True)),
+                        'C': ('--chains', dict(chains=True)),
+                        'I': ('--defer', dict(defer=True)),
                         }.get(c)
                     if a:
                         args.append(a[0])
@@ -50,6 +59,507 @@ class MinipyTests(unittest.TestCase):
                 output.seek(0)
                 self.assertEqual(output.read(), correct)
 
+    def testChains(self):
+        # The aliases must refer to the modules as renamed.
+        for source, minified in (('testChains.C.py', 'testChains.py'),
+                                 ('testChainsScoped.CRS.py',
+                                  'testChainsScoped.py')):
+            outputs = []
+            for f in source, minified:
+                pipe = Popen([executable, os.path.join(self.testdir, f)],
+                             stdout=PIPE)
+                outputs.append(pipe.communicate()[0])
+                self.assertEqual(pipe.returncode, 0)
+            self.assertEqual(outputs[0], outputs[1])
+
+    def testBatch(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            inputs = [os.path.join(self.testdir, f)
+                      for f in sorted(os.listdir(self.testdir))
+                      if f.endswith('.X.py')]
+            manifest = StringIO()
+            entries = minipy.minify_files(inputs, outdir, jobs=2,
+                                          manifest=manifest)
+            self.assertEqual([e['input'] for e in entries], inputs)
+            for e in entries:
+                self.assertEqual(e['status'], 'ok')
+                correct = open(e['input'].replace('.X', '')).read()
+                self.assertEqual(open(e['output']).read(), correct)
+                self.assertEqual(e['bytes_out'], len(correct))
+            self.assertTrue(manifest.getvalue().startswith('['))
+        finally:
+            rmtree(outdir)
+
+    def testTimeout(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            destination = os.path.join(outdir, 'minipy.py')
+            entry = minipy.minify_job((minipy.__file__.replace('.pyc', '.py'),
+                                       destination, 0.001, None,
+                                       dict(fold=True)))
+            self.assertEqual(entry['status'], 'timeout')
+            self.assertFalse(os.path.exists(destination))
+        finally:
+            rmtree(outdir)
+
+    def testTimeoutScan(self):
+        # A timeout while ExportIndex.scan imports a module in another
+        # process must stop that process.
+        import py_compile
+        import sys
+        import time
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        tmpdir = mkdtemp()
+        path = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = tmpdir
+        sys.path.insert(0, tmpdir)
+        try:
+            module = os.path.join(tmpdir, 'minipyslowscan.py')
+            pidfile = os.path.join(tmpdir, 'pid')
+            with open(module, 'w') as f:
+                f.write('import os, time\n'
+                        'open({0!r}, "w").write(str(os.getpid()))\n'
+                        'time.sleep(30)\n'.format(pidfile))
+            py_compile.compile(module)
+            os.remove(module)   # So that it's scanned, not analysed.
+            source = os.path.join(tmpdir, 'user.py')
+            with open(source, 'w') as f:
+                f.write('from minipyslowscan import *\n')
+            start = time.time()
+            entry = minipy.minify_job((source, os.path.join(tmpdir, 'out.py'),
+                                       1, None, dict(rename=True)))
+            self.assertEqual(entry['status'], 'timeout')
+            self.assertTrue(time.time() - start < 10)
+            pid = int(open(pidfile).read())
+            self.assertRaises(OSError, os.kill, pid, 0)
+        finally:
+            sys.path.remove(tmpdir)
+            if path is None:
+                del os.environ['PYTHONPATH']
+            else:
+                os.environ['PYTHONPATH'] = path
+            rmtree(tmpdir)
+
+    def testCache(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        cachedir = mkdtemp()
+        try:
+            cache = minipy.MinifyCache(cachedir, fingerprint=True)
+            filename = os.path.join(self.testdir, 'testFib.DR.py')
+            correct = open(os.path.join(self.testdir, 'testFib.py')).read()
+            for hits, misses in ((0, 1), (1, 1)):
+                output = StringIO()
+                minipy.minify(filename, output=output, cache=cache,
+                              docstrings=True, rename=True)
+                self.assertEqual(output.getvalue(), correct)
+                self.assertEqual((cache.hits, cache.misses), (hits, misses))
+        finally:
+            rmtree(cachedir)
+
+    def testCacheInit(self):
+        # A package's __init__ module is minified differently from
+        # other modules with the same source, so mustn't share their
+        # cache entries.
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        tmpdir = mkdtemp()
+        try:
+            cache = minipy.MinifyCache(os.path.join(tmpdir, 'cache'))
+            pkg = os.path.join(tmpdir, 'pkg')
+            os.mkdir(pkg)
+            for source, options, outputs in (
+                ('import os\n', dict(deadcode=True),
+                 ('import os\n', '\n')),
+                ('import json as _json\ndef f():return _json\n',
+                 dict(defer=True),
+                 ('import json as _json\ndef f():return _json\n',
+                  'def f():import json as _json;return _json\n'))):
+                for filename, correct in zip(('__init__.py', 'mod.py'),
+                                             outputs):
+                    path = os.path.join(pkg, filename)
+                    open(path, 'w').write(source)
+                    output = StringIO()
+                    minipy.minify(path, output=output, cache=cache, **options)
+                    self.assertEqual(output.getvalue(), correct)
+            self.assertEqual(cache.hits, 0)
+        finally:
+            rmtree(tmpdir)
+
+    def testStats(self):
+        filename = os.path.join(self.testdir, 'testFib.DR.py')
+        output = StringIO()
+        stats = dict()
+        minipy.minify(filename, output=output, stats=stats,
+                      docstrings=True, rename=True)
+        self.assertEqual(stats['bytes_in'], os.path.getsize(filename))
+        self.assertEqual(stats['bytes_out'], len(output.getvalue()))
+        self.assertEqual(stats['nodes']['Module'], 1)
+        self.assertTrue(stats['renamed'] > 0)
+        self.assertTrue(stats['reserved'] >= stats['kept'])
+        for phase in 'parse rename_ast serialize'.split():
+            self.assertTrue(stats['seconds'][phase] >= 0)
+
+    def testRenaming(self):
+        from ast import dump
+        for f in 'testCall.JR.py', 'testScopes.RS.py', 'testGzip.RSG.py':
+            source = open(os.path.join(self.testdir, f)).read()
+            options = dict(scoped='S' in f,
+                           target='gzip' if 'G' in f else 'raw')
+            tree = parse(source)
+            original = dump(tree)
+            renaming = minipy.find_renaming(
+                tree, reserve=minipy.FindReserved(), **options)
+            minified = minipy.serialize_ast(tree, renaming=renaming)
+            self.assertEqual(dump(tree), original)
+            renamed = parse(source)
+            minipy.rename_ast(renamed, minipy.reserved_names_in_ast(renamed),
+                              **options)
+            self.assertEqual(minified, minipy.serialize_ast(renamed))
+
+    def testSource(self):
+        import mmap
+        filename = os.path.join(self.testdir, 'testFib.DR.py')
+        correct = open(os.path.join(self.testdir, 'testFib.py')).read()
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            source = data[:]
+            for d in (source, memoryview(source), data):
+                stats = dict()
+                self.assertEqual(minipy.minify_source(
+                        d, stats=stats, docstrings=True, rename=True),
+                                 correct)
+                self.assertEqual(stats['bytes_in'], len(source))
+            output = StringIO()
+            self.assertEqual(minipy.minify_source(
+                    data, output, docstrings=True, rename=True), None)
+            self.assertEqual(output.getvalue(), correct)
+            data.close()
+
+    def testUnicodeSource(self):
+        # Unicode is encoded as its coding cookie says, or as UTF-8 with
+        # a cookie added after the #! line.
+        for source, value, encoding in (
+                (u"s = u'\xe9\u20ac'\n", u'\xe9\u20ac', 'utf-8'),
+                (u"#!/usr/bin/env python\ns = u'\xe9'\n", u'\xe9', 'utf-8'),
+                (u"# coding: latin-1\ns = u'\xe9'\n", u'\xe9', 'latin-1'),
+                (u"s = 'e'\n", 'e', 'ascii')):
+            output = minipy.minify_source(source)
+            self.assertTrue(isinstance(output, str))
+            self.assertTrue(value.encode(encoding) in output)
+            self.assertEqual(output.startswith('#!'),
+                             source.startswith('#!'))
+            namespace = dict()
+            exec compile(output, '<string>', 'exec') in namespace
+            self.assertEqual(namespace['s'], value)
+
+    def testStream(self):
+        # Minifying a statement at a time gives the same output as
+        # minifying the whole module.
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        tmpdir = mkdtemp()
+        try:
+            edges = os.path.join(tmpdir, 'edges.py')
+            with open(edges, 'w') as f:
+                f.write('#!/usr/bin/env python\n'
+                        '"""Docstring."""\n'
+                        '# A comment between the docstring and the future.\n'
+                        'from __future__ import print_function\n'
+                        'from __future__ import division\n'
+                        'print(1 / 2, end="")\n'
+                        '@staticmethod\n\n'
+                        '# A comment after a decorator.\n'
+                        '@classmethod\n'
+                        'def f(): pass\n'
+                        'if f:\n    x = 1\n'
+                        '# A comment before elif.\n'
+                        'elif x:\n    x = 2\n'
+                        'else:\n    x = 3\n'
+                        'try:\n    pass\n'
+                        'except ValueError:\n    pass\n'
+                        'except:\n    pass\n'
+                        'else:\n    pass\n'
+                        'finally:\n    pass\n'
+                        'y = [1,\n# Comment in brackets.\n2,\n  3]\n'
+                        'z = 1 + \\\n    2\n'
+                        'while 0:\n    pass\n'
+                        'else:\n    pass\n'
+                        's = """a\ndef g(): pass\nb"""\n'
+                        'class C:\n    pass\n')
+            prologue = os.path.join(tmpdir, 'prologue.py')
+            with open(prologue, 'w') as f:
+                f.write('"""Docstring."""\n'
+                        'from __future__ import unicode_literals\n')
+            inputs = [edges, prologue] + [os.path.join(self.testdir, f)
+                                for f in sorted(os.listdir(self.testdir))
+                                if f.endswith('.py')]
+            for filename in inputs:
+                for docstrings in False, True:
+                    outputs = []
+                    for stream in False, True:
+                        output = StringIO()
+                        minipy.minify(filename, output=output, stream=stream,
+                                      docstrings=docstrings)
+                        outputs.append(output.getvalue())
+                    self.assertEqual(outputs[0], outputs[1], filename)
+        finally:
+            rmtree(tmpdir)
+
+    def testBytecode(self):
+        import imp
+        import marshal
+        import struct
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            output = os.path.join(outdir, 'call.py')
+            minipy.minify(os.path.join(self.testdir, 'testCall.JR.py'),
+                          output=output, pyc=output + 'c', joinlines=False,
+                          rename=True)
+            data = open(output + 'c', 'rb').read()
+            self.assertEqual(data[:4], imp.get_magic())
+            self.assertEqual(struct.unpack('<I', data[4:8])[0],
+                             int(os.path.getmtime(output)))
+            self.assertEqual(data[8:], marshal.dumps(compile(
+                        open(output).read(), output, 'exec')))
+            entries = minipy.minify_files([os.path.join(self.testdir, 'pkg')],
+                                          os.path.join(outdir, 'pkg'), jobs=1,
+                                          bytecode='only')
+            self.assertEqual([e['status'] for e in entries], ['ok'] * 3)
+            self.assertTrue(all(e['output'].endswith('.pyc')
+                                for e in entries))
+            pipe = Popen([executable, '-c', 'import pkg; print pkg.answer(), '
+                          'pkg.__file__'], stdout=PIPE, cwd=outdir)
+            self.assertEqual(pipe.communicate()[0],
+                             '13.0 pkg/__init__.pyc\n')
+        finally:
+            rmtree(outdir)
+
+    def testCompress(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            filename = os.path.join(outdir, 'compressed.py')
+            stats = dict()
+            minipy.minify(minipy.__file__.replace('.pyc', '.py'),
+                          output=filename, compress=True, stats=stats)
+            info = stats['compress']
+            self.assertTrue(info['form'].startswith(('zlib+', 'bz2+')))
+            self.assertEqual(info['bytes_after'], os.path.getsize(filename))
+            self.assertTrue(info['bytes_after'] < info['bytes_before'])
+            self.assertTrue(info['decompress_seconds'] >= 0)
+            pipe = Popen([executable, '-c', 'import compressed; '
+                          'print compressed.__version__'],
+                         stdout=PIPE, cwd=outdir)
+            self.assertEqual(pipe.communicate()[0], minipy.__version__ + '\n')
+
+            # A small file is not compressed.
+            output = StringIO()
+            minipy.minify(os.path.join(self.testdir, 'testFib.DR.py'),
+                          output=output, compress=True, docstrings=True,
+                          rename=True)
+            self.assertEqual(output.getvalue(), open(
+                    os.path.join(self.testdir, 'testFib.py')).read())
+        finally:
+            rmtree(outdir)
+
+    def testPackage(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            source = os.path.join(self.testdir, 'pkg')
+            package = minipy.Package([s for s, _ in minipy.find_sources(
+                        [source], outdir)])
+            mapping = package.analyse(preserve=['answer'])
+            for name in 'make_square square_area ORIGIN'.split():
+                self.assertTrue(name in mapping)
+            self.assertFalse('answer' in mapping)
+            entries = minipy.minify_files([source], os.path.join(outdir, 'pkg'),
+                                          rename=True, package=package)
+            self.assertEqual([e['status'] for e in entries], ['ok'] * 3)
+            pipe = Popen([executable, '-c', 'import pkg; print pkg.answer()'],
+                         stdout=PIPE, cwd=outdir)
+            self.assertEqual(pipe.communicate()[0], '13.0\n')
+        finally:
+            rmtree(outdir)
+
+    def testPackageCache(self):
+        # Modules with the same source in different subpackages import
+        # different modules, so mustn't share cache entries.
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        tmpdir = mkdtemp()
+        try:
+            source = 'from helper import value\nprint value\n'
+            pkg = os.path.join(tmpdir, 'pkg')
+            for sub in 'a', 'b':
+                os.makedirs(os.path.join(pkg, sub))
+            for path, text in (('__init__.py', ''), ('a/__init__.py', ''),
+                               ('b/__init__.py', ''), ('a/mod.py', source),
+                               ('b/mod.py', source),
+                               ('a/helper.py', 'value = 1\n')):
+                open(os.path.join(pkg, path), 'w').write(text)
+            package = minipy.Package([s for s, _ in minipy.find_sources(
+                        [pkg], tmpdir)])
+            package.analyse()
+            cache = minipy.MinifyCache(os.path.join(tmpdir, 'cache'))
+            outputs = []
+            for sub in 'a', 'b':
+                filename = os.path.join(pkg, sub, 'mod.py')
+                outputs.append(minipy.minify_source(
+                        open(filename).read(), None, filename, rename=True,
+                        package=package, cache=cache))
+                self.assertEqual(outputs[-1], minipy.minify_source(
+                        open(filename).read(), None, filename, rename=True,
+                        package=package))
+            self.assertNotEqual(outputs[0], outputs[1])
+            self.assertEqual(cache.hits, 0)
+        finally:
+            rmtree(tmpdir)
+
+    def testBundle(self):
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        outdir = mkdtemp()
+        try:
+            source = os.path.join(self.testdir, 'pkg')
+            filename = os.path.join(outdir, 'bundle.py')
+            entries = minipy.bundle([source], filename, jobs=1)
+            self.assertEqual([e['status'] for e in entries], ['ok'] * 3)
+            pipe = Popen([executable, '-c', 'import bundle, pkg.geometry; '
+                          'print pkg.answer(), pkg.geometry.__package__'],
+                         stdout=PIPE, cwd=outdir)
+            self.assertEqual(pipe.communicate()[0], '13.0 pkg\n')
+        finally:
+            rmtree(outdir)
+
+    def testServer(self):
+        pipe = Popen([executable, minipy.__file__, '--serve', '--jobs=2'],
+                     stdin=PIPE, stdout=PIPE)
+        requests = StringIO()
+        cases = ['testFib.DR.py', 'testCall.JR.py', 'missing.py']
+        for i, f in enumerate(cases):
+            minipy.write_frame(requests, dict(
+                id=i, filename=os.path.join(self.testdir, f),
+                options=dict(docstrings=True, rename=True)))
+        source = open(os.path.join(self.testdir, 'testFib.DR.py')).read()
+        cases.append('source')
+        minipy.write_frame(requests, dict(
+                id=3, source=source.decode('latin1'),
+                options=dict(docstrings=True, rename=True)))
+        output, _ = pipe.communicate(requests.getvalue())
+        output = StringIO(output)
+        responses = {}
+        for _ in cases:
+            response = minipy.read_frame(output)
+            responses[response['id']] = response
+        self.assertEqual(minipy.read_frame(output), None)
+        self.assertEqual(responses[0]['output'],
+                         open(os.path.join(self.testdir, 'testFib.py')).read())
+        self.assertTrue('output' in responses[1])
+        self.assertTrue(responses[2]['error'].startswith('IOError'))
+        self.assertEqual(responses[3]['output'], responses[0]['output'])
+
+    def testClient(self):
+        import time
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        client = os.path.join(os.path.dirname(os.path.abspath(minipy.__file__)),
+                              'minipy_client.py')
+        tmpdir = mkdtemp()
+        socket_path = os.path.join(tmpdir, 'socket')
+        server = Popen([executable, minipy.__file__, '--serve', '--jobs=1',
+                        '--socket', socket_path])
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            output = os.path.join(tmpdir, 'output.py')
+            pipe = Popen([executable, client, socket_path, '-DR', '-o', output,
+                          os.path.join(self.testdir, 'testFib.DR.py')],
+                         stdout=PIPE)
+            self.assertEqual(pipe.communicate()[0], '')
+            self.assertEqual(pipe.returncode, 0)
+            self.assertEqual(open(output).read(),
+                             open(os.path.join(self.testdir, 'testFib.py')).read())
+            pipe = Popen([executable, client, socket_path, 'missing.py'],
+                         stdout=PIPE, stderr=PIPE)
+            out, err = pipe.communicate()
+            self.assertEqual(pipe.returncode, 1)
+            self.assertTrue('IOError' in err)
+            # The client mustn't pay for loading minipy.
+            pipe = Popen([executable, '-c', 'import sys; sys.path.insert(0, '
+                          'sys.argv[1]); import minipy_client; '
+                          'print "minipy" in sys.modules',
+                          os.path.dirname(client)], stdout=PIPE)
+            self.assertEqual(pipe.communicate()[0], 'False\n')
+        finally:
+            server.terminate()
+            for _ in range(50):
+                if server.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                server.kill()
+            rmtree(tmpdir)
+
+    def testExportIndex(self):
+        import sys
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        tmpdir = mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'minipytestmod.py'), 'w') as f:
+                f.write('from os.path import *\n'
+                        'if 1:\n for bound in ():pass\n'
+                        'def function(): global gbl\n'
+                        'raise ImportError("imported")\n')
+            sys.path.insert(0, tmpdir)
+            try:
+                index_file = os.path.join(tmpdir, 'index.json')
+                index = minipy.ExportIndex(index_file)
+                names = index.exports('minipytestmod')
+                index.save()
+            finally:
+                sys.path.remove(tmpdir)
+            self.assertFalse('minipytestmod' in sys.modules)
+            for n in 'join bound function gbl __file__'.split():
+                self.assertTrue(n in names)
+            self.assertFalse('os' in names)
+            entries = minipy.ExportIndex(index_file).entries
+            self.assertTrue(any(sorted(names) == e[1]
+                                for e in entries.values()))
+        finally:
+            rmtree(tmpdir)
+
+    def testSelftestFailure(self):
+        class Broken(minipy.SerializeVisitor):
+            def visit_Num(self, node):
+                self.emit(repr(node.n + (node.n == 2)))
+        tree = parse('a = 1\nif a:\n    b = [1, 2]\nc = 2\n')
+        try:
+            Broken().serialize(tree)
+        except AssertionError as e:
+            message = str(e)
+        else:
+            self.fail("self-test passed")
+        self.assertTrue(message.startswith(
+            'self-test failed at line 3 of the original'))
+        self.assertTrue("\nNum(n=2)\n" in message)
+        self.assertTrue("\nif a:b=[1,3]\n" in message)
+        self.assertFalse("c=" in message)
+
 
 if __name__ == '__main__':
     unittest.main()